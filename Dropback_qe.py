@@ -1,6 +1,43 @@
+import contextlib
+import os
+import resource
+import tempfile
+import tracemalloc
+import warnings
+
+import numpy as np
 import torch
 from qe_cpp import qe
 
+# elements per chunk of chunked selection when it is picked through memory_budget
+SELECTION_CHUNK_SIZE = 2 ** 20
+
+
+def _resident_bytes(key="VmRSS"):
+    '''Resident memory of this process from /proc/self/status (Linux), VmHWM is its peak. None elsewhere.'''
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(key + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _reset_resident_peak():
+    '''Reset VmHWM to the current resident memory (Linux 4.0+), False when that is not possible.'''
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def _resident_peak():
+    peak = _resident_bytes("VmHWM")
+    # ru_maxrss is in KiB on Linux
+    return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
 
 class Dropback(torch.optim.SGD):
     '''
@@ -10,18 +47,47 @@ class Dropback(torch.optim.SGD):
 
     def __init__(self, params, lr, track_size=0, init_decay=1, proper_decay=False,
                  q=None, q_init=1e-2, q_step=1e-6, sf=False, ulp=False, beta=0.1,
-                 momentum=0, weight_decay=0):
+                 momentum=0, weight_decay=0, memory_budget=None, rank_every=1, init_offload_dir=None,
+                 selection_chunk_size=None, track_sizes=None, measure_memory=False):
         '''
         weight_decay: gamma in lr decay setting
         decay_rate is the actual ratio that applies on init_param (lr in lr decay setting)
         q: target quantile (default None, corresponds to not apply qe)
         sf: stop fixed init scheme: quantile estimation init change based on mean of runtime estimation
         ulp: use last prediction: quantile estimation init change based on last value of runtime estimation
+        The settings can also be given per param group. A group with dense=True is trained
+        with plain SGD, all of its weights are kept and it does not count towards track_size.
+        memory_budget: bytes the optimizer may use (persistent state plus the temporaries of a
+            step, see memory_report). When the default strategy does not fit, the scores are
+            written into one buffer instead of being concatenated (chunked_scoring), then the
+            top-k selection is chunked (selection_chunk_size) and then the initial weights are
+            stored in half precision (init_dtype).
+        rank_every: rank and reset the weights only every rank_every optimizer steps, in
+            between all weights are updated. With gradient accumulation (e.g. Lightning's
+            accumulate_grad_batches) step is called once per effective batch, so the ranking
+            already runs once per effective step.
+        init_offload_dir: keep the initial weights in a memory-mapped file in this directory
+            instead of next to the parameters. They are copied to the device one parameter
+            at a time for scoring and reset, the copy of the next one overlapping the use of
+            the current one (and the first one the SGD update). On the cpu they are used
+            directly from the mapping, whose pages the kernel can evict.
+        selection_chunk_size: select the top track_size weights chunk by chunk (without q),
+            so neither the scores nor the mask of the whole model are materialized, see
+            _chunked_topk_reset. The temporaries are bounded by the chunk size (at least one
+            row of a parameter) plus track_size, the selected weights are the same.
+        track_sizes: smaller track sizes whose nested top-k sets are kept along the run (one
+            byte per weight), see shadow_weights. Needs the plain top-k selection (no q, no
+            selection_chunk_size).
+        measure_memory: measure the peak allocation of every step (memory_report measured).
+            This resets the process wide peak counters of the CUDA allocator and tracemalloc
+            every step, it is done anyway with a memory_budget.
         '''
         super(Dropback, self).__init__(params, lr=lr, momentum=momentum, weight_decay=weight_decay)
         # TODO: check if input values are valid
 
         self.debug_flag = False
+        # optional callable marking the end of a phase of step, set by telemetry.StepTimeline
+        self.timeline = None
         self.debug = {
             "tracked_weights": 0,
             "tracked_est": 0,
@@ -33,19 +99,373 @@ class Dropback(torch.optim.SGD):
             for p in group['params']:
                 init_params.append(p.clone().detach())
             group['init_params'] = init_params
-            group['track_size'] = track_size
+            group.setdefault('track_size', track_size)
             group['first_iter'] = True
-            group['init_decay'] = init_decay
+            group.setdefault('init_decay', init_decay)
             group['decay_rate'] = 1
-            group['proper_decay'] = proper_decay
-            group['q'] = q
-            group['q_init'] = q_init
-            group['q_step'] = q_step
-            group['sf'] = sf
-            group['ulp'] = ulp
-            group['beta'] = beta
+            group.setdefault('proper_decay', proper_decay)
+            group.setdefault('q', q)
+            group.setdefault('q_init', q_init)
+            group.setdefault('q_step', q_step)
+            group.setdefault('sf', sf)
+            group.setdefault('ulp', ulp)
+            group.setdefault('beta', beta)
+            group.setdefault('dense', False)
+            group.setdefault('chunked_scoring', False)
+            group.setdefault('selection_chunk_size', selection_chunk_size)
+            group.setdefault('rank_every', rank_every)
+            group['track_sizes'] = sorted(group.get('track_sizes', track_sizes) or (), reverse=True)
+            group['step_count'] = 0
+            if group['track_sizes'] and not group['dense']:
+                if group['q'] is not None or group['selection_chunk_size']:
+                    raise ValueError("track_sizes needs the top-k selection, without q and selection_chunk_size")
+                if group['track_sizes'][0] >= group['track_size']:
+                    raise ValueError(f"track_sizes {group['track_sizes']} must be smaller than track_size {group['track_size']}")
         # save init weights to check?
 
+        self.memory_budget = memory_budget
+        self.measure_memory = measure_memory
+        # bytes of the temporaries of the last step by category, see memory_report
+        self.transient_memory = {}
+        self.measured_memory = {}
+        self.init_offload_dir = init_offload_dir
+        self._copy_stream = None
+        self._prefetched = {}
+        # level of every weight in the nested top-k sets of track_sizes, by id of the parameter
+        self.levels = {}
+        if memory_budget is not None:
+            self._fit_memory_budget()
+        if init_offload_dir is not None:
+            self._offload_init_params(init_offload_dir)
+
+    def _offload_init_params(self, directory):
+        '''Move the initial weights of every group into one memory-mapped file.'''
+        init_params = [init_p for group in self.param_groups for init_p in group['init_params']]
+        dtype = init_params[0].dtype
+        fd, path = tempfile.mkstemp(prefix="init_params_", dir=directory)
+        os.close(fd)
+        storage = np.memmap(path, dtype=torch.empty(0, dtype=dtype).numpy().dtype, mode="w+",
+                            shape=(sum(init_p.numel() for init_p in init_params),))
+        # the mapping keeps the file alive, it is removed together with the optimizer
+        os.remove(path)
+        storage = torch.from_numpy(storage)
+
+        start = 0
+        for group in self.param_groups:
+            offloaded = []
+            for init_p in group['init_params']:
+                end = start + init_p.numel()
+                host_init_p = storage[start:end].view(init_p.shape)
+                host_init_p.copy_(init_p)
+                offloaded.append(host_init_p)
+                start = end
+            group['init_params'] = offloaded
+        if torch.cuda.is_available() and self.param_groups[0]['params'][0].is_cuda:
+            self._copy_stream = torch.cuda.Stream(device=self.param_groups[0]['params'][0].device)
+
+    def _prefetch(self, init_p, device):
+        with torch.cuda.stream(self._copy_stream):
+            # pages of the mapping are read into pinned memory, the copy to the device is asynchronous
+            device_init_p = init_p.pin_memory().to(device, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record(self._copy_stream)
+        return device_init_p, ready
+
+    def _init_params_on_device(self, group, params):
+        '''
+        Yields (p, init_p on the device of p) for the (p, init_p) pairs of params. Offloaded
+        initial weights are double buffered: the copy of the next one runs on a side stream
+        while the current one is used.
+        '''
+        if self._copy_stream is None:
+            for p, init_p in params:
+                yield p, init_p.to(p.device)
+            return
+
+        pending = self._prefetched.pop(id(group), None) or self._prefetch(params[0][1], params[0][0].device)
+        for i, (p, _) in enumerate(params):
+            device_init_p, ready = pending
+            if i + 1 < len(params):
+                pending = self._prefetch(params[i + 1][1], params[i + 1][0].device)
+            torch.cuda.current_stream().wait_event(ready)
+            # allocated on the side stream, freed only after the computation using it
+            device_init_p.record_stream(torch.cuda.current_stream())
+            yield p, device_init_p
+
+    def load_state_dict(self, state_dict):
+        super(Dropback, self).load_state_dict(state_dict)
+        if self.init_offload_dir is not None:
+            # the loaded initial weights replace the mapped ones
+            self._offload_init_params(self.init_offload_dir)
+
+    def warm_start(self, init_params, momentum_buffers=None, **group_state):
+        '''
+        Continue from a source run instead of starting over from the current weights.
+        init_params and momentum_buffers are lists per param group, aligned with group['params'];
+        None entries (e.g. a resized classifier) keep the current weights as initial weights
+        and no momentum. group_state (e.g. decay_rate) is set on every Dropback group.
+        The tracked weights follow from the current weights: every weight that differs from
+        decay_rate * init_param is tracked.
+        '''
+        for i, group in enumerate(self.param_groups):
+            for j, p in enumerate(group['params']):
+                init_p = init_params[i][j]
+                if init_p is not None and self.init_offload_dir is not None:
+                    group['init_params'][j].copy_(init_p.detach())
+                elif init_p is not None:
+                    group['init_params'][j] = init_p.detach().to(device=p.device, dtype=group['init_params'][j].dtype).clone()
+                if momentum_buffers is not None and momentum_buffers[i][j] is not None:
+                    self.state[p]['momentum_buffer'] = momentum_buffers[i][j].detach().to(device=p.device, dtype=p.dtype).clone()
+            if not group['dense']:
+                group.update(group_state)
+
+    def _tensor_bytes(self, group, key=None):
+        if key is None:
+            return sum(p.numel() * p.element_size() for p in group['params'])
+        return sum(t.numel() * t.element_size() for t in group[key])
+
+    def persistent_memory(self):
+        '''Bytes held between steps by category, offloaded initial weights are counted as init_params_host.'''
+        memory = {"params": 0, "grads": 0, "init_params": 0, "momentum": 0}
+        if self.init_offload_dir is not None:
+            memory["init_params_host"] = 0
+        for group in self.param_groups:
+            memory["params"] += self._tensor_bytes(group)
+            memory["init_params" if self.init_offload_dir is None else "init_params_host"] += self._tensor_bytes(group, 'init_params')
+            for p in group['params']:
+                if p.grad is not None:
+                    memory["grads"] += p.grad.numel() * p.grad.element_size()
+                momentum_buffer = self.state[p].get('momentum_buffer')
+                if momentum_buffer is not None:
+                    memory["momentum"] += momentum_buffer.numel() * momentum_buffer.element_size()
+        if self.levels:
+            memory["levels"] = sum(levels.numel() for levels in self.levels.values())
+        return memory
+
+    def estimate_transient_memory(self, chunked_scoring=None, selection_chunk_size=None):
+        '''
+        Bytes of the temporaries of one step by category, at their peak (the scores, the
+        mask and the top-k or quantile estimation outputs are alive at the same time).
+        selection_chunk_size applies to the groups without one.
+        '''
+        memory = {"scores": 0, "mask": 0, "selection": 0}
+        for group in self.param_groups:
+            if group['dense']:
+                continue
+            chunked = group['chunked_scoring'] if chunked_scoring is None else chunked_scoring
+            numel = sum(p.numel() for p in group['params'] if p.requires_grad)
+            element_size = group['params'][0].element_size()
+            chunk_size = group['selection_chunk_size'] or selection_chunk_size
+            if chunk_size and group['q'] is None:
+                chunk_numel = min(numel, max([chunk_size] + [p[0].numel() for p in group['params'] if p.dim() > 0]))
+                track_size = min(numel, group['track_size'])
+                memory["scores"] = max(memory["scores"], chunk_numel * element_size)
+                memory["mask"] = max(memory["mask"], chunk_numel)
+                # candidates concatenated with a chunk, then values and int64 indices of topk
+                memory["selection"] = max(memory["selection"], (track_size + chunk_numel) * element_size + track_size * (element_size + 8))
+                continue
+            # the per parameter scores are concatenated into a second copy unless chunked
+            memory["scores"] = max(memory["scores"], numel * element_size * (1 if chunked else 2))
+            memory["mask"] = max(memory["mask"], numel)
+            if group['q'] is not None:
+                # cpu copy of the scores, the mask and the estimates of qe
+                memory["selection"] = max(memory["selection"], numel * (2 * element_size + 1))
+            else:
+                # values and int64 indices of topk
+                memory["selection"] = max(memory["selection"], group['track_size'] * (element_size + 8))
+        return memory
+
+    def memory_report(self):
+        '''
+        persistent: bytes held between steps by category
+        transient: temporaries of the last step by category (estimated before the first step)
+        measured: peak allocation during the last step above the allocation before it, from the
+            CUDA allocator on the gpu (cuda_step_peak) and from the peak resident memory of the
+            process on the cpu (cpu_step_peak, tensor storage included), plus the peak of Python
+            object allocations if tracemalloc is tracing (python_step_peak). Only with
+            measure_memory or a memory_budget, otherwise the peaks since the counters were last
+            reset (cuda_peak, cpu_peak, python_peak), the counters are left alone. Without a
+            resettable peak (no /proc/self/clear_refs) cpu_step_peak is how much the step raised
+            the peak of the process, 0 when it stayed below an earlier one.
+        '''
+        persistent = self.persistent_memory()
+        transient = self.transient_memory or self.estimate_transient_memory()
+        return {
+            "persistent": persistent,
+            "transient": transient,
+            "persistent_total": sum(persistent.values()),
+            "transient_peak": sum(transient.values()),
+            "measured": dict(self.measured_memory),
+            "strategy": {
+                "chunked_scoring": any(group['chunked_scoring'] for group in self.param_groups),
+                "selection_chunk_size": max((group['selection_chunk_size'] or 0) for group in self.param_groups) or None,
+                "init_dtype": str(self.param_groups[0]['init_params'][0].dtype),
+                "init_offload": self.init_offload_dir is not None,
+            },
+        }
+
+    def _estimated_total(self, chunked_scoring, init_element_size, selection_chunk_size=None):
+        persistent = self.persistent_memory()
+        # grads and momentum are only allocated by the first step, of the trained parameters of every group
+        trained_bytes = [sum(p.numel() * p.element_size() for p in group['params'] if p.requires_grad) for group in self.param_groups]
+        if persistent["grads"] == 0:
+            persistent["grads"] = sum(trained_bytes)
+        if persistent["momentum"] == 0:
+            persistent["momentum"] = sum(group_bytes for group, group_bytes in zip(self.param_groups, trained_bytes) if group['momentum'] != 0)
+        if self.init_offload_dir is None:
+            persistent["init_params"] = sum(p.numel() * init_element_size for group in self.param_groups for p in group['params'])
+        # offloaded initial weights do not take device memory
+        return (sum(persistent.values()) - persistent.get("init_params_host", 0)
+                + sum(self.estimate_transient_memory(chunked_scoring, selection_chunk_size).values()))
+
+    def _fit_memory_budget(self):
+        '''Pick the first strategy whose estimated memory fits memory_budget.'''
+        element_size = self.param_groups[0]['params'][0].element_size()
+        strategies = ((False, None, None), (True, None, None), (True, None, SELECTION_CHUNK_SIZE),
+                      (True, torch.float16, SELECTION_CHUNK_SIZE))
+        if any(group['track_sizes'] and not group['dense'] for group in self.param_groups):
+            # track_sizes needs the plain top-k selection, only the initial weights can shrink
+            strategies = ((False, None, None), (True, None, None), (True, torch.float16, None))
+        for chunked_scoring, init_dtype, selection_chunk_size in strategies:
+            init_element_size = element_size if init_dtype is None else torch.finfo(init_dtype).bits // 8
+            if self._estimated_total(chunked_scoring, init_element_size, selection_chunk_size) <= self.memory_budget:
+                break
+        else:
+            warnings.warn(f"Dropback needs about {self._estimated_total(True, 2, selection_chunk_size)} bytes even with "
+                          f"chunked scoring{' and selection' if selection_chunk_size else ''} and half precision initial "
+                          f"weights, more than the budget of {self.memory_budget} bytes.")
+
+        for group in self.param_groups:
+            group['chunked_scoring'] = chunked_scoring
+            group['selection_chunk_size'] = group['selection_chunk_size'] or selection_chunk_size
+            if init_dtype is not None:
+                group['init_params'] = [init_p.to(init_dtype) for init_p in group['init_params']]
+
+    def _scores(self, group):
+        '''|p - decay_rate * init_p| of the parameters with a gradient, flattened into one tensor.'''
+        params = [(p, init_p) for p, init_p in zip(group['params'], group['init_params']) if p.grad is not None]
+        if not params:
+            return None
+
+        if not group['chunked_scoring']:
+            abs_accumulated_all = []  # absolute value of accumulated gradients of the entire network
+            for p, init_p in self._init_params_on_device(group, params):
+                abs_accumulated_all.append(torch.abs(p - group['decay_rate'] * init_p.to(p.dtype)).flatten().clone().detach())
+            return torch.cat(abs_accumulated_all)
+
+        # written in place into one buffer, without per parameter temporaries
+        scores = torch.empty(sum(p.numel() for p, _ in params), dtype=params[0][0].dtype, device=params[0][0].device)
+        start = 0
+        for p, init_p in self._init_params_on_device(group, params):
+            end = start + p.numel()
+            out = scores[start:end].view_as(p)
+            out.copy_(init_p).mul_(group['decay_rate']).sub_(p.detach()).abs_()
+            start = end
+        return scores
+
+    def _selection_chunks(self, group):
+        '''
+        (p, init_p) slices along the first dimension of the parameters with a gradient, of at
+        most selection_chunk_size elements (at least one row), in the order of the scores of _scores.
+        '''
+        params = [(p, init_p) for p, init_p in zip(group['params'], group['init_params']) if p.grad is not None]
+        for p, init_p in self._init_params_on_device(group, params):
+            p_data = p.data if p.dim() > 0 else p.data.view(1)
+            init_p = init_p.view_as(p_data)
+            rows = max(1, group['selection_chunk_size'] // max(1, p_data[0].numel()))
+            for start in range(0, p_data.shape[0], rows):
+                yield p_data[start:start + rows], init_p[start:start + rows]
+
+    def _chunked_topk_reset(self, group):
+        '''
+        Top-k selection and reset without the scores and the mask of the whole group.
+        The first pass keeps the track_size largest scores seen so far (values only) and
+        finds the threshold, the second pass recomputes the scores of every chunk and resets
+        the weights below the threshold. Of the scores equal to the threshold, the first ones
+        in the order of the parameters are kept, as many as track_size allows. The selection
+        is the one of the unchunked top-k whenever the threshold is unique, torch.topk does
+        not define which of tied scores it picks.
+        '''
+        track_size = group['track_size']
+        candidates = None
+        chunk_bytes = 0
+        for p_chunk, init_chunk in self._selection_chunks(group):
+            scores = torch.abs(p_chunk - group['decay_rate'] * init_chunk.to(p_chunk.dtype)).flatten()
+            chunk_bytes = max(chunk_bytes, scores.numel() * scores.element_size())
+            if candidates is not None and candidates.numel() >= track_size > 0:
+                # lower scores can not make it into the top track_size
+                scores = scores[scores > candidates.min()]
+            candidates = scores if candidates is None else torch.cat([candidates, scores])
+            if candidates.numel() > track_size:
+                candidates, _ = torch.topk(candidates, track_size, sorted=False)
+        if candidates is None:
+            # every parameter of the group is frozen
+            return
+        element_size = candidates.element_size()
+        self.transient_memory["scores"] = max(self.transient_memory["scores"], chunk_bytes)
+        self.transient_memory["selection"] = max(self.transient_memory["selection"], candidates.numel() * (2 * element_size + 8) + chunk_bytes)
+
+        if candidates.numel() < track_size:
+            # fewer weights than track_size, all of them are tracked
+            threshold, ties = float("-inf"), 0
+        elif track_size == 0:
+            threshold, ties = float("inf"), 0
+        else:
+            threshold = candidates.min()
+            ties = track_size - int((candidates > threshold).sum())
+        del candidates
+        if self.debug_flag:
+            self.debug['th_val'] = threshold
+        if self.timeline is not None:
+            self.timeline("dropback/select")
+
+        for p_chunk, init_chunk in self._selection_chunks(group):
+            init_chunk = init_chunk.to(p_chunk.dtype)
+            # flattened in the logical order, also for channels_last parameters
+            scores = torch.abs(p_chunk - group['decay_rate'] * init_chunk).flatten()
+            mask = scores > threshold
+            if ties > 0:
+                tied = (scores == threshold).nonzero().flatten()[:ties]
+                mask[tied] = True
+                ties -= tied.numel()
+            mask = mask.view(p_chunk.shape)
+            self.transient_memory["mask"] = max(self.transient_memory["mask"], mask.numel() * mask.element_size())
+            p_chunk[~mask] = group['decay_rate'] * init_chunk[~mask]
+            # param is decayed for next iteration inference
+            if group['proper_decay'] and group['init_decay'] < 1:
+                p_chunk.add_(group['decay_rate'] * init_chunk, alpha=group['init_decay'] - 1)
+        if self.timeline is not None:
+            self.timeline("dropback/reset")
+
+    @contextlib.contextmanager
+    def shadow_weights(self, track_size):
+        '''
+        Use the weights of the nested level with track_size tracked weights (one of
+        track_sizes) inside the with block: the weights outside of the top track_size of the
+        last ranking are set to their untracked value. The weights are restored on exit.
+        '''
+        saved = []
+        with torch.no_grad():
+            for group in self.param_groups:
+                if track_size not in group['track_sizes']:
+                    continue
+                level = group['track_sizes'].index(track_size)
+                for p, init_p in zip(group['params'], group['init_params']):
+                    levels = self.levels.get(id(p))
+                    if levels is None:
+                        continue
+                    saved.append((p, p.detach().clone()))
+                    untracked = levels <= level
+                    untracked_values = group['decay_rate'] * init_p.to(device=p.device, dtype=p.dtype)
+                    if group['proper_decay'] and group['init_decay'] < 1:
+                        untracked_values = untracked_values * group['init_decay']
+                    p.data[untracked] = untracked_values[untracked]
+        try:
+            yield
+        finally:
+            for p, value in saved:
+                p.data.copy_(value)
+
     def get_decay_rate(self):
         '''Get decay rate of the optimizer'''
         return self.param_groups[0]['decay_rate']
@@ -62,6 +482,21 @@ class Dropback(torch.optim.SGD):
         if closure is not None:
             loss = closure()
 
+        measure_cuda = self.param_groups[0]['params'][0].is_cuda
+        # the peak counters are process wide, other users lose their peak when they are reset
+        reset_peaks = self.measure_memory or self.memory_budget is not None
+        if measure_cuda:
+            device = self.param_groups[0]['params'][0].device
+            allocated = torch.cuda.memory_allocated(device)
+            if reset_peaks:
+                torch.cuda.reset_peak_memory_stats(device)
+        elif reset_peaks:
+            resident = _resident_bytes() if _reset_resident_peak() else None
+            resident_peak = _resident_peak()
+        if reset_peaks and tracemalloc.is_tracing() and hasattr(tracemalloc, "reset_peak"):
+            # Python 3.9+, otherwise the peak is the one since tracing started
+            tracemalloc.reset_peak()
+
         for group in self.param_groups:
             # decay init weights
             if overwritten_decay_rate is not None:
@@ -74,20 +509,49 @@ class Dropback(torch.optim.SGD):
                 
             if group['first_iter']:
                 group['first_iter'] = False
+        if self.timeline is not None:
+            self.timeline("dropback/decay")
+
+        ranking_groups = []
+        for group in self.param_groups:
+            group['step_count'] += 1
+            if not group['dense'] and (group['step_count'] - 1) % group['rank_every'] == 0:
+                ranking_groups.append(group)
+                if self._copy_stream is not None:
+                    # the first offloaded initial weights are copied during the SGD update
+                    params = [(p, init_p) for p, init_p in zip(group['params'], group['init_params']) if p.grad is not None]
+                    if params:
+                        self._prefetched[id(group)] = self._prefetch(params[0][1], params[0][0].device)
+
+        # the closure was evaluated above, evaluating it again in SGD.step would add the
+        # gradient of the last (micro) batch a second time when gradients are accumulated
+        super(Dropback, self).step()
+        if self.timeline is not None:
+            self.timeline("optimizer")
+
+        if ranking_groups:
+            self.transient_memory = {"scores": 0, "mask": 0, "selection": 0}
 
-        super(Dropback, self).step(closure)
         # think and make sure it is a way that can be done in HW
         # evaluate and sort accumulated gradients (as an metric of importance)
         # mask off the non important weights back to initial weights
-        for group in self.param_groups:
-            abs_accumulated_all = []  # absolute value of accumulated gradients of the entire network
-            for p, init_p in zip(group['params'], group['init_params']):
-                if p.grad is None:
-                    continue
-                abs_accumulated_all.append(torch.abs(p - group['decay_rate'] * init_p).flatten().clone().detach())
-            abs_accumulated_flatten = torch.cat(abs_accumulated_all)
+        for group in ranking_groups:
+            if group['selection_chunk_size'] and group['q'] is None:
+                self._chunked_topk_reset(group)
+                continue
+            levels = None
+            abs_accumulated_flatten = self._scores(group)
+            if abs_accumulated_flatten is None:
+                # every parameter of the group is frozen
+                continue
+            scores_bytes = abs_accumulated_flatten.numel() * abs_accumulated_flatten.element_size()
+            self.transient_memory["scores"] = max(self.transient_memory["scores"], scores_bytes * (1 if group['chunked_scoring'] else 2))
             if group['q'] is not None:
                 flattened_mask, flattened_est = qe(abs_accumulated_flatten.cpu(), group['q_init'], group['q_step'], group['q'])
+                selection_bytes = sum(t.numel() * t.element_size() for t in (flattened_mask, flattened_est))
+                if not abs_accumulated_flatten.is_cpu:
+                    selection_bytes += scores_bytes
+                self.transient_memory["selection"] = max(self.transient_memory["selection"], selection_bytes)
                 self.debug['tracked_weights'] = torch.mean(flattened_est)
                 self.debug['tracked_est'] = torch.sum(flattened_mask)
 
@@ -107,18 +571,44 @@ class Dropback(torch.optim.SGD):
                 # create a mask that selects topk values
                 flattened_mask = torch.zeros_like(abs_accumulated_flatten, dtype=torch.bool)
                 flattened_mask.scatter_(0, ind, 1.)
+                if group['track_sizes']:
+                    levels = torch.zeros_like(abs_accumulated_flatten, dtype=torch.uint8)
+                    # ind is sorted by decreasing score, the top k of every level is a prefix of it
+                    for k in group['track_sizes']:
+                        levels[ind[:k]] += 1
+                self.transient_memory["selection"] = max(self.transient_memory["selection"], elements.numel() * (elements.element_size() + ind.element_size()))
 
                 if self.debug_flag:
                     self.debug['th_val'] = torch.min(elements)
+            self.transient_memory["mask"] = max(self.transient_memory["mask"], flattened_mask.numel() * flattened_mask.element_size())
+
+            if self.timeline is not None:
+                self.timeline("dropback/select")
 
             start = 0
-            for p, init_p in zip(group['params'], group['init_params']):
-                if p.grad is None:
-                    continue
+            params = [(p, init_p) for p, init_p in zip(group['params'], group['init_params']) if p.grad is not None]
+            for p, init_p in self._init_params_on_device(group, params):
                 end = start + p.data.numel()
                 mask = flattened_mask[start:end].view(p.size())
-                p.data[~mask] = group['decay_rate'] * init_p.data[~mask]
+                if levels is not None:
+                    self.levels[id(p)] = levels[start:end].view(p.size())
+                p.data[~mask] = group['decay_rate'] * init_p.data[~mask].to(p.dtype)
                 # param is decayed for next iteration inference
                 if group['proper_decay'] and group['init_decay'] < 1:
-                    p.data.add_(group['init_decay'] - 1, group['decay_rate'] * init_p)
-                start = end
\ No newline at end of file
+                    p.data.add_(group['init_decay'] - 1, group['decay_rate'] * init_p.to(p.dtype))
+                start = end
+            if self.timeline is not None:
+                self.timeline("dropback/reset")
+
+        if measure_cuda:
+            if reset_peaks:
+                self.measured_memory["cuda_step_peak"] = torch.cuda.max_memory_allocated(device) - allocated
+            else:
+                self.measured_memory["cuda_peak"] = torch.cuda.max_memory_allocated(device)
+        elif reset_peaks:
+            # above the resident memory before the step, or above the earlier peak of the process
+            self.measured_memory["cpu_step_peak"] = max(0, _resident_peak() - (resident if resident is not None else resident_peak))
+        else:
+            self.measured_memory["cpu_peak"] = _resident_peak()
+        if tracemalloc.is_tracing():
+            self.measured_memory["python_step_peak" if reset_peaks else "python_peak"] = tracemalloc.get_traced_memory()[1]
\ No newline at end of file
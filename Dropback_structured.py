@@ -0,0 +1,171 @@
+import torch
+
+
+class StructuredDropback(torch.optim.SGD):
+    '''
+    Dropback that tracks whole units instead of single weights, so the untracked
+    part of the network can be removed and run with smaller dense kernels.
+    Only supports SGD and SGD with momentum.
+
+    A unit is one of:
+        - an output channel (slice along dim 0) of a parameter, granularity='channel'
+        - a contiguous block of block_size weights of the flattened parameter, granularity='block'
+        - a channel shared by several parameters given in channel_groups, e.g. the hidden
+          channel of a MobileNetV2 inverted residual block (expand conv row, its BN, the
+          depthwise filter, its BN and the projection conv column)
+    '''
+
+    def __init__(self, params, lr, track_size=0, init_decay=1, granularity="channel", block_size=16,
+                 channel_groups=None, momentum=0, weight_decay=0):
+        '''
+        track_size: number of weights to track, units are tracked in order of their score
+            until the budget is used up
+        granularity: 'channel' or 'block'
+        channel_groups: optional list of groups, each a list of (param, dim) pairs whose
+            slices along dim form one unit, only used with granularity='channel'
+        '''
+        if granularity not in ("channel", "block"):
+            raise ValueError(f"Invalid granularity: {granularity}")
+
+        super(StructuredDropback, self).__init__(params, lr=lr, momentum=momentum, weight_decay=weight_decay)
+
+        self.channel_groups = channel_groups if granularity == "channel" and channel_groups else []
+        self.grouped = {}
+        for group_id, members in enumerate(self.channel_groups):
+            for p, dim in members:
+                self.grouped[id(p)] = (group_id, dim)
+
+        for group in self.param_groups:
+            group['init_params'] = [p.clone().detach() for p in group['params']]
+            group['track_size'] = track_size
+            group['first_iter'] = True
+            group['init_decay'] = init_decay
+            group['decay_rate'] = 1
+            group['granularity'] = granularity
+            group['block_size'] = block_size
+            group['tracked_fraction'] = 1.
+
+    def get_decay_rate(self):
+        '''Get decay rate of the optimizer'''
+        return self.param_groups[0]['decay_rate']
+
+    def _unit_scores(self, group):
+        '''
+        Sum of absolute accumulated gradients and number of weights of every unit.
+        Independent units of each parameter come first (in parameter order), followed by
+        the units of the channel groups.
+        '''
+        scores = []
+        sizes = []
+        group_scores = [None] * len(self.channel_groups)
+        group_sizes = [0] * len(self.channel_groups)
+
+        for p, init_p in zip(group['params'], group['init_params']):
+            abs_accumulated = torch.abs(p.data - group['decay_rate'] * init_p)
+
+            if id(p) in self.grouped:
+                group_id, dim = self.grouped[id(p)]
+                channel_scores = abs_accumulated.transpose(0, dim).reshape(p.size(dim), -1).sum(1)
+                if group_scores[group_id] is None:
+                    group_scores[group_id] = channel_scores
+                else:
+                    group_scores[group_id] = group_scores[group_id] + channel_scores
+                group_sizes[group_id] += p.numel() // p.size(dim)
+                continue
+
+            if p.grad is None:
+                continue
+
+            if group['granularity'] == "channel":
+                scores.append(abs_accumulated.flatten(1).sum(1) if p.dim() > 1 else abs_accumulated)
+                sizes.append(torch.full_like(scores[-1], p.numel() // p.size(0)))
+            else:
+                flattened = abs_accumulated.flatten()
+                num_blocks = -(-flattened.numel() // group['block_size'])
+                padded = flattened.new_zeros(num_blocks * group['block_size'])
+                padded[:flattened.numel()] = flattened
+                scores.append(padded.view(num_blocks, group['block_size']).sum(1))
+                block_sizes = torch.full_like(scores[-1], group['block_size'])
+                block_sizes[-1] = flattened.numel() - (num_blocks - 1) * group['block_size']
+                sizes.append(block_sizes)
+
+        for channel_scores, size in zip(group_scores, group_sizes):
+            if channel_scores is not None:
+                scores.append(channel_scores)
+                sizes.append(torch.full_like(channel_scores, size))
+
+        return torch.cat(scores), torch.cat(sizes)
+
+    def _unit_masks(self, group, unit_mask):
+        '''
+        Split the flat unit mask back into a mask per parameter (keyed by id and
+        broadcastable to the parameter), in the same order as _unit_scores.
+        '''
+        masks = {}
+        start = 0
+        for p in group['params']:
+            if id(p) in self.grouped or p.grad is None:
+                continue
+
+            if group['granularity'] == "channel":
+                end = start + p.size(0)
+                masks[id(p)] = unit_mask[start:end].view(-1, *([1] * (p.dim() - 1)))
+            else:
+                end = start + -(-p.numel() // group['block_size'])
+                block_mask = unit_mask[start:end].repeat_interleave(group['block_size'])
+                masks[id(p)] = block_mask[:p.numel()].view(p.size())
+            start = end
+
+        for members in self.channel_groups:
+            channel_mask = None
+            for p, dim in members:
+                if channel_mask is None:
+                    end = start + p.size(dim)
+                    channel_mask = unit_mask[start:end]
+                    start = end
+                shape = [1] * p.dim()
+                shape[dim] = -1
+                masks[id(p)] = channel_mask.view(shape)
+
+        return masks
+
+    def step(self, closure=None):
+        """Performs a single optimization step.
+        Arguments:
+            closure (callable, optional): A closure that reevaluates the model
+                and returns the loss.
+        """
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        for group in self.param_groups:
+            # decay init weights
+            if group['decay_rate'] != 0:
+                if not group['first_iter'] and group['init_decay'] < 1:
+                    group['decay_rate'] *= group['init_decay']
+                    if group['decay_rate'] < 1e-10:
+                        group['decay_rate'] = 0
+
+            if group['first_iter']:
+                group['first_iter'] = False
+
+        # the closure has already been evaluated above
+        super(StructuredDropback, self).step()
+        # rank units by their mean absolute accumulated gradient and track the best ones
+        # until track_size weights are used up, the rest is reset to the initial weights
+        for group in self.param_groups:
+            unit_scores, unit_sizes = self._unit_scores(group)
+            order = torch.argsort(unit_scores / unit_sizes, descending=True)
+            tracked_order = torch.cumsum(unit_sizes[order].double(), 0) <= group['track_size']
+            unit_mask = torch.zeros_like(unit_scores, dtype=torch.bool)
+            unit_mask[order[tracked_order]] = True
+            group['tracked_fraction'] = (unit_sizes[unit_mask].sum() / unit_sizes.sum()).item()
+
+            masks = self._unit_masks(group, unit_mask)
+            for p, init_p in zip(group['params'], group['init_params']):
+                if id(p) not in masks:
+                    continue
+                p.data.copy_(torch.where(masks[id(p)], p.data, group['decay_rate'] * init_p))
+
+        return loss
@@ -0,0 +1,199 @@
+import math
+import multiprocessing
+import queue
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Subset
+
+from pytorch_lightning.callbacks import Callback
+from pytorch_lightning.utilities import rank_zero_info
+
+from ray import tune
+
+from checkpoint import dropback_state_dict, init_fingerprint, load_dropback_weights, named_init_params
+
+
+def stratified_subset(dataset, fraction, seed=42):
+    '''
+    Subset with the same fraction of samples of every class, the dataset has to expose targets.
+    '''
+    targets = torch.as_tensor(dataset.targets)
+    generator = torch.Generator().manual_seed(seed)
+    indices = []
+    for label in torch.unique(targets):
+        label_indices = torch.nonzero(targets == label).flatten()
+        num_samples = max(1, math.ceil(fraction * len(label_indices)))
+        indices.append(label_indices[torch.randperm(len(label_indices), generator=generator)[:num_samples]])
+
+    return Subset(dataset, torch.sort(torch.cat(indices)).values.tolist())
+
+def evaluate(model, loader):
+    '''Validation loss and top1/top5 accuracy, named like the metrics logged by ExperimentModel.'''
+    loss = 0.
+    correct_top1 = 0
+    correct_top5 = 0
+    num_samples = 0
+
+    with torch.no_grad():
+        for x, y in loader:
+            logits = model(x)
+            loss += F.cross_entropy(logits, y, reduction="sum").item()
+            top5 = torch.topk(logits, min(5, logits.size(1)), dim=1).indices
+            correct_top1 += (top5[:, 0] == y).sum().item()
+            correct_top5 += (top5 == y.unsqueeze(1)).any(1).sum().item()
+            num_samples += len(y)
+
+    return {
+        "ptl/val_loss": loss / num_samples,
+        "ptl/val_accuracy_top1": correct_top1 / num_samples,
+        "ptl/val_accuracy_top5": correct_top5 / num_samples,
+    }
+
+def _validation_worker(model_cls, hyper_parameters, dataset, batch_size, num_workers, num_threads,
+                       subsample, requests, results):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    model = model_cls(**hyper_parameters).eval()
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+    subsample_loader = None
+    if subsample:
+        subsample_loader = DataLoader(stratified_subset(dataset, subsample), batch_size=batch_size, num_workers=num_workers)
+    init_params = None
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        if "init_params" in request:
+            init_params = request["init_params"]
+            continue
+
+        state = request["state"]
+        if "format" in state:
+            load_dropback_weights(model, state, init_params)
+        else:
+            model.load_state_dict(state)
+
+        metrics = evaluate(model, subsample_loader if request["subsample"] else loader)
+        metrics["val_subsample"] = float(request["subsample"])
+        results.put((request["epoch"], metrics))
+
+
+class AsyncValidation(Callback):
+    '''
+    Validate weight snapshots in a background process on the cpu while training continues.
+    Use it with limit_val_batches=0 on the trainer and instead of TuneReportCallback.
+
+    At the end of every training epoch the weights are snapshotted, for Dropback only the
+    tracked weights (the initial weights are sent once). The results are logged to the
+    logger with the epoch as step, and reported to Ray Tune tagged with validation_epoch,
+    in epoch order. If the worker falls more than max_pending snapshots behind, training
+    waits for it, and fails if the worker died.
+    '''
+
+    def __init__(self, metrics=None, subsample=None, subsample_epochs=0, every_n_epochs=1,
+                 batch_size=None, num_workers=0, num_threads=None, max_pending=4):
+        '''
+        metrics: dict mapping Ray Tune names to logged metric names, like TuneReportCallback.
+            Metrics not computed by the validation (e.g. sparsity) are taken from the trainer.
+            None disables reporting to Ray Tune.
+        subsample: fraction of the validation set (stratified by class) used during the
+            first subsample_epochs epochs
+        num_threads: intra-op threads of the validation process
+        '''
+        super().__init__()
+        self.metrics = metrics
+        self.subsample = subsample
+        self.subsample_epochs = subsample_epochs
+        self.every_n_epochs = every_n_epochs
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.num_threads = num_threads
+        self.max_pending = max_pending
+        self._process = None
+
+    def on_fit_start(self, trainer, pl_module):
+        val_loader = trainer.datamodule.val_dataloader()
+        context = multiprocessing.get_context("spawn")
+        self._requests = context.Queue(maxsize=self.max_pending)
+        self._results = context.Queue()
+        self._process = context.Process(
+            target=_validation_worker,
+            args=(type(pl_module), dict(pl_module.hparams), val_loader.dataset,
+                  self.batch_size or val_loader.batch_size, self.num_workers, self.num_threads,
+                  self.subsample, self._requests, self._results),
+            daemon=True)
+        self._process.start()
+        self._is_dropback = False
+        self._init_params = None
+        self._fingerprint = None
+
+    def on_train_start(self, trainer, pl_module):
+        # the optimizers only exist once training starts
+        optimizer = trainer.optimizers[0]
+        self._is_dropback = 'init_params' in optimizer.param_groups[0]
+        if self._is_dropback:
+            # copied once, the snapshots of every epoch only compare against them
+            self._init_params = named_init_params(pl_module, optimizer)
+            self._fingerprint = init_fingerprint(self._init_params)
+            self._put({"init_params": self._init_params})
+
+    def _put(self, request, timeout=10):
+        # the queue is bounded, a worker that died would block training forever
+        while True:
+            if not self._process.is_alive():
+                raise RuntimeError(f"The asynchronous validation process died (exit code {self._process.exitcode}).")
+            try:
+                self._requests.put(request, timeout=timeout)
+                return
+            except queue.Full:
+                continue
+
+    def _snapshot(self, trainer, pl_module):
+        if self._is_dropback:
+            return dropback_state_dict(pl_module, trainer.optimizers[0], with_momentum=False,
+                                       init_params=self._init_params, fingerprint=self._fingerprint)
+        return {name: value.detach().cpu().clone() for name, value in pl_module.state_dict().items()}
+
+    def on_train_epoch_end(self, trainer, pl_module, *args):
+        epoch = trainer.current_epoch
+        if (epoch + 1) % self.every_n_epochs == 0:
+            self._put({
+                "epoch": epoch,
+                "state": self._snapshot(trainer, pl_module),
+                "subsample": bool(self.subsample) and epoch < self.subsample_epochs,
+            })
+        self._report(trainer)
+
+    def on_train_batch_end(self, trainer, pl_module, *args):
+        self._report(trainer)
+
+    def on_train_end(self, trainer, pl_module):
+        self._put(None)
+        self._report(trainer, wait=True)
+        self._process.join()
+        rank_zero_info("Asynchronous validation finished.")
+
+    def _report(self, trainer, wait=False):
+        while True:
+            try:
+                if wait and self._process.is_alive():
+                    epoch, metrics = self._results.get(timeout=1)
+                else:
+                    epoch, metrics = self._results.get_nowait()
+            except queue.Empty:
+                if wait and self._process.is_alive():
+                    continue
+                return
+
+            if trainer.logger is not None:
+                trainer.logger.log_metrics(metrics, step=epoch)
+            if self.metrics:
+                report_dict = {"validation_epoch": epoch}
+                for key, metric in self.metrics.items():
+                    if metric in metrics:
+                        report_dict[key] = metrics[metric]
+                    elif metric in trainer.callback_metrics:
+                        report_dict[key] = trainer.callback_metrics[metric].item()
+                tune.report(**report_dict)
@@ -15,6 +15,9 @@ from ray.tune.integration.pytorch_lightning import TuneReportCallback
 
 from models import ExperimentModel
 from datamodules import cifar100_datamodule
+from curve_scheduler import LearningCurveScheduler
+from telemetry import StepTimeline, timeline_tune_metrics
+from results_store import ResultsStore
 
 
 def main():
@@ -34,6 +37,12 @@ def training(config, num_epochs=10, num_gpus=0):
     cifar100_dm = cifar100_datamodule(labels=target_list,  already_prepared=True, data_dir=str(Path.home())+"/data")
     num_classes = cifar100_dm.num_classes
 
+    # Per step time breakdown (data wait, forward, backward, optimizer, ...), see telemetry.py
+    step_timeline = False
+    # Every config and metric also goes to results.sqlite in the experiment directory, see results_store.py.
+    # SQLite's WAL needs a local filesystem for the experiment directory
+    results_store = False
+
     trainer = pl.Trainer(
         max_epochs=num_epochs,
         gpus=math.ceil(num_gpus),  # If fractional GPUs passed in, convert to int.
@@ -47,6 +56,7 @@ def training(config, num_epochs=10, num_gpus=0):
                     "loss": "ptl/val_loss",
                     "mean_accuracy": "ptl/val_accuracy_top1",
                     "current_lr": "current_lr",
+                    **(timeline_tune_metrics() if step_timeline else {}),
                 },
                 on="validation_end"),
             ModelCheckpoint(
@@ -56,7 +66,7 @@ def training(config, num_epochs=10, num_gpus=0):
                 mode='max',
                 auto_insert_metric_name=False
             ),
-        ],
+        ] + ([StepTimeline()] if step_timeline else []) + ([ResultsStore(config)] if results_store else []),
     )
 
     checkpoint_path = None
@@ -75,10 +85,19 @@ def tune_asha(num_samples=10, num_epochs=10, gpus_per_trial=0):
         "weight_decay": tune.loguniform(1e-6, 1e-3),
     }
 
-    scheduler = ASHAScheduler(
-        max_t=num_epochs,
-        grace_period=60,
-        reduction_factor=2)
+    # Stop trials whose extrapolated accuracy curve is confidently below the best trial, see curve_scheduler.py
+    use_curve_scheduler = False
+    if use_curve_scheduler:
+        scheduler = LearningCurveScheduler(
+            max_t=num_epochs,
+            metric="mean_accuracy",
+            min_t=20,
+            eval_every=10)
+    else:
+        scheduler = ASHAScheduler(
+            max_t=num_epochs,
+            grace_period=60,
+            reduction_factor=2)
 
     in_jupyter_notebook = False
     if in_jupyter_notebook:
@@ -0,0 +1,700 @@
+import copy
+import os
+import tempfile
+import time
+
+import torch
+import torch.nn.functional as F
+
+import torch.nn.utils.prune as prune
+import torchvision
+from torch.utils.data import DataLoader, Dataset
+
+from models import ExperimentModel, DBModel, PruneModel
+from checkpoint import save_init_params, save_sparse_checkpoint, load_sparse_checkpoint, load_pruned_checkpoint
+from export import mobilenet_v2_channel_groups, export_structured_mobilenet_v2
+from utils import count_macs, cpu_latency, effective_macs, measure_global_sparsity
+from masks import MaskStatistics, dropback_masks
+from results_store import connect, add_trial, add_metrics, best_of, learning_curves
+from core_pinning import core_slots, pin_trial
+from quantized_export import compare_exports, print_comparison, quantized_state_dict, load_quantized_state_dict
+
+
+def time_training_steps(model, optimizer, batch_size=128, num_classes=10, num_steps=20, warmup=5, accumulate_grad_batches=1):
+    '''
+    Images per second of a plain training loop on random CIFAR sized data.
+    With accumulate_grad_batches, every optimizer step accumulates the gradients of that many
+    micro-batches of batch_size, as Lightning does.
+    '''
+    model.train()
+    x = torch.randn(batch_size, 3, 32, 32)
+    y = torch.randint(0, num_classes, (batch_size,))
+
+    for i in range(warmup + num_steps):
+        if i == warmup:
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        for _ in range(accumulate_grad_batches):
+            loss = F.cross_entropy(model(x), y) / accumulate_grad_batches
+            loss.backward()
+        optimizer.step()
+    elapsed = time.perf_counter() - start
+
+    return num_steps * batch_size * accumulate_grad_batches / elapsed
+
+def time_inference(model, batch_size=128, num_steps=20, warmup=5):
+    '''
+    Images per second of the model in eval mode on random CIFAR sized data.
+    '''
+    model.eval()
+    x = torch.randn(batch_size, 3, 32, 32)
+
+    with torch.no_grad():
+        for i in range(warmup + num_steps):
+            if i == warmup:
+                start = time.perf_counter()
+            model(x)
+    elapsed = time.perf_counter() - start
+
+    return num_steps * batch_size / elapsed
+
+def benchmark_fast_path(batch_size=128, num_steps=20):
+    '''
+    Compare eager NCHW ExperimentModel against the channels_last/folded-BN fast path
+    and the compiled fast path on CPU.
+    '''
+    results = {}
+    for name, kwargs in [
+        ("eager", {}),
+        ("fast_path", {"fast_path": True}),
+        ("fast_path+compile", {"fast_path": True, "compile_model": True}),
+    ]:
+        torch.manual_seed(0)
+        model = ExperimentModel(**kwargs)
+        optimizer = torch.optim.SGD(model.parameters(), lr=model.lr, momentum=model.momentum)
+
+        train_throughput = time_training_steps(model, optimizer, batch_size=batch_size, num_steps=num_steps)
+
+        model.on_validation_epoch_start()
+        eval_throughput = time_inference(model, batch_size=batch_size, num_steps=num_steps)
+        with torch.no_grad():
+            x = torch.randn(8, 3, 32, 32)
+            max_diff = (model(x) - model.model(x)).abs().max().item()
+        model.on_validation_epoch_end()
+
+        results[name] = (train_throughput, eval_throughput)
+        print(f"{name:>20}: train {train_throughput:8.1f} img/s, eval {eval_throughput:8.1f} img/s, "
+              f"max |folded - unfolded| {max_diff:.2e}")
+
+    return results
+
+def benchmark_structured_dropback(tracked_fractions=(1.0, 0.5, 0.25, 0.1)):
+    '''
+    Zero out all but a fraction of the hidden channels of every inverted residual block,
+    as StructuredDropback does once init_decay reached zero, export the smaller model and
+    compare MACs and CPU latency against the dense model.
+    '''
+    torch.manual_seed(0)
+    dense_model = ExperimentModel().model.eval()
+    dense_macs = count_macs(dense_model)
+    dense_latency = cpu_latency(dense_model) * 1000
+    dense_throughput = time_inference(dense_model)
+
+    for fraction in tracked_fractions:
+        model = copy.deepcopy(dense_model)
+        with torch.no_grad():
+            for channel_group in mobilenet_v2_channel_groups(model):
+                num_channels = channel_group[0][0].size(0)
+                dead = torch.randperm(num_channels)[:num_channels - max(1, round(fraction * num_channels))]
+                for param, dim in channel_group:
+                    param.index_fill_(dim, dead, 0)
+
+        exported_model = export_structured_mobilenet_v2(model)
+        x = torch.randn(8, 3, 32, 32)
+        with torch.no_grad():
+            max_diff = (model(x) - exported_model(x)).abs().max().item()
+
+        macs = count_macs(exported_model)
+        latency = cpu_latency(exported_model.eval()) * 1000
+        throughput = time_inference(exported_model)
+        print(f"tracked hidden channels {fraction:4.2f}: MACs {macs / dense_macs:5.3f}x, "
+              f"latency {latency:6.2f} ms ({latency / dense_latency:5.3f}x), "
+              f"throughput {throughput:8.1f} img/s ({throughput / dense_throughput:5.2f}x), "
+              f"max |exported - masked| {max_diff:.2e}")
+
+def benchmark_sparse_checkpoint(num_steps=20, batch_size=64, sparse_momentum=False):
+    '''
+    Size and save/load time of a sparse Dropback checkpoint against the dense checkpoint
+    Lightning writes (state_dict plus optimizer state including init_params), and check
+    that the rebuilt model and optimizer match exactly.
+    '''
+    torch.manual_seed(0)
+    config = {
+        "lr": 0.1,
+        "momentum": 0.9,
+        "weight_decay": 4e-5,
+        "track_size": 111835,
+        "init_decay": 0.99,
+        "q": None,
+        "q_init": 1e-2,
+        "q_step": 1e-6,
+        "sf": False,
+    }
+    model = DBModel(config=config)
+    optimizers, schedulers = model.configure_optimizers()
+    optimizer, scheduler = optimizers[0], schedulers[0]
+    time_training_steps(model, optimizer, batch_size=batch_size, num_steps=num_steps, warmup=0)
+
+    with tempfile.TemporaryDirectory() as dirpath:
+        dense_path = os.path.join(dirpath, "dense.ckpt")
+        start = time.perf_counter()
+        torch.save({
+            "state_dict": model.state_dict(),
+            "optimizer_states": [optimizer.state_dict()],
+            "lr_schedulers": [scheduler.state_dict()],
+            "hyper_parameters": dict(model.hparams),
+        }, dense_path)
+        dense_save = time.perf_counter() - start
+        start = time.perf_counter()
+        torch.load(dense_path)
+        dense_load = time.perf_counter() - start
+
+        init_path = os.path.join(dirpath, "init_params.pt")
+        save_init_params(model, optimizer, init_path)
+        sparse_path = os.path.join(dirpath, "sparse.pt")
+        start = time.perf_counter()
+        save_sparse_checkpoint(model, optimizer, sparse_path, init_path=init_path, sparse_momentum=sparse_momentum,
+                               lr_schedulers=[scheduler.state_dict()])
+        sparse_save = time.perf_counter() - start
+        start = time.perf_counter()
+        loaded_model, loaded_optimizer, _, _ = load_sparse_checkpoint(sparse_path)
+        sparse_load = time.perf_counter() - start
+
+        print(f"dense checkpoint : {os.path.getsize(dense_path) / 2**20:7.2f} MiB, "
+              f"save {dense_save * 1000:7.1f} ms, load {dense_load * 1000:7.1f} ms")
+        print(f"sparse checkpoint: {os.path.getsize(sparse_path) / 2**20:7.2f} MiB "
+              f"(+{os.path.getsize(init_path) / 2**20:.2f} MiB init_params once per trial), "
+              f"save {sparse_save * 1000:7.1f} ms, load (incl. rebuilding the model) {sparse_load * 1000:7.1f} ms")
+
+    exact = all(torch.equal(p, loaded_p) for p, loaded_p in zip(model.parameters(), loaded_model.parameters()))
+    exact &= all(torch.equal(init_p, loaded_init_p) for init_p, loaded_init_p in
+                 zip(optimizer.param_groups[0]['init_params'], loaded_optimizer.param_groups[0]['init_params']))
+    if not sparse_momentum:
+        exact &= all(torch.equal(optimizer.state[p]['momentum_buffer'], loaded_optimizer.state[loaded_p]['momentum_buffer'])
+                     for p, loaded_p in zip(model.parameters(), loaded_model.parameters()))
+    print(f"model and optimizer state rebuilt exactly: {exact}")
+
+def _tensor_bytes(model):
+    parameters = sum(p.numel() * p.element_size() for p in model.parameters())
+    buffers = sum(b.numel() * b.element_size() for b in model.buffers())
+    # the masked weights recomputed by the pruning forward pre-hooks are plain attributes
+    recomputed = sum(
+        getattr(module, hook._tensor_name).numel() * getattr(module, hook._tensor_name).element_size()
+        for module in model.modules() for hook in module._forward_pre_hooks.values()
+        if isinstance(hook, prune.BasePruningMethod))
+
+    return parameters, buffers, recomputed
+
+def benchmark_fused_masks(amount=0.9, batch_size=128, num_steps=20):
+    '''
+    Training throughput and tensor memory of a plain PruneModel, one pruned with the
+    torch.nn.utils.prune reparametrization (as ModelPruning does) and one with fused masks.
+    '''
+    for name in ["plain", "reparametrized", "fused"]:
+        torch.manual_seed(0)
+        model = PruneModel(pruning=True, fused_masks=name == "fused")
+        if name != "plain":
+            parameters_to_prune = [(module, param_name) for module in model.model.modules()
+                                   for param_name in ("weight", "bias") if getattr(module, param_name, None) is not None]
+            prune.global_unstructured(parameters_to_prune, pruning_method=prune.L1Unstructured, amount=amount)
+        if name == "fused":
+            model.fuse_pruning_masks()
+
+        optimizer = torch.optim.SGD(model.parameters(), lr=model.lr, momentum=model.momentum, weight_decay=model.weight_decay)
+        throughput = time_training_steps(model, optimizer, batch_size=batch_size, num_steps=num_steps)
+        if name == "fused":
+            model.apply_pruning_masks()
+        _, _, sparsity = measure_global_sparsity(model.model, weight=True, bias=True, use_mask=True)
+        parameters, buffers, recomputed = _tensor_bytes(model.model)
+        print(f"{name:>15}: train {throughput:8.1f} img/s, parameters {parameters / 2**20:6.2f} MiB, "
+              f"buffers {buffers / 2**20:6.2f} MiB, recomputed weights {recomputed / 2**20:6.2f} MiB, "
+              f"mask sparsity {sparsity:.3f}")
+
+def benchmark_pruned_checkpoint_loader(amount=0.9):
+    '''
+    Startup time of a pruned checkpoint loaded with prune.identity on every module followed by
+    load_state_dict, against load_pruned_checkpoint (with and without make_permanent).
+    '''
+    torch.manual_seed(0)
+    model = PruneModel(pruning=True)
+    parameters_to_prune = [(module, name) for module in model.model.modules()
+                           for name in ("weight", "bias") if getattr(module, name, None) is not None]
+    prune.global_unstructured(parameters_to_prune, pruning_method=prune.L1Unstructured, amount=amount)
+
+    with tempfile.TemporaryDirectory() as dirpath:
+        path = os.path.join(dirpath, "pruned.ckpt")
+        torch.save({"state_dict": model.state_dict()}, path)
+
+        start = time.perf_counter()
+        identity_model = PruneModel(pruning=True)
+        for module in identity_model.modules():
+            if getattr(module, "weight", None) is not None:
+                prune.identity(module, "weight")
+            if getattr(module, "bias", None) is not None:
+                prune.identity(module, "bias")
+        identity_model.load_state_dict(torch.load(path)["state_dict"])
+        identity_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        loaded_model = load_pruned_checkpoint(PruneModel(pruning=True), path)
+        loader_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        permanent_model = load_pruned_checkpoint(PruneModel(pruning=True), path, make_permanent=True)
+        permanent_time = time.perf_counter() - start
+
+    x = torch.randn(8, 3, 32, 32)
+    model.eval(), identity_model.eval(), loaded_model.eval(), permanent_model.eval()
+    with torch.no_grad():
+        reference = identity_model(x)
+        max_diff = max((loaded_model(x) - reference).abs().max().item(), (permanent_model(x) - reference).abs().max().item())
+    print(f"prune.identity + load_state_dict: {identity_time * 1000:7.1f} ms")
+    print(f"load_pruned_checkpoint          : {loader_time * 1000:7.1f} ms")
+    print(f"load_pruned_checkpoint permanent: {permanent_time * 1000:7.1f} ms, max |output difference| {max_diff:.2e}")
+
+def benchmark_vectorized_trials(num_trials=4, batch_size=64, num_steps=10, warmup=2):
+    '''
+    Training throughput (images per second summed over trials) of num_trials Dropback models
+    trained one after another against the same models stacked with VectorizedTrials.
+    '''
+    from multi_trial import VectorizedTrials
+
+    configs = [{
+        "lr": 0.1, "momentum": 0.9, "weight_decay": 4e-5, "track_size": 111835, "init_decay": 0.995,
+        "q": None, "q_init": 1e-2, "q_step": 1e-6, "sf": False,
+    } for _ in range(num_trials)]
+
+    sequential_time = 0.
+    for config in configs:
+        model = DBModel(config=config)
+        optimizers, _ = model.configure_optimizers()
+        throughput = time_training_steps(model, optimizers[0], batch_size=batch_size, num_steps=num_steps, warmup=warmup)
+        sequential_time += batch_size * num_steps / throughput
+    sequential_throughput = num_trials * batch_size * num_steps / sequential_time
+
+    trials = VectorizedTrials(configs, dropback=True)
+    x = torch.randn(batch_size, 3, 32, 32)
+    y = torch.randint(0, 10, (batch_size,))
+    for i in range(warmup + num_steps):
+        if i == warmup:
+            start = time.perf_counter()
+        trials.training_step(x, y)
+    vectorized_throughput = num_trials * batch_size * num_steps / (time.perf_counter() - start)
+
+    print(f"{num_trials} trials sequential: {sequential_throughput:8.1f} img/s, "
+          f"vectorized: {vectorized_throughput:8.1f} img/s ({vectorized_throughput / sequential_throughput:.2f}x)")
+
+def benchmark_trial_clone(num_steps=20, batch_size=64, epoch_images=5000):
+    '''
+    Latency of cloning a Dropback trial for population based training (serialize the trial
+    state, load it into another trial with perturbed hyperparameters) relative to the time of
+    one training epoch of epoch_images images (a 10 class subset of CIFAR100).
+    '''
+    import io
+    import types
+
+    from pbt import trial_state_dict, load_trial_state
+
+    config = {
+        "lr": 0.1, "momentum": 0.9, "weight_decay": 4e-5, "track_size": 111835, "init_decay": 0.995,
+        "q": None, "q_init": 1e-2, "q_step": 1e-6, "sf": False,
+    }
+
+    def trial(config):
+        # the whole population is built from the same seed
+        torch.manual_seed(0)
+        model = DBModel(config=config)
+        optimizers, schedulers = model.configure_optimizers()
+        trainer = types.SimpleNamespace(optimizers=optimizers, lr_schedulers=[{"scheduler": schedulers[0]}],
+                                        current_epoch=0, global_step=0)
+        return model, trainer
+
+    source, source_trainer = trial(config)
+    throughput = time_training_steps(source, source_trainer.optimizers[0], batch_size=batch_size, num_steps=num_steps, warmup=0)
+    target, target_trainer = trial(config)
+    perturbed = {**config, "lr": config["lr"] * 1.2, "momentum": 0.8, "init_decay": 0.99}
+
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    torch.save(trial_state_dict(source_trainer, source), buffer)
+    save_time = time.perf_counter() - start
+    start = time.perf_counter()
+    buffer.seek(0)
+    load_trial_state(target_trainer, target, torch.load(buffer), perturbed)
+    load_time = time.perf_counter() - start
+
+    epoch_time = epoch_images / throughput
+    exact = all(torch.equal(p, target_p) for p, target_p in zip(source.parameters(), target.parameters()))
+    print(f"trial state {buffer.getbuffer().nbytes / 2**20:.2f} MiB, save {save_time * 1000:.1f} ms, "
+          f"load {load_time * 1000:.1f} ms, {(save_time + load_time) / epoch_time:.2%} of an epoch ({epoch_time:.1f} s), "
+          f"weights cloned exactly: {exact}")
+
+def benchmark_memory_budget(batch_size=64, num_steps=10):
+    '''
+    Memory report and training throughput of Dropback with the default strategy, with
+    chunked scoring and with half precision initial weights, picked through memory_budget.
+    '''
+    config = {
+        "lr": 0.1, "momentum": 0.9, "weight_decay": 4e-5, "track_size": 111835, "init_decay": 0.995,
+        "q": None, "q_init": 1e-2, "q_step": 1e-6, "sf": False,
+    }
+    model = DBModel(config=config)
+    optimizers, _ = model.configure_optimizers()
+    time_training_steps(model, optimizers[0], batch_size=batch_size, num_steps=1, warmup=0)
+    report = optimizers[0].memory_report()
+    total = report["persistent_total"] + report["transient_peak"]
+
+    # budgets just below what the previous strategy needs
+    for name, memory_budget in (("default", None), ("chunked scoring", total - 1), ("half init_params", total - report["transient"]["scores"] // 2 - 1)):
+        torch.manual_seed(0)
+        model = DBModel(config={**config, "memory_budget": memory_budget})
+        optimizers, _ = model.configure_optimizers()
+        throughput = time_training_steps(model, optimizers[0], batch_size=batch_size, num_steps=num_steps, warmup=1)
+        report = optimizers[0].memory_report()
+        print(f"{name:17s}: persistent {report['persistent_total'] / 2**20:6.1f} MiB "
+              f"(init_params {report['persistent']['init_params'] / 2**20:5.1f} MiB), "
+              f"step temporaries {report['transient_peak'] / 2**20:5.1f} MiB, {throughput:7.1f} img/s, {report['strategy']}")
+
+
+def benchmark_effective_batch_size(batch_size=32, accumulations=(1, 2, 4, 8), rank_every=(1, 4), num_steps=5):
+    '''
+    CPU training throughput of Dropback against the effective batch size (micro-batches of
+    batch_size accumulated before every optimizer step), with the ranking run every step
+    and only every few steps.
+    '''
+    config = {
+        "lr": 0.1, "momentum": 0.9, "weight_decay": 4e-5, "track_size": 111835, "init_decay": 0.995,
+        "q": None, "q_init": 1e-2, "q_step": 1e-6, "sf": False,
+    }
+    print(f"{'effective batch':>15s} " + " ".join(f"{f'rank_every={n}':>14s}" for n in rank_every))
+    for accumulate_grad_batches in accumulations:
+        throughputs = []
+        for n in rank_every:
+            torch.manual_seed(0)
+            model = DBModel(config={**config, "rank_every": n})
+            optimizers, _ = model.configure_optimizers()
+            throughputs.append(time_training_steps(model, optimizers[0], batch_size=batch_size, num_steps=num_steps * n,
+                                                   warmup=1, accumulate_grad_batches=accumulate_grad_batches))
+        print(f"{batch_size * accumulate_grad_batches:15d} " + " ".join(f"{throughput:9.1f} img/s" for throughput in throughputs))
+
+
+def benchmark_chunked_selection(chunk_sizes=(None, 2**20, 2**16), batch_size=64, num_steps=5):
+    '''
+    Step temporaries and throughput of Dropback with the whole model top-k and with the
+    chunked selection, and whether the chunked runs end with the same weights.
+    '''
+    config = {
+        "lr": 0.1, "momentum": 0.9, "weight_decay": 4e-5, "track_size": 111835, "init_decay": 0.995,
+        "q": None, "q_init": 1e-2, "q_step": 1e-6, "sf": False,
+    }
+    reference = None
+    for selection_chunk_size in chunk_sizes:
+        torch.manual_seed(0)
+        model = DBModel(config={**config, "selection_chunk_size": selection_chunk_size})
+        optimizers, _ = model.configure_optimizers()
+        torch.manual_seed(1)
+        throughput = time_training_steps(model, optimizers[0], batch_size=batch_size, num_steps=num_steps, warmup=1)
+        report = optimizers[0].memory_report()
+        weights = [p.detach().clone() for p in model.parameters()]
+        if reference is None:
+            reference = weights
+        same = all(torch.equal(p, q) for p, q in zip(weights, reference))
+        print(f"selection_chunk_size {str(selection_chunk_size):8s}: step temporaries {report['transient_peak'] / 2**20:6.2f} MiB "
+              f"(scores {report['transient']['scores'] / 2**20:6.2f}, mask {report['transient']['mask'] / 2**20:6.2f}, "
+              f"selection {report['transient']['selection'] / 2**20:6.2f}), {throughput:7.1f} img/s, same weights: {same}")
+
+
+def benchmark_mask_statistics(num_records=20, batch_size=64):
+    '''
+    Memory and time of the intersection count of two masks as bool tensors and packed, and
+    the cost of recording the tracked set of MobileNetV2 Dropback with MaskStatistics.
+    '''
+    config = {
+        "lr": 0.1, "momentum": 0.9, "weight_decay": 4e-5, "track_size": 111835, "init_decay": 0.995,
+        "q": None, "q_init": 1e-2, "q_step": 1e-6, "sf": False,
+    }
+    model = DBModel(config=config)
+    optimizers, _ = model.configure_optimizers()
+    statistics = MaskStatistics()
+
+    record_time = 0.
+    for _ in range(num_records):
+        time_training_steps(model, optimizers[0], batch_size=batch_size, num_steps=1, warmup=0)
+        start = time.perf_counter()
+        masks = dropback_masks(model, optimizers[0])
+        row = statistics.add(len(statistics.steps), masks)
+        record_time += time.perf_counter() - start
+    statistics.finalize()
+
+    bool_masks = [mask.to_bool() for mask in masks.values()]
+    previous = [mask.to_bool() for mask in statistics.history[-2].values()]
+    start = time.perf_counter()
+    bool_count = sum(int((a & b).sum()) for a, b in zip(bool_masks, previous))
+    bool_time = time.perf_counter() - start
+    start = time.perf_counter()
+    packed_count = sum((a & b).count() for a, b in zip(masks.values(), statistics.history[-2].values()))
+    packed_time = time.perf_counter() - start
+    assert bool_count == packed_count
+
+    print(f"intersection count: bool {sum(m.numel() for m in bool_masks) / 2**20:5.2f} MiB {bool_time * 1000:6.2f} ms, "
+          f"packed {sum(m.nbytes for m in masks.values()) / 2**20:5.2f} MiB {packed_time * 1000:6.2f} ms")
+    print(f"recording the tracked set: {record_time / num_records * 1000:.1f} ms per record, last jaccard {row['jaccard']:.4f}, "
+          f"entry rate {row['entry_rate']:.4f}, jaccard with the final set {statistics.final_jaccard[0]:.4f} at the first record")
+
+
+def benchmark_multi_sparsity(track_sizes=(55917, 22367), batch_size=64, num_steps=10):
+    '''
+    Training throughput of Dropback with and without nested track_sizes levels, the time to
+    swap in the shadow weights of a level and the sparsity of every level.
+    '''
+    config = {
+        "lr": 0.1, "momentum": 0.9, "weight_decay": 4e-5, "track_size": 111835, "init_decay": 0.995,
+        "q": None, "q_init": 1e-2, "q_step": 1e-6, "sf": False,
+    }
+    for levels in ((), track_sizes):
+        torch.manual_seed(0)
+        model = DBModel(config={**config, "track_sizes": list(levels)})
+        optimizers, _ = model.configure_optimizers()
+        throughput = time_training_steps(model, optimizers[0], batch_size=batch_size, num_steps=num_steps, warmup=1)
+        print(f"track_sizes {str(list(levels)):16s}: {throughput:7.1f} img/s")
+
+    for k in track_sizes:
+        start = time.perf_counter()
+        with optimizers[0].shadow_weights(k):
+            swap_time = time.perf_counter() - start
+            _, _, sparsity = measure_global_sparsity(model.model, threshold=0, weight=True, bias=True, use_mask=False)
+        print(f"level {k}: shadow weights in {swap_time * 1000:.1f} ms, sparsity {sparsity:.4f}")
+
+
+def _resident_anonymous_bytes():
+    '''RssAnon of this process (Linux): resident memory that is not backed by a file.'''
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("RssAnon:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def _init_offload_run(arch, config, batch_size, num_steps, results):
+    torch.manual_seed(0)
+    model = DBModel(arch=arch, config=config)
+    optimizers, _ = model.configure_optimizers()
+    throughput = time_training_steps(model, optimizers[0], batch_size=batch_size, num_steps=num_steps, warmup=1)
+    results.put((_resident_anonymous_bytes(), throughput, optimizers[0].memory_report()["persistent"]))
+
+def benchmark_init_offload(arch="resnet50", track_size=2500000, batch_size=16, num_steps=5):
+    '''
+    Resident memory and throughput on the cpu with the initial weights next to the model and
+    in a memory-mapped file (init_offload_dir). Every run gets its own process, so the
+    resident memory of one does not carry over to the next.
+    '''
+    config = {
+        "lr": 0.1, "momentum": 0.9, "weight_decay": 4e-5, "track_size": track_size, "init_decay": 0.995,
+        "q": None, "q_init": 1e-2, "q_step": 1e-6, "sf": False,
+    }
+    context = torch.multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, init_offload_dir in (("resident", None), ("offloaded", directory)):
+            results = context.Queue()
+            process = context.Process(target=_init_offload_run, args=(
+                arch, {**config, "init_offload_dir": init_offload_dir}, batch_size, num_steps, results))
+            process.start()
+            rss_anon, throughput, persistent = results.get()
+            process.join()
+            print(f"{arch} {name:9s}: resident (anonymous) {rss_anon / 2**20:7.1f} MiB, "
+                  f"init_params on the device {persistent['init_params'] / 2**20:6.1f} MiB, {throughput:6.1f} img/s")
+
+
+def benchmark_results_store(num_trials=80, num_epochs=450, num_metrics=10):
+    '''
+    Time to append the metrics of a synthetic sweep to a results store epoch by epoch, as
+    ResultsStore does, and the time of best-of and learning-curve queries over the sweep.
+    '''
+    generator = torch.Generator().manual_seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        connection = connect(os.path.join(directory, "results.sqlite"))
+        start = time.perf_counter()
+        for trial in range(num_trials):
+            lr = 0.05 + 0.25 * torch.rand(1, generator=generator).item()
+            add_trial(connection, f"trial_{trial}", {"lr": lr, "momentum": 0.9, "track_size": 111835}, "sweep")
+            noise = torch.rand(num_epochs, num_metrics, generator=generator).tolist()
+            for epoch in range(num_epochs):
+                metrics = {f"metric_{i}": noise[epoch][i] for i in range(1, num_metrics)}
+                metrics["ptl/val_accuracy_top1"] = epoch / num_epochs * lr + 0.1 * noise[epoch][0]
+                add_metrics(connection, f"trial_{trial}", epoch, metrics, step=epoch * 100)
+        write_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        best = best_of(connection, "ptl/val_accuracy_top1", mode="max", top=5, experiment="sweep")
+        best_time = time.perf_counter() - start
+        start = time.perf_counter()
+        best_early = best_of(connection, "ptl/val_accuracy_top1", mode="max", top=5, max_epoch=60, where={"lr": (0.1, 0.2)})
+        filtered_time = time.perf_counter() - start
+        start = time.perf_counter()
+        curves = learning_curves(connection, "ptl/val_accuracy_top1", experiment="sweep")
+        curves_time = time.perf_counter() - start
+        connection.close()
+
+    print(f"{num_trials} trials x {num_epochs} epochs x {num_metrics} metrics: {write_time / (num_trials * num_epochs) * 1000:.2f} ms per epoch written")
+    print(f"best of: {best_time * 1000:.1f} ms ({best[0][0]}), best of up to epoch 60 with 0.1 <= lr <= 0.2: {filtered_time * 1000:.1f} ms "
+          f"({best_early[0][0] if best_early else None}), all learning curves: {curves_time * 1000:.1f} ms ({len(curves)} trials)")
+
+
+def benchmark_quantized_export(batch_size=64, num_steps=5, num_batches=4):
+    '''
+    Accuracy, size, weight sparsity and cpu latency of the fp32 dense, fp32 sparse and int8
+    sparse exports of a MobileNetV2 Dropback model, the int8/fp32 top-1 agreement and a round
+    trip through quantized_state_dict. Random data, so only the agreement says something
+    about the accuracy.
+    '''
+    config = {
+        "lr": 0.1, "momentum": 0.9, "weight_decay": 4e-5, "track_size": 111835, "init_decay": 0.995,
+        "q": None, "q_init": 1e-2, "q_step": 1e-6, "sf": False,
+    }
+    torch.manual_seed(0)
+    model = DBModel(config=config)
+    optimizers, _ = model.configure_optimizers()
+    time_training_steps(model, optimizers[0], batch_size=batch_size, num_steps=num_steps, warmup=0)
+    # after ~4600 steps with init_decay 0.995 decay_rate drops to 0 and the untracked weights are exactly zero
+    for group in optimizers[0].param_groups:
+        group['decay_rate'] = 1e-10
+    time_training_steps(model, optimizers[0], batch_size=batch_size, num_steps=1, warmup=0)
+
+    data = [(torch.randn(batch_size, 3, 32, 32), torch.randint(0, 10, (batch_size,))) for _ in range(num_batches)]
+    rows, quantized_model = compare_exports(model.model, data, data)
+    print_comparison(rows)
+
+    restored = load_quantized_state_dict(DBModel(config=config).model, quantized_state_dict(quantized_model))
+    x = data[0][0]
+    with torch.no_grad():
+        same = torch.equal(quantized_model(x), restored(x))
+        agreement = (quantized_model(x).argmax(1) == model.model.eval()(x).argmax(1)).float().mean().item()
+    print(f"round trip identical: {same}, int8/fp32 top-1 agreement {agreement:.3f}")
+
+
+def benchmark_effective_macs(amount=0.9, fraction=0.25):
+    '''
+    Effective MACs of MobileNetV2 under the execution models of effective_macs, for 90%
+    global unstructured pruning and for all but a quarter of the hidden channels zeroed,
+    next to the MACs of the structured export, and the time effective_macs takes per epoch.
+    '''
+    torch.manual_seed(0)
+    dense_model = ExperimentModel().model.eval()
+
+    pruned_model = copy.deepcopy(dense_model)
+    parameters_to_prune = [(module, "weight") for module in pruned_model.modules() if isinstance(module, (torch.nn.Conv2d, torch.nn.Linear))]
+    prune.global_unstructured(parameters_to_prune, pruning_method=prune.L1Unstructured, amount=amount)
+
+    channel_model = copy.deepcopy(dense_model)
+    with torch.no_grad():
+        for channel_group in mobilenet_v2_channel_groups(channel_model):
+            num_channels = channel_group[0][0].size(0)
+            dead = torch.randperm(num_channels)[:num_channels - max(1, round(fraction * num_channels))]
+            for param, dim in channel_group:
+                param.index_fill_(dim, dead, 0)
+
+    for name, model in (("dense", dense_model), (f"pruned {amount}", pruned_model), (f"channels {fraction}", channel_model)):
+        start = time.perf_counter()
+        macs = effective_macs(model)
+        elapsed = time.perf_counter() - start
+        exported = count_macs(export_structured_mobilenet_v2(model)) if name.startswith("channels") else None
+        print(f"{name:14s}: dense {macs['dense'] / 1e6:6.1f} M, unstructured {macs['unstructured'] / macs['dense']:5.3f}x, "
+              f"channel {macs['channel'] / macs['dense']:5.3f}x"
+              + (f" (exported {exported / macs['dense']:5.3f}x)" if exported else "") + f", computed in {elapsed * 1000:.1f} ms")
+
+
+class _RandomImages(Dataset):
+    '''CIFAR sized images through the training augmentation of the datamodules, so the loader workers have real work.'''
+
+    def __init__(self, num_images=4096, num_classes=10):
+        self.images = torch.randint(0, 256, (num_images, 32, 32, 3), dtype=torch.uint8).numpy()
+        self.labels = torch.randint(0, num_classes, (num_images,))
+        self.transform = torchvision.transforms.Compose([
+            torchvision.transforms.ToPILImage(),
+            torchvision.transforms.RandomCrop(32, padding=4),
+            torchvision.transforms.RandomHorizontalFlip(),
+            torchvision.transforms.ToTensor(),
+        ])
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return self.transform(self.images[index]), self.labels[index]
+
+def _packing_trial(pin, cores_per_trial, batch_size, num_steps, warmup, results):
+    pinned = pin_trial(cores_per_trial) if pin else None
+    loader = DataLoader(_RandomImages(), batch_size=batch_size, shuffle=True, drop_last=True,
+                        num_workers=pinned.num_workers if pinned else 8, worker_init_fn=pinned.worker_init_fn if pinned else None)
+    torch.manual_seed(0)
+    model = ExperimentModel().model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+
+    step = 0
+    while step < warmup + num_steps:
+        for x, y in loader:
+            if step == warmup:
+                start = time.perf_counter()
+            optimizer.zero_grad()
+            F.cross_entropy(model(x), y).backward()
+            optimizer.step()
+            step += 1
+            if step == warmup + num_steps:
+                break
+    results.put(num_steps * batch_size / (time.perf_counter() - start))
+
+def benchmark_trial_packing(cores_per_trial=4, batch_size=64, num_steps=30, warmup=3):
+    '''
+    Throughput of a cpu-only sweep with as many concurrent trials as there are slots of
+    cores_per_trial cores (what Ray Tune runs with resources_per_trial={"cpu": cores_per_trial}),
+    every trial training MobileNetV2 on augmented random images. Default: every trial with
+    PyTorch's default thread count and 8 loader workers. Packed: pin_trial, so every trial
+    on its own cores. Run it on an otherwise idle node, the slots are shared with real sweeps.
+    '''
+    num_trials = max(1, len(core_slots(cores_per_trial)))
+    context = torch.multiprocessing.get_context("spawn")
+    for name, pin in (("default", False), ("packed", True)):
+        results = context.Queue()
+        processes = [context.Process(target=_packing_trial, args=(pin, cores_per_trial, batch_size, num_steps, warmup, results))
+                     for _ in range(num_trials)]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        throughputs = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - start
+        print(f"{name:8s}: {num_trials} trials of {cores_per_trial} cores, sweep {sum(throughputs):7.1f} img/s "
+              f"(per trial {min(throughputs):6.1f} to {max(throughputs):6.1f}), {elapsed:6.1f}s until all finished")
+
+
+def main():
+    benchmark_fast_path()
+    # benchmark_structured_dropback()
+    # benchmark_sparse_checkpoint()
+    # benchmark_fused_masks()
+    # benchmark_pruned_checkpoint_loader()
+    # benchmark_vectorized_trials()
+    # benchmark_trial_clone()
+    # benchmark_memory_budget()
+    # benchmark_effective_batch_size()
+    # benchmark_init_offload()
+    # benchmark_chunked_selection()
+    # benchmark_mask_statistics()
+    # benchmark_multi_sparsity()
+    # benchmark_results_store()
+    # benchmark_quantized_export()
+    # benchmark_effective_macs()
+    # benchmark_trial_packing()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,402 @@
+import inspect
+import os
+
+import torch
+import torch.nn as nn
+import torch.nn.utils.prune as prune
+
+from pytorch_lightning.callbacks import Callback
+from pytorch_lightning.utilities import rank_zero_info
+
+from models import DBModel
+from utils import is_sanity_checking, pack_mask, unpack_mask
+
+SPARSE_CHECKPOINT_FORMAT = "dropback-sparse-v1"
+INIT_PARAMS_FILE_NAME = "init_params.pt"
+
+
+def untracked_values(group, init_p):
+    '''
+    The value Dropback_qe leaves an untracked weight at after a step, computed the same
+    way on save and load so the comparison against it is exact.
+    '''
+    # initial weights kept in half precision by a memory budget are used in full precision
+    if init_p.element_size() < 4:
+        init_p = init_p.float()
+    values = group['decay_rate'] * init_p
+    if group.get('proper_decay', False) and group['init_decay'] < 1:
+        values = values + (group['init_decay'] - 1) * (group['decay_rate'] * init_p)
+
+    return values
+
+def init_fingerprint(init_params):
+    '''Cheap check that a reference file holds the initial weights a checkpoint was saved against.'''
+    return sum(init_p.double().sum().item() for init_p in init_params.values())
+
+def _param_names(model, optimizer):
+    names = {id(p): name for name, p in model.named_parameters()}
+    return [[names[id(p)] for p in group['params']] for group in optimizer.param_groups]
+
+def named_init_params(model, optimizer):
+    '''Initial weights held by the optimizer, keyed by parameter name, on the cpu.'''
+    init_params = {}
+    for group, names in zip(optimizer.param_groups, _param_names(model, optimizer)):
+        for name, init_p in zip(names, group['init_params']):
+            init_params[name] = init_p.detach().cpu().clone()
+
+    return init_params
+
+def dropback_state_dict(model, optimizer, init_seed=None, init_path=None, sparse_momentum=False, with_momentum=True,
+                        init_params=None, fingerprint=None):
+    '''
+    Compact state of a Dropback model and optimizer. Every parameter is stored as a packed
+    bitset of the weights that differ from their untracked value and the values of those
+    weights. The initial weights are not stored, only the seed the model was built with
+    (init_seed) or a reference file written by save_init_params (init_path).
+
+    sparse_momentum: only keep the momentum of tracked weights. This makes the checkpoint
+        much smaller but the momentum of the untracked weights restarts from zero.
+    with_momentum: set to False to only snapshot the weights
+    init_params, fingerprint: named_init_params and its init_fingerprint, when the caller
+        already holds them (snapshots every epoch), instead of copying the initial weights
+    '''
+    init_params = named_init_params(model, optimizer) if init_params is None else init_params
+    param_names = _param_names(model, optimizer)
+
+    params = {}
+    momentum = {}
+    for group_index, (group, names) in enumerate(zip(optimizer.param_groups, param_names)):
+        for p, name in zip(group['params'], names):
+            p_cpu = p.detach().cpu()
+            mask = p_cpu != untracked_values(group, init_params[name])
+            params[name] = {"group": group_index, "mask": pack_mask(mask), "values": p_cpu[mask].clone()}
+
+            momentum_buffer = optimizer.state[p].get('momentum_buffer')
+            if momentum_buffer is None or not with_momentum:
+                continue
+            if sparse_momentum:
+                momentum[name] = {"mask": params[name]["mask"], "values": momentum_buffer.detach().cpu()[mask].clone()}
+            else:
+                momentum[name] = momentum_buffer.detach().cpu().clone()
+
+    parameter_names = set(name for name, _ in model.named_parameters())
+    buffers = {name: value.detach().cpu().clone() for name, value in model.state_dict().items() if name not in parameter_names}
+
+    param_groups = [{k: v for k, v in group.items() if k not in ('params', 'init_params')} for group in optimizer.param_groups]
+
+    return {
+        "format": SPARSE_CHECKPOINT_FORMAT,
+        "hyper_parameters": dict(model.hparams),
+        "params": params,
+        "momentum": momentum,
+        "sparse_momentum": sparse_momentum,
+        "buffers": buffers,
+        "param_groups": param_groups,
+        "init": {
+            "seed": init_seed,
+            "path": init_path,
+            "fingerprint": init_fingerprint(init_params) if fingerprint is None else fingerprint,
+        },
+    }
+
+def save_init_params(model, optimizer, path):
+    '''Write the initial weights of the optimizer once, to be referenced by sparse checkpoints.'''
+    torch.save(named_init_params(model, optimizer), path)
+
+def save_sparse_checkpoint(model, optimizer, path, init_seed=None, init_path=None, sparse_momentum=False, **extra):
+    '''
+    Save dropback_state_dict to path. init_path is stored relative to the checkpoint.
+    Extra entries (epoch, global_step, lr_schedulers, ...) are stored as they are.
+    '''
+    if init_seed is None and init_path is None:
+        raise ValueError("Either init_seed or init_path is required to rebuild the initial weights.")
+
+    if init_path is not None:
+        init_path = os.path.relpath(init_path, os.path.dirname(os.path.abspath(path)))
+    checkpoint = dropback_state_dict(model, optimizer, init_seed=init_seed, init_path=init_path, sparse_momentum=sparse_momentum)
+    checkpoint.update(extra)
+    torch.save(checkpoint, path)
+
+def load_dropback_weights(model, checkpoint, init_params):
+    '''
+    Restore the weights and buffers of a dropback_state_dict into a model, given the
+    initial weights keyed by parameter name. No optimizer is needed.
+    '''
+    if init_fingerprint(init_params) != checkpoint["init"]["fingerprint"]:
+        raise RuntimeError("The initial weights do not match the ones the checkpoint was saved against.")
+
+    with torch.no_grad():
+        for name, p in model.named_parameters():
+            saved = checkpoint["params"][name]
+            mask = unpack_mask(saved["mask"], p.shape)
+            values = untracked_values(checkpoint["param_groups"][saved["group"]], init_params[name])
+            values[mask] = saved["values"].to(values.dtype)
+            p.copy_(values)
+
+        for name, buffer in model.named_buffers():
+            if name in checkpoint["buffers"]:
+                buffer.copy_(checkpoint["buffers"][name])
+
+def load_dropback_state_dict(model, optimizer, checkpoint, init_params=None):
+    '''
+    Restore a state from dropback_state_dict into a model and its freshly created Dropback
+    optimizer whose init_params already hold the initial weights.
+    '''
+    if init_params is None:
+        init_params = named_init_params(model, optimizer)
+
+    for group, saved_group in zip(optimizer.param_groups, checkpoint["param_groups"]):
+        group.update(saved_group)
+    load_dropback_weights(model, checkpoint, init_params)
+
+    with torch.no_grad():
+        for group, names in zip(optimizer.param_groups, _param_names(model, optimizer)):
+            for p, name in zip(group['params'], names):
+                if name not in checkpoint["momentum"]:
+                    optimizer.state[p].pop('momentum_buffer', None)
+                    continue
+                saved_momentum = checkpoint["momentum"][name]
+                if checkpoint["sparse_momentum"]:
+                    momentum_buffer = torch.zeros(p.shape, dtype=p.dtype)
+                    momentum_buffer[unpack_mask(saved_momentum["mask"], p.shape)] = saved_momentum["values"]
+                else:
+                    momentum_buffer = saved_momentum
+                optimizer.state[p]['momentum_buffer'] = momentum_buffer.to(p.device).clone()
+
+def load_sparse_checkpoint(checkpoint_path, model_cls=DBModel, **kwargs):
+    '''
+    Rebuild a Dropback model, its optimizer and lr scheduler from a sparse checkpoint.
+    kwargs overwrite the saved hyperparameters of the model.
+    Returns the model, the optimizer, the scheduler and the loaded checkpoint dict.
+    '''
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    if checkpoint.get("format") != SPARSE_CHECKPOINT_FORMAT:
+        raise ValueError(f"{checkpoint_path} is not a sparse Dropback checkpoint.")
+
+    hyper_parameters = dict(checkpoint["hyper_parameters"])
+    hyper_parameters.update(kwargs)
+
+    init = checkpoint["init"]
+    if init["path"] is not None:
+        model = model_cls(**hyper_parameters)
+        init_path = os.path.join(os.path.dirname(os.path.abspath(checkpoint_path)), init["path"])
+        init_params = torch.load(init_path, map_location="cpu")
+        with torch.no_grad():
+            for name, p in model.named_parameters():
+                p.copy_(init_params[name])
+    else:
+        # seeded in a fork of the RNG, the state of the caller is left alone
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(init["seed"])
+            model = model_cls(**hyper_parameters)
+        init_params = None
+
+    optimizers, schedulers = model.configure_optimizers()
+    optimizer, scheduler = optimizers[0], schedulers[0]
+    load_dropback_state_dict(model, optimizer, checkpoint, init_params=init_params)
+    if "lr_schedulers" in checkpoint:
+        scheduler.load_state_dict(checkpoint["lr_schedulers"][0])
+
+    rank_zero_info(f"Sparse checkpoint {checkpoint_path} loaded.")
+    return model, optimizer, scheduler, checkpoint
+
+def load_source_state(checkpoint_path, model, with_momentum=False):
+    '''
+    Everything needed to continue Dropback from a source run, keyed by parameter name of
+    model (a DBModel of the same architecture, possibly with another number of classes):
+    weights, init_params, momentum (with_momentum) and the decay state of the source
+    (decay_rate, first_iter). Reads Lightning checkpoints and sparse checkpoints.
+    Tensors whose shape differs from the model, like a resized classifier, are left out.
+    '''
+    checkpoint = _load_mmap(checkpoint_path)
+    shapes = {name: p.shape for name, p in model.named_parameters()}
+    names = list(shapes)
+
+    if checkpoint.get("format") == SPARSE_CHECKPOINT_FORMAT:
+        init = checkpoint["init"]
+        if init["path"] is not None:
+            init_params = torch.load(os.path.join(os.path.dirname(os.path.abspath(checkpoint_path)), init["path"]), map_location="cpu")
+        else:
+            # the source model is rebuilt from its seed only to recover its initial weights, in a
+            # fork of the RNG so the trials warm started from it keep their own random streams
+            hyper_parameters = {key: value for key, value in checkpoint["hyper_parameters"].items() if key != "source_checkpoint"}
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(init["seed"])
+                source = type(model)(**hyper_parameters)
+            init_params = {name: p.detach().clone() for name, p in source.named_parameters()}
+
+        weights = {}
+        momentum = {}
+        for name, saved in checkpoint["params"].items():
+            group = checkpoint["param_groups"][saved["group"]]
+            weights[name] = untracked_values(group, init_params[name])
+            weights[name][unpack_mask(saved["mask"], init_params[name].shape)] = saved["values"].to(weights[name].dtype)
+        if with_momentum:
+            for name, saved in checkpoint["momentum"].items():
+                if checkpoint["sparse_momentum"]:
+                    momentum[name] = torch.zeros(init_params[name].shape)
+                    momentum[name][unpack_mask(saved["mask"], init_params[name].shape)] = saved["values"]
+                else:
+                    momentum[name] = saved
+        buffers = checkpoint["buffers"]
+        source_group = checkpoint["param_groups"][0]
+    else:
+        state_dict = checkpoint["state_dict"]
+        source_group = checkpoint["optimizer_states"][0]["param_groups"][0]
+        optimizer_state = checkpoint["optimizer_states"][0]["state"]
+        # Lightning saves the optimizer parameters in the order of model.parameters()
+        init_params = {names[i]: init_p for i, init_p in enumerate(source_group["init_params"])}
+        weights = {name: state_dict[name] for name in names if name in state_dict}
+        momentum = {}
+        if with_momentum:
+            for i, index in enumerate(source_group["params"]):
+                if "momentum_buffer" in optimizer_state.get(index, {}):
+                    momentum[names[i]] = optimizer_state[index]["momentum_buffer"]
+        buffers = {name: value for name, value in state_dict.items() if name not in shapes}
+
+    def matching(tensors):
+        return {name: tensor for name, tensor in tensors.items() if name in shapes and tensor.shape == shapes[name]}
+
+    return {
+        "weights": matching(weights),
+        "init_params": matching(init_params),
+        "momentum": matching(momentum),
+        "buffers": buffers,
+        "group_state": {key: source_group[key] for key in ("decay_rate", "first_iter") if key in source_group},
+    }
+
+def _load_mmap(checkpoint_path):
+    '''torch.load memory-mapping the tensors when the installed PyTorch supports it.'''
+    if "mmap" in inspect.signature(torch.load).parameters:
+        return torch.load(checkpoint_path, map_location="cpu", mmap=True)
+    return torch.load(checkpoint_path, map_location="cpu")
+
+def _check_tensor(key, current, tensor):
+    # load_state_dict would refuse these, putting the tensor in place must do so too
+    if current is None:
+        return
+    if tensor.shape != current.shape:
+        raise RuntimeError(f"size mismatch for {key}: copying a param with shape {tuple(tensor.shape)} from checkpoint, "
+                           f"the shape in current model is {tuple(current.shape)}.")
+    if tensor.dtype != current.dtype:
+        raise RuntimeError(f"dtype mismatch for {key}: copying a param with dtype {tensor.dtype} from checkpoint, "
+                           f"the dtype in current model is {current.dtype}.")
+
+def _assign(module, name, tensor, key=None):
+    # put the loaded tensor in place instead of copying it into the freshly initialized one
+    _check_tensor(key or name, module._parameters[name] if name in module._parameters else module._buffers.get(name), tensor)
+    if name in module._parameters:
+        requires_grad = module._parameters[name].requires_grad
+        module._parameters[name] = nn.Parameter(tensor, requires_grad=requires_grad)
+    else:
+        module._buffers[name] = tensor
+
+def _attach_mask(module, name, orig, mask, key=None):
+    '''What torch.nn.utils.prune.custom_from_mask does, without allocating a default mask.'''
+    _check_tensor(key or name, module._parameters[name], orig)
+    if mask.shape != orig.shape:
+        raise RuntimeError(f"size mismatch for {key or name}_mask: mask of shape {tuple(mask.shape)} for a weight "
+                           f"of shape {tuple(orig.shape)}.")
+    requires_grad = module._parameters[name].requires_grad
+    method = prune.CustomFromMask(mask)
+    method._tensor_name = name
+    del module._parameters[name]
+    module.register_parameter(name + "_orig", nn.Parameter(orig, requires_grad=requires_grad))
+    module.register_buffer(name + "_mask", mask)
+    setattr(module, name, method.apply_mask(module))
+    module.register_forward_pre_hook(method)
+
+def load_pruned_checkpoint(model, checkpoint_path, make_permanent=False):
+    '''
+    Load a checkpoint written while pruning (with weight_orig/weight_mask entries or, from a
+    PruneModel with fused_masks, masked weights next to their mask) into a freshly created model.
+    The pruning reparametrization is only created for the tensors that have a mask, and the
+    tensors are memory-mapped and put in place instead of being copied when possible.
+
+    make_permanent: load the masked weights as plain parameters without any mask.
+    Models with fused_masks get their masks fused right away.
+    An already loaded checkpoint can be passed instead of the path, its tensors end up in the model.
+    '''
+    checkpoint = _load_mmap(checkpoint_path) if isinstance(checkpoint_path, str) else checkpoint_path
+    state_dict = checkpoint["state_dict"] if "state_dict" in checkpoint else checkpoint
+    modules = dict(model.named_modules())
+    loaded = set()
+
+    for key in state_dict:
+        if not key.endswith("_mask"):
+            continue
+        prefix = key[:-len("_mask")]
+        module_name, name = prefix.rsplit(".", 1)
+        module = modules[module_name]
+        mask = state_dict[key]
+        if prefix + "_orig" in state_dict:
+            orig = state_dict[prefix + "_orig"]
+            loaded.update([key, prefix + "_orig"])
+        else:
+            orig = state_dict[prefix]
+            loaded.update([key, prefix])
+
+        if make_permanent:
+            _assign(module, name, orig.mul_(mask), key=prefix)
+        else:
+            _attach_mask(module, name, orig, mask, key=prefix)
+
+    for key, tensor in state_dict.items():
+        if key in loaded:
+            continue
+        module_name, name = key.rsplit(".", 1)
+        if module_name not in modules or (name not in modules[module_name]._parameters and name not in modules[module_name]._buffers):
+            raise RuntimeError(f"Unexpected key in checkpoint: {key}")
+        _assign(modules[module_name], name, tensor, key=key)
+        loaded.add(key)
+
+    missing = [key for key in model.state_dict() if key not in loaded]
+    if missing:
+        raise RuntimeError(f"Missing keys in checkpoint: {missing}")
+
+    if not make_permanent and getattr(model, "fused_masks", False):
+        model.fuse_pruning_masks()
+
+    return model
+
+
+class SparseCheckpoint(Callback):
+    '''
+    Write sparse Dropback checkpoints instead of full Lightning checkpoints.
+    The initial weights are written once per trial next to the checkpoints.
+    '''
+
+    def __init__(self, dirpath=None, filename="epoch{epoch:02d}", every_n_epochs=1, init_seed=None, sparse_momentum=False):
+        super().__init__()
+        self.dirpath = dirpath
+        self.filename = filename
+        self.every_n_epochs = every_n_epochs
+        self.init_seed = init_seed
+        self.sparse_momentum = sparse_momentum
+
+    def on_validation_end(self, trainer, pl_module):
+        if is_sanity_checking(trainer):
+            return
+        if (trainer.current_epoch + 1) % self.every_n_epochs != 0:
+            return
+
+        dirpath = self.dirpath or os.path.join(trainer.log_dir, "sparse_checkpoints")
+        os.makedirs(dirpath, exist_ok=True)
+        optimizer = trainer.optimizers[0]
+
+        init_path = None
+        if self.init_seed is None:
+            init_path = os.path.join(dirpath, INIT_PARAMS_FILE_NAME)
+            if not os.path.isfile(init_path):
+                save_init_params(pl_module, optimizer, init_path)
+
+        path = os.path.join(dirpath, self.filename.format(epoch=trainer.current_epoch) + ".pt")
+        save_sparse_checkpoint(
+            pl_module, optimizer, path,
+            init_seed=self.init_seed,
+            init_path=init_path,
+            sparse_momentum=self.sparse_momentum,
+            epoch=trainer.current_epoch,
+            global_step=trainer.global_step,
+            lr_schedulers=[config["scheduler"].state_dict() for config in trainer.lr_schedulers],
+        )
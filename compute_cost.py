@@ -0,0 +1,67 @@
+import copy
+
+from pytorch_lightning.callbacks import Callback
+
+from utils import cpu_latency, effective_macs, fold_batchnorm, is_sanity_checking
+from export import export_structured_mobilenet_v2
+
+
+def cost_tune_metrics():
+    '''Entries for the metrics of TuneReportCallback, the effective MACs and the measured cpu latency.'''
+    return {
+        "macs_dense": "cost/macs_dense",
+        "macs_unstructured": "cost/macs_unstructured",
+        "macs_channel": "cost/macs_channel",
+        "cpu_latency_ms": "cost/cpu_latency_ms",
+    }
+
+
+class ComputeCost(Callback):
+    '''
+    Logs what the current sparsity pattern is worth in compute, every validation epoch:
+
+        cost/macs_dense, cost/macs_unstructured, cost/macs_channel
+            MACs per sample under the execution models of utils.effective_macs
+        cost/macs_unstructured_fraction, cost/macs_channel_fraction
+            the same relative to dense
+
+    and every latency_every_n_epochs epochs the measured cpu latency of a copy of the
+    current (masked) model with BatchNorm folded, cost/cpu_latency_ms, plus for MobileNetV2
+    the one of the structured export without its dead hidden channels,
+    cost/cpu_latency_structured_ms. Between measurements the last latency is kept, so Ray
+    Tune sees it with every report (cost_tune_metrics). Logged from on_validation_epoch_end,
+    so it reaches Ray Tune with the validation of the same epoch.
+    '''
+
+    def __init__(self, latency_every_n_epochs=10, batch_size=1, num_threads=1, input_size=(3, 32, 32)):
+        super().__init__()
+        self.latency_every_n_epochs = latency_every_n_epochs
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.input_size = tuple(input_size)
+        self._latency = {}
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        if is_sanity_checking(trainer):
+            return
+
+        model = pl_module.model
+        macs = effective_macs(model, (1,) + self.input_size)
+        for name, value in macs.items():
+            pl_module.log(f"cost/macs_{name}", float(value))
+        pl_module.log("cost/macs_unstructured_fraction", macs["unstructured"] / macs["dense"])
+        pl_module.log("cost/macs_channel_fraction", macs["channel"] / macs["dense"])
+
+        if trainer.current_epoch % self.latency_every_n_epochs == 0 or not self._latency:
+            self._latency = self._measure_latency(pl_module)
+        for name, value in self._latency.items():
+            pl_module.log(name, value)
+
+    def _measure_latency(self, pl_module):
+        input_size = (self.batch_size,) + self.input_size
+        model = fold_batchnorm(copy.deepcopy(pl_module.model).cpu().eval())
+        latency = {"cost/cpu_latency_ms": cpu_latency(model, input_size, num_steps=30, warmup=5, num_threads=self.num_threads) * 1e3}
+        if getattr(pl_module, "arch", None) == "mobilenet_v2":
+            structured = export_structured_mobilenet_v2(copy.deepcopy(pl_module.model).cpu())
+            latency["cost/cpu_latency_structured_ms"] = cpu_latency(structured.eval(), input_size, num_steps=30, warmup=5, num_threads=self.num_threads) * 1e3
+        return latency
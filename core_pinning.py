@@ -0,0 +1,172 @@
+import ctypes
+import fcntl
+import functools
+import glob
+import os
+import tempfile
+
+import torch
+
+from pytorch_lightning.utilities import rank_zero_info, rank_zero_warn
+
+# Trials pinned with the same cores_per_trial claim their slot with a lock file in here
+LOCK_DIR = os.path.join(tempfile.gettempdir(), f"core_slots_{os.getuid()}")
+
+# Slot claimed by this process, kept as long as the process lives (Ray Tune reuses it for the next trials)
+_pinned = {}
+
+
+def _parse_cpulist(cpulist):
+    '''"0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11]'''
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus += range(int(first), int(last or first) + 1)
+    return cpus
+
+def _core_of(cpu):
+    # hyperthreads of one physical core share its first sibling
+    path = f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list"
+    if not os.path.exists(path):
+        return cpu
+    with open(path) as f:
+        return min(_parse_cpulist(f.read()))
+
+def numa_nodes():
+    '''
+    {NUMA node: cpus this process may run on}, the hyperthreads of a physical core next to
+    each other. {None: cpus} when the topology is not known.
+    '''
+    available = os.sched_getaffinity(0)
+    nodes = {}
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        with open(path) as f:
+            cpus = [cpu for cpu in _parse_cpulist(f.read()) if cpu in available]
+        if cpus:
+            nodes[int(os.path.basename(os.path.dirname(path))[len("node"):])] = sorted(cpus, key=lambda cpu: (_core_of(cpu), cpu))
+    return nodes or {None: sorted(available, key=lambda cpu: (_core_of(cpu), cpu))}
+
+def core_slots(cores_per_trial):
+    '''
+    Disjoint sets of cores_per_trial cpus, [(node, cpus)]. A set never spans two NUMA nodes
+    and takes whole physical cores where the count allows, left over cpus of a node are not used.
+    '''
+    slots = []
+    for node, cpus in numa_nodes().items():
+        for start in range(0, len(cpus) - cores_per_trial + 1, cores_per_trial):
+            slots.append((node, cpus[start:start + cores_per_trial]))
+    return slots
+
+def _prefer_numa_node(node):
+    '''
+    Allocate memory on node first (libnuma). Pinned to the cpus of the node, Linux' first
+    touch policy already does so for new pages, this also covers pages of threads that are
+    moved later. False when libnuma is not available.
+    '''
+    if node is None:
+        return False
+    try:
+        libnuma = ctypes.CDLL("libnuma.so.1")
+    except OSError:
+        return False
+    if libnuma.numa_available() < 0:
+        return False
+    libnuma.numa_set_preferred(node)
+    return True
+
+def _pin_worker(cpus, worker_id):
+    '''worker_init_fn of the dataloader workers of a pinned trial.'''
+    os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(1)
+    # Lightning only sets its own seeding worker_init_fn when there is none
+    if os.environ.get("PL_SEED_WORKERS") == "1":
+        from pytorch_lightning.utilities.seed import pl_worker_init_function
+        pl_worker_init_function(worker_id)
+
+
+class PinnedTrial:
+    '''
+    Core set of a trial: compute_cpus for the training process and its intra-op threads,
+    loader_cpus for the dataloader workers (num_workers of them, one per cpu).
+    '''
+
+    def __init__(self, index, node, cpus, loader_cores, lock):
+        self.index = index
+        self.node = node
+        self.cpus = cpus
+        if 0 < loader_cores < len(cpus):
+            self.compute_cpus, self.loader_cpus = cpus[:-loader_cores], cpus[-loader_cores:]
+        else:
+            self.compute_cpus, self.loader_cpus = cpus, cpus
+        self.num_workers = loader_cores
+        self.numa_bound = False
+        self._lock = lock
+
+    @property
+    def worker_init_fn(self):
+        return functools.partial(_pin_worker, self.loader_cpus)
+
+    def apply(self, bind_memory=True):
+        os.sched_setaffinity(0, self.compute_cpus)
+        torch.set_num_threads(len(self.compute_cpus))
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # can only be set before the first inter-op parallel work of the process
+            pass
+        # for processes started by the trial
+        os.environ["OMP_NUM_THREADS"] = os.environ["MKL_NUM_THREADS"] = str(len(self.compute_cpus))
+        if bind_memory:
+            self.numa_bound = _prefer_numa_node(self.node)
+
+
+def pin_trial(cores_per_trial, loader_cores=1, bind_memory=True):
+    '''
+    Claim a free core slot (core_slots) for this process and run the trial on it: the
+    calling thread and the threads it starts from now on are pinned to compute_cpus, the
+    intra-op pool gets one thread per compute cpu and memory is preferably allocated on the
+    NUMA node of the slot. Pass num_workers and worker_init_fn of the returned PinnedTrial
+    to the datamodule, so the dataloader workers run on loader_cpus.
+
+    Call it first thing in every trial function, threads started before keep their affinity.
+    cores_per_trial should be the cpus of resources_per_trial, then Ray Tune never runs more
+    trials on a node than there are slots. A slot stays claimed until the process exits (a
+    lock file in LOCK_DIR), a later trial of the same process gets the same slot applied to
+    its own thread. When no slot is free the trial runs unpinned and None is returned.
+    '''
+    if cores_per_trial in _pinned:
+        # with reuse_actors the next trial of the process runs on a new thread, affinity and
+        # the intra-op thread count are per thread
+        pinned = _pinned[cores_per_trial]
+        pinned.apply(bind_memory)
+        return pinned
+
+    lock_dir = os.path.join(LOCK_DIR, str(cores_per_trial))
+    os.makedirs(lock_dir, exist_ok=True)
+    for index, (node, cpus) in enumerate(core_slots(cores_per_trial)):
+        lock = open(os.path.join(lock_dir, f"slot{index}"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            continue
+        pinned = PinnedTrial(index, node, cpus, loader_cores, lock)
+        pinned.apply(bind_memory)
+        _pinned[cores_per_trial] = pinned
+        rank_zero_info(f"Trial pinned to slot {index}: compute cpus {pinned.compute_cpus}, loader cpus {pinned.loader_cpus}, "
+                       f"NUMA node {node}{' (memory bound)' if pinned.numa_bound else ''}.")
+        return pinned
+
+    rank_zero_warn(f"No free slot of {cores_per_trial} cores, the trial runs unpinned.")
+    return None
+
+
+def main():
+    for cores_per_trial in (2, 4, 8):
+        slots = core_slots(cores_per_trial)
+        print(f"{cores_per_trial} cores per trial: {len(slots)} slots {[cpus for _, cpus in slots]}")
+
+if __name__ == '__main__':
+    main()
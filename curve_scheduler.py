@@ -0,0 +1,283 @@
+import glob
+import math
+import os
+import sys
+import warnings
+from pathlib import Path
+
+import numpy as np
+from scipy.optimize import curve_fit
+
+from ray.tune.schedulers import FIFOScheduler, TrialScheduler
+
+CONTINUE = "CONTINUE"
+STOP = "STOP"
+
+
+def _pow3(t, a, b, c):
+    return a - b * np.power(t, -c)
+
+def _exp3(t, a, b, c):
+    return a - b * np.exp(-c * t)
+
+def _log2(t, a, b):
+    return a + b * np.log(t)
+
+# name: (function, initial guess, bounds)
+CURVE_MODELS = {
+    "pow3": (_pow3, (1., 1., 0.5), ([-np.inf, -np.inf, 0.], [np.inf, np.inf, 5.])),
+    "exp3": (_exp3, (1., 1., 0.01), ([-np.inf, -np.inf, 0.], [np.inf, np.inf, 1.])),
+    "log2": (_log2, (0., 0.1), ([-np.inf, -np.inf], [np.inf, np.inf])),
+}
+
+
+def smooth(values, window=5):
+    '''Trailing running mean, keeps the length.'''
+    values = np.asarray(values, dtype=float)
+    cumsum = np.cumsum(np.insert(values, 0, 0.))
+    counts = np.minimum(np.arange(1, len(values) + 1), window)
+    return (cumsum[1:] - cumsum[np.arange(1, len(values) + 1) - counts]) / counts
+
+def extrapolate(epochs, values, target_epoch, smoothing=5):
+    '''
+    Fit an ensemble of learning-curve models to (epochs, values) and predict the value at
+    target_epoch. The models are weighted by the inverse of their fitting error.
+    Returns the prediction and its uncertainty (spread of the models plus residual noise),
+    or None if no model could be fitted.
+    '''
+    epochs = np.asarray(epochs, dtype=float)
+    values = smooth(values, smoothing)
+
+    predictions = []
+    errors = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for function, p0, bounds in CURVE_MODELS.values():
+            try:
+                popt, _ = curve_fit(function, epochs, values, p0=p0, bounds=bounds, maxfev=2000)
+            except (RuntimeError, ValueError):
+                continue
+            prediction = function(target_epoch, *popt)
+            if not np.isfinite(prediction):
+                continue
+            predictions.append(prediction)
+            errors.append(np.mean((function(epochs, *popt) - values) ** 2))
+
+    if not predictions:
+        return None
+
+    predictions = np.array(predictions)
+    weights = 1 / (np.array(errors) + 1e-12)
+    weights /= weights.sum()
+    mean = float(np.sum(weights * predictions))
+    spread = float(np.sum(weights * (predictions - mean) ** 2))
+    noise = float(np.sum(weights * np.array(errors)))
+
+    return mean, math.sqrt(spread + noise)
+
+
+class LearningCurveRule:
+    '''
+    Stopping rule independent of Ray Tune, shared by LearningCurveScheduler and replay.
+
+    Every eval_every epochs after min_t, the accuracy curve of a trial is extrapolated to
+    max_t. The trial is stopped when the optimistic prediction (mean + confidence * sigma)
+    stays below the incumbent, the best final (or predicted final) accuracy of the other
+    trials, minus margin. When sparsity is reported (Dropback and prune runs), its curve
+    is extrapolated as well and a trial is only compared with trials that end at least as
+    sparse (within sparsity_tolerance), so a sparser trial is never stopped by a denser
+    one. With sparsity_target, trials that confidently end below the target are stopped.
+
+    The multi-step lr schedule makes curves jump at the milestones, which biases every
+    prediction the same way, so trials are still ranked consistently.
+    '''
+
+    def __init__(self, max_t, min_t=20, eval_every=10, confidence=2.0, margin=0.0,
+                 sparsity_target=None, sparsity_tolerance=0.01, smoothing=5):
+        self.max_t = max_t
+        self.min_t = min_t
+        self.eval_every = eval_every
+        self.confidence = confidence
+        self.margin = margin
+        self.sparsity_target = sparsity_target
+        self.sparsity_tolerance = sparsity_tolerance
+        self.smoothing = smoothing
+
+        self.curves = {}
+        self.sparsity_curves = {}
+        self.final = {}
+        self.predicted = {}
+        self.final_sparsity = {}
+        self.predicted_sparsity = {}
+
+    def _sparsity(self, trial_id):
+        if trial_id in self.final_sparsity:
+            return self.final_sparsity[trial_id]
+        return self.predicted_sparsity.get(trial_id)
+
+    def incumbent(self, exclude=None, min_sparsity=None):
+        candidates = []
+        for trial_id in set(self.final) | set(self.predicted):
+            if trial_id == exclude:
+                continue
+            sparsity = self._sparsity(trial_id)
+            if min_sparsity is not None and sparsity is not None and sparsity < min_sparsity - self.sparsity_tolerance:
+                continue
+            candidates.append(self.final.get(trial_id, self.predicted.get(trial_id)))
+        return max(candidates) if candidates else None
+
+    def on_result(self, trial_id, t, accuracy, sparsity=None):
+        self.curves.setdefault(trial_id, []).append((t, accuracy))
+        if sparsity is not None:
+            self.sparsity_curves.setdefault(trial_id, []).append((t, sparsity))
+
+        if t >= self.max_t:
+            self.final[trial_id] = accuracy
+            if sparsity is not None:
+                self.final_sparsity[trial_id] = sparsity
+            return CONTINUE
+        if t < self.min_t or t % self.eval_every != 0:
+            return CONTINUE
+
+        sparsity_fit = None
+        if trial_id in self.sparsity_curves:
+            epochs, values = zip(*self.sparsity_curves[trial_id])
+            sparsity_fit = extrapolate(epochs, values, self.max_t, self.smoothing)
+            if sparsity_fit is not None:
+                self.predicted_sparsity[trial_id] = sparsity_fit[0]
+
+        epochs, values = zip(*self.curves[trial_id])
+        fit = extrapolate(epochs, values, self.max_t, self.smoothing)
+        if fit is None:
+            return CONTINUE
+        mean, sigma = fit
+        self.predicted[trial_id] = mean
+
+        incumbent = self.incumbent(exclude=trial_id, min_sparsity=self._sparsity(trial_id))
+        if incumbent is not None and mean + self.confidence * sigma < incumbent - self.margin:
+            return STOP
+
+        if self.sparsity_target is not None and sparsity_fit is not None:
+            if sparsity_fit[0] + self.confidence * sparsity_fit[1] < self.sparsity_target - self.sparsity_tolerance:
+                return STOP
+
+        return CONTINUE
+
+    def on_complete(self, trial_id):
+        if trial_id not in self.final:
+            # stopped or errored trials do not count as incumbent
+            self.predicted.pop(trial_id, None)
+            self.predicted_sparsity.pop(trial_id, None)
+
+
+class LearningCurveScheduler(FIFOScheduler):
+    '''
+    Ray Tune scheduler that stops trials based on LearningCurveRule.
+    Uses its own metric (higher is better) instead of the one passed to tune.run.
+    '''
+
+    def __init__(self, max_t, metric="mean_accuracy", time_attr="training_iteration", sparsity_attr=None, **kwargs):
+        super().__init__()
+        self._curve_metric = metric
+        self._time_attr = time_attr
+        self._sparsity_attr = sparsity_attr
+        self._rule = LearningCurveRule(max_t, **kwargs)
+        self._num_stopped = 0
+
+    def set_search_properties(self, metric, mode, **spec):
+        return True
+
+    def on_trial_result(self, trial_runner, trial, result):
+        if self._curve_metric not in result or self._time_attr not in result:
+            return TrialScheduler.CONTINUE
+
+        sparsity = result.get(self._sparsity_attr) if self._sparsity_attr else None
+        decision = self._rule.on_result(trial.trial_id, result[self._time_attr], result[self._curve_metric], sparsity)
+        if decision == STOP:
+            self._num_stopped += 1
+            return TrialScheduler.STOP
+        return TrialScheduler.CONTINUE
+
+    def on_trial_complete(self, trial_runner, trial, result):
+        self._rule.on_complete(trial.trial_id)
+
+    def on_trial_remove(self, trial_runner, trial):
+        self._rule.on_complete(trial.trial_id)
+
+    def debug_string(self):
+        return f"LearningCurveScheduler: {self._num_stopped} trials stopped, incumbent {self._rule.incumbent()}."
+
+
+def load_trial_curves(experiment_dir, metric_tag="ptl/val_accuracy_top1", sparsity_tag="sparsity"):
+    '''
+    Read the TensorBoard logs of every trial of a Ray Tune experiment.
+    Returns {trial_dir: {"accuracy": [...], "sparsity": [...], "wall_time": [...]}}, one entry per epoch.
+    '''
+    from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
+
+    curves = {}
+    for event_file in sorted(glob.glob(os.path.join(experiment_dir, "*", "events.out.tfevents.*"))):
+        trial_dir = os.path.dirname(event_file)
+        accumulator = EventAccumulator(event_file, size_guidance={"scalars": 0})
+        accumulator.Reload()
+        tags = accumulator.Tags()["scalars"]
+        if metric_tag not in tags:
+            continue
+        events = accumulator.Scalars(metric_tag)
+        curve = curves.setdefault(trial_dir, {"accuracy": [], "sparsity": [], "wall_time": []})
+        curve["accuracy"] += [event.value for event in events]
+        curve["wall_time"] += [event.wall_time for event in events]
+        if sparsity_tag in tags:
+            curve["sparsity"] += [event.value for event in accumulator.Scalars(sparsity_tag)]
+
+    return curves
+
+def replay(experiment_dir, max_t, use_sparsity=False, **kwargs):
+    '''
+    Replay the logged curves of an experiment through LearningCurveRule in the order the
+    results were originally reported and count the epochs (and GPU-hours, one GPU per trial)
+    that stopping would have saved. Trials already stopped by ASHA can only stop earlier.
+    '''
+    curves = load_trial_curves(experiment_dir)
+    rule = LearningCurveRule(max_t, **kwargs)
+
+    events = []
+    for trial_dir, curve in curves.items():
+        for epoch, (accuracy, wall_time) in enumerate(zip(curve["accuracy"], curve["wall_time"])):
+            sparsity = curve["sparsity"][epoch] if use_sparsity and epoch < len(curve["sparsity"]) else None
+            events.append((wall_time, trial_dir, epoch + 1, accuracy, sparsity))
+    events.sort()
+
+    stopped_at = {}
+    for _, trial_dir, epoch, accuracy, sparsity in events:
+        if trial_dir in stopped_at:
+            continue
+        if rule.on_result(trial_dir, epoch, accuracy, sparsity) == STOP:
+            stopped_at[trial_dir] = epoch
+            rule.on_complete(trial_dir)
+        elif epoch == len(curves[trial_dir]["wall_time"]) and epoch < max_t:
+            # last result of a trial stopped by ASHA or errored, as on_trial_complete/on_trial_remove
+            rule.on_complete(trial_dir)
+
+    saved_epochs = 0
+    saved_hours = 0.
+    for trial_dir, epoch in stopped_at.items():
+        wall_time = curves[trial_dir]["wall_time"]
+        epoch_time = (wall_time[-1] - wall_time[0]) / max(1, len(wall_time) - 1)
+        saved_epochs += len(wall_time) - epoch
+        saved_hours += (len(wall_time) - epoch) * epoch_time / 3600
+
+    total_epochs = sum(len(curve["wall_time"]) for curve in curves.values())
+    best_trial = max(curves, key=lambda trial_dir: max(curves[trial_dir]["accuracy"]))
+    print(f"{len(stopped_at)}/{len(curves)} trials stopped, {saved_epochs}/{total_epochs} epochs "
+          f"({saved_hours:.1f} GPU-hours) saved, best trial {'stopped' if best_trial in stopped_at else 'kept'}: {best_trial}")
+
+    return stopped_at, saved_epochs, saved_hours
+
+
+def main():
+    experiment_dir = sys.argv[1] if len(sys.argv) > 1 else str(Path.home()) + "/ray_results/source_2_dropback"
+    replay(experiment_dir, max_t=450, use_sparsity=True)
+
+if __name__ == '__main__':
+    main()
@@ -138,6 +138,8 @@ class cifar100_datamodule(pl.LightningDataModule):
         drop_last: bool = False,
         labels: Sequence = range(100),
         already_prepared:bool = False,
+        cache_datasets: bool = False,
+        worker_init_fn = None,
         *args,
         **kwargs,
         ):
@@ -151,6 +153,11 @@ class cifar100_datamodule(pl.LightningDataModule):
         self.drop_last = drop_last
         self.lables = labels
         self.already_prepared = already_prepared
+        # Keep the loaded datasets, so reusing the datamodule for another trial does not load them again
+        self.cache_datasets = cache_datasets
+        # Runs in every dataloader worker, e.g. to pin it to the cores of the trial (see core_pinning.py)
+        self.worker_init_fn = worker_init_fn
+        self._datasets = {}
         
     @property
     def num_classes(self):
@@ -162,10 +169,21 @@ class cifar100_datamodule(pl.LightningDataModule):
         TrialCifar100(
             data_dir=self.data_dir, train=False, download=True, transform=torchvision.transforms.ToTensor(), labels=self.lables, already_prepared=self.already_prepared)
         
+    def _dataset(self, train, transform):
+        # default_transforms builds new transforms every call, they are told apart by their repr
+        key = (train, repr(transform))
+        if self.cache_datasets and key in self._datasets:
+            return self._datasets[key]
+
+        dataset = TrialCifar100(self.data_dir, train=train, download=False, transform=transform, labels=self.lables, relabel=True, already_prepared=self.already_prepared)
+        if self.cache_datasets:
+            self._datasets[key] = dataset
+        return dataset
+
     def train_dataloader(self):
         transforms, _ = self.default_transforms()
 
-        dataset_train = TrialCifar100(self.data_dir, train=True, download=False, transform=transforms, labels=self.lables, relabel=True, already_prepared=self.already_prepared)
+        dataset_train = self._dataset(train=True, transform=transforms)
         
         loader = DataLoader(
             dataset_train,
@@ -173,14 +191,15 @@ class cifar100_datamodule(pl.LightningDataModule):
             shuffle=self.shuffle,
             num_workers=self.num_workers,
             drop_last=self.drop_last,
-            pin_memory=self.pin_memory
+            pin_memory=self.pin_memory,
+            worker_init_fn=self.worker_init_fn
         )
         return loader
 
     def val_dataloader(self):
         _, transforms = self.default_transforms()
 
-        dataset_val = TrialCifar100(self.data_dir, train=False, download=False, transform=transforms, labels=self.lables, relabel=True, already_prepared=self.already_prepared)
+        dataset_val = self._dataset(train=False, transform=transforms)
         
         loader = DataLoader(
             dataset_val,
@@ -188,7 +207,8 @@ class cifar100_datamodule(pl.LightningDataModule):
             shuffle=self.shuffle,
             num_workers=self.num_workers,
             pin_memory=self.pin_memory,
-            drop_last=self.drop_last
+            drop_last=self.drop_last,
+            worker_init_fn=self.worker_init_fn
         )
         return loader
 
@@ -2,9 +2,12 @@ from pathlib import Path
 
 import math
 
+import torch
+
 import pytorch_lightning as pl
 from pytorch_lightning import seed_everything
 from pytorch_lightning.loggers import TensorBoardLogger
+from pytorch_lightning.plugins import DDPSpawnPlugin
 from pytorch_lightning.callbacks import ModelCheckpoint
 from pytorch_lightning.utilities import rank_zero_info
 
@@ -15,13 +18,32 @@ from ray.tune.integration.pytorch_lightning import TuneReportCallback
 
 from models import DBModel
 from datamodules import cifar100_datamodule
+from checkpoint import SparseCheckpoint
+from async_validation import AsyncValidation
+from pbt import TrialStateCheckpoint, pbt_scheduler
+from curve_scheduler import LearningCurveScheduler
+from telemetry import StepTimeline, timeline_tune_metrics
+from results_store import ResultsStore
+from core_pinning import pin_trial
+from compute_cost import ComputeCost, cost_tune_metrics
+from trial_cache import TrialCache, TrialMemo, trial_identity
+from masks import MaskStability
+from grad_compression import MaskedAllreduceState, GradientCompressionMonitor, masked_allreduce_hook
+from multi_sparsity import MultiSparsityValidation, multi_sparsity_tune_metrics
 
 def main():
     rank_zero_info(f"Experiment name is: dropback")
 
     tune_asha(num_samples=40, num_epochs=450, gpus_per_trial=1)
 
-def training(config, num_epochs=10, num_gpus=0):
+def training(config, checkpoint_dir=None, num_epochs=10, num_gpus=0, population_based=False):
+    # CPU-only sweeps: run every trial on its own cores (intra-op threads, dataloader workers and
+    # NUMA-local memory) instead of all trials sharing all cores, see core_pinning.py.
+    # cores_per_trial is the "cpu" of resources_per_trial.
+    pin_cores = False
+    pinned = pin_trial(cores_per_trial=4) if pin_cores else None
+    loader_kwargs = {"num_workers": pinned.num_workers, "worker_init_fn": pinned.worker_init_fn} if pinned else {}
+
     deterministic = False
     if deterministic:
         seed_everything(42, workers=True)
@@ -30,33 +52,102 @@ def training(config, num_epochs=10, num_gpus=0):
     training_labels_2 = (55, 91, 54, 28, 57, 86, 94, 18, 88, 17)
     target_list = (33, 19, 63, 79, 46, 93, 50, 52, 8, 85)
     target_list_2 = (49, 15, 66, 99, 98, 29, 74, 47, 58, 89)
-    cifar100_dm = cifar100_datamodule(labels=training_labels_2, already_prepared=True, data_dir=str(Path.home())+"/data")
+    cifar100_dm = cifar100_datamodule(labels=training_labels_2, already_prepared=True, data_dir=str(Path.home())+"/data", **loader_kwargs)
     num_classes = cifar100_dm.num_classes
 
+    # Sparse checkpoints only store the tracked weights, see checkpoint.py
+    use_sparse_checkpoint = False
+    if use_sparse_checkpoint:
+        checkpoint_callback = SparseCheckpoint(
+            filename='epoch{epoch:02d}',
+        )
+    else:
+        checkpoint_callback = ModelCheckpoint(
+            filename='epoch{epoch:02d}-val_accuracy{ptl/val_accuracy_top1:.2f}-val_loss{ptl/val_loss:.2f}',
+            auto_insert_metric_name=False,
+            # monitor='ptl/val_accuracy_top1',
+            # save_top_k=3,
+            # mode='max',         
+        )
+
+    # Per step time breakdown (data wait, forward, backward, optimizer, ...), see telemetry.py
+    step_timeline = False
+    # Jaccard overlap and turnover of the tracked (or unpruned) weights over training, see masks.py
+    mask_stability = False
+    # Effective MACs (dense, unstructured, channel-structured) and measured cpu latency, see compute_cost.py
+    compute_cost = False
+    # Every config and metric also goes to results.sqlite in the experiment directory, see results_store.py.
+    # SQLite's WAL needs a local filesystem for the experiment directory
+    results_store = False
+
+    # Nested smaller track sizes validated from the same run, see multi_sparsity.py
+    track_sizes = config.get("track_sizes", ())
+
+    tune_metrics = {
+        "loss": "ptl/val_loss",
+        "mean_accuracy": "ptl/val_accuracy_top1",
+        "current_lr": "current_lr",
+        "sparsity": "sparsity",
+        **(timeline_tune_metrics() if step_timeline else {}),
+        **(cost_tune_metrics() if compute_cost else {}),
+        **(multi_sparsity_tune_metrics(track_sizes) if track_sizes else {}),
+    }
+
+    # Validate weight snapshots on the cpu in a background process while training continues,
+    # with a stratified 20% of the validation set during the first 60 epochs
+    async_validation = False
+    if population_based:
+        # Reports with a small trial state checkpoint that exploiting trials are cloned from
+        report_callback = TrialStateCheckpoint(metrics=tune_metrics, checkpoint_dir=checkpoint_dir, config=config)
+    elif async_validation:
+        report_callback = AsyncValidation(metrics=tune_metrics, subsample=0.2, subsample_epochs=60)
+    else:
+        report_callback = TuneReportCallback(metrics=tune_metrics, on="validation_end")
+
+    # Larger effective batches: gradients of this many batches are summed before every optimizer
+    # step, Dropback ranks once per step (set "rank_every" in the config to rank less often)
+    accumulate_grad_batches = 1
+
+    # With several GPUs per trial (DDP), only all-reduce the gradients of tracked weights, see grad_compression.py
+    compress_gradients = False
+    compression_state = MaskedAllreduceState() if compress_gradients else None
+
+    # Reuse the results and checkpoints of an earlier trial with the same identity, or resume from
+    # the longest cached prefix of it, see trial_cache.py
+    memoize = False
+    trial_cache = None
+    resume_checkpoint = None
+    if memoize and not population_based and not async_validation:
+        trial_cache = TrialCache(trial_identity(
+            config, training_labels_2, "mobilenet_v2", "dropback", num_epochs, seed=42 if deterministic else None,
+            extra={"accumulate_grad_batches": accumulate_grad_batches}, script=__file__))
+        completed, resume_checkpoint = trial_cache.restore(tune.report, tune.get_trial_dir())
+        if completed:
+            return
+
     trainer = pl.Trainer(
         max_epochs=num_epochs,
+        resume_from_checkpoint=resume_checkpoint,
+        # ddp would launch the script again in every child process (the whole sweep), spawn only runs the trial
+        accelerator="ddp_spawn" if compress_gradients else None,
+        plugins=[DDPSpawnPlugin(ddp_comm_state=compression_state, ddp_comm_hook=masked_allreduce_hook)] if compress_gradients else None,
+        accumulate_grad_batches=accumulate_grad_batches,
         gpus=math.ceil(num_gpus),           # If fractional GPUs passed in, convert to int.
         logger=TensorBoardLogger(
             save_dir=tune.get_trial_dir(), name="", version="."),
         progress_bar_refresh_rate=0,
         deterministic=deterministic,
+        checkpoint_callback=not use_sparse_checkpoint,
+        limit_val_batches=0 if async_validation else 1.0,
         callbacks=[
-            TuneReportCallback(
-                metrics = {
-                    "loss": "ptl/val_loss",
-                    "mean_accuracy": "ptl/val_accuracy_top1",
-                    "current_lr": "current_lr",
-                    "sparsity": "sparsity"
-                },
-                on="validation_end"),
-            ModelCheckpoint(
-                filename='epoch{epoch:02d}-val_accuracy{ptl/val_accuracy_top1:.2f}-val_loss{ptl/val_loss:.2f}',
-                auto_insert_metric_name=False,
-                # monitor='ptl/val_accuracy_top1',
-                # save_top_k=3,
-                # mode='max',         
-            ),
-        ]
+            report_callback,
+            checkpoint_callback,
+        ] + ([StepTimeline()] if step_timeline else []) + ([MaskStability()] if mask_stability else [])
+          + ([MultiSparsityValidation()] if track_sizes else [])
+          + ([GradientCompressionMonitor(compression_state)] if compress_gradients else [])
+          + ([ComputeCost()] if compute_cost else [])
+          + ([ResultsStore(config)] if results_store else [])
+          + ([TrialMemo(trial_cache, tune_metrics)] if trial_cache else [])
     )
     
     checkpoint_path = None
@@ -64,8 +155,13 @@ def training(config, num_epochs=10, num_gpus=0):
         model = DBModel.load_from_checkpoint(checkpoint_path, config=config, num_classes=num_classes)  
         rank_zero_info(f"Checkpoint {checkpoint_path} loaded.")
     else:
+        if population_based:
+            # Same initial weights in the whole population, so cloning only copies the tracked weights
+            torch.manual_seed(0)
         model = DBModel(config=config, num_classes=num_classes)
 
+    if compress_gradients:
+        compression_state.model = model
     trainer.fit(model, datamodule=cifar100_dm) 
 
 def tune_asha(num_samples=10, num_epochs=10, gpus_per_trial=0):
@@ -78,13 +174,34 @@ def tune_asha(num_samples=10, num_epochs=10, gpus_per_trial=0):
         "q": 0.95,
         "q_init": tune.loguniform(1e-4, 1e-2),
 	    "q_step": tune.loguniform(1e-6, 1e-4),
-        "sf": False
+        "sf": False,
+        # Nested track sizes of the same run, with the top-k selection ("q": None)
+        # "track_sizes": [55917, 22367],
     }
 
-    scheduler = ASHAScheduler(
-        max_t=num_epochs,
-        grace_period=60,
-        reduction_factor=2)
+    # Stop trials whose extrapolated accuracy curve is confidently below the best trial, see curve_scheduler.py
+    use_curve_scheduler = False
+    # Population based training, exploiting trials continue from a copy of a better trial, see pbt.py
+    population_based = False
+    if population_based:
+        scheduler = pbt_scheduler(
+            hyperparam_mutations={
+                "lr": tune.uniform(0.05, 0.3),
+                "momentum": tune.uniform(0.8, 0.99),
+                "init_decay": tune.uniform(0.99, 0.999),
+            },
+            perturbation_interval=20)
+    elif use_curve_scheduler:
+        scheduler = LearningCurveScheduler(
+            max_t=num_epochs,
+            metric="mean_accuracy", sparsity_attr="sparsity",
+            min_t=20,
+            eval_every=10)
+    else:
+        scheduler = ASHAScheduler(
+            max_t=num_epochs,
+            grace_period=60,
+            reduction_factor=2)
 
     in_jupyter_notebook = False
     if in_jupyter_notebook:
@@ -103,6 +220,7 @@ def tune_asha(num_samples=10, num_epochs=10, gpus_per_trial=0):
             training,
             num_epochs=num_epochs,
             num_gpus=gpus_per_trial,
+            population_based=population_based,
         ),
         resources_per_trial={
             "cpu": 4,
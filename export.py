@@ -0,0 +1,109 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from torchvision.models.mobilenetv2 import InvertedResidual
+
+from utils import count_macs
+
+
+def _expanded_blocks(model):
+    '''
+    InvertedResidual blocks with an expansion layer, their conv is
+    [ConvBNReLU expand, ConvBNReLU depthwise, Conv2d project, BatchNorm2d].
+    '''
+    return [module for module in model.modules() if isinstance(module, InvertedResidual) and len(module.conv) == 4]
+
+def _hidden_channel_params(block):
+    '''
+    (param, dim) pairs of an expanded block whose slices along dim belong to one hidden channel.
+    '''
+    expand, depthwise, project = block.conv[0], block.conv[1], block.conv[2]
+    return [
+        (expand[0].weight, 0),
+        (expand[1].weight, 0),
+        (expand[1].bias, 0),
+        (depthwise[0].weight, 0),
+        (depthwise[1].weight, 0),
+        (depthwise[1].bias, 0),
+        (project.weight, 1),
+    ]
+
+def mobilenet_v2_channel_groups(model):
+    '''
+    Group the parameters that belong to the same hidden channel of every expanded
+    inverted residual block, as channel_groups for StructuredDropback.
+    Once all of them are zero the hidden channel contributes nothing and can be removed.
+    '''
+    return [_hidden_channel_params(block) for block in _expanded_blocks(model)]
+
+def _alive_hidden_channels(block, threshold=0):
+    depthwise = block.conv[1]
+    alive = torch.zeros(depthwise[0].out_channels, dtype=torch.bool, device=depthwise[0].weight.device)
+    for param, dim in _hidden_channel_params(block):
+        alive |= (param.detach().abs() > threshold).transpose(0, dim).reshape(param.size(dim), -1).any(1)
+
+    return alive
+
+def _slice_conv(conv, out_index=None, in_index=None):
+    weight = conv.weight.detach()
+    if out_index is not None:
+        weight = weight[out_index]
+    if in_index is not None and conv.groups == 1:
+        weight = weight[:, in_index]
+
+    out_channels = weight.size(0)
+    in_channels = weight.size(1) * (out_channels if conv.groups > 1 else 1)
+    groups = out_channels if conv.groups > 1 else 1
+    new_conv = nn.Conv2d(in_channels, out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                         dilation=conv.dilation, groups=groups, bias=conv.bias is not None)
+    new_conv.weight.data.copy_(weight)
+    if conv.bias is not None:
+        new_conv.bias.data.copy_(conv.bias.detach()[out_index] if out_index is not None else conv.bias.detach())
+
+    return new_conv.to(conv.weight.device)
+
+def _slice_batchnorm(bn, index):
+    new_bn = nn.BatchNorm2d(len(index), eps=bn.eps, momentum=bn.momentum)
+    new_bn.weight.data.copy_(bn.weight.detach()[index])
+    new_bn.bias.data.copy_(bn.bias.detach()[index])
+    new_bn.running_mean.copy_(bn.running_mean[index])
+    new_bn.running_var.copy_(bn.running_var[index])
+    new_bn.num_batches_tracked.copy_(bn.num_batches_tracked)
+
+    return new_bn.to(bn.weight.device)
+
+def export_structured_mobilenet_v2(model, threshold=0):
+    '''
+    Return a physically smaller copy of a MobileNetV2 in which the hidden channels of
+    the inverted residual blocks are removed when all their weights are zero (untracked
+    by StructuredDropback after init_decay brought the initial weights to zero).
+    A dead hidden channel contributes exactly zero, so the exported model is equivalent
+    in eval mode. At least one channel is kept per block.
+    '''
+    model = copy.deepcopy(model).eval()
+
+    for block in _expanded_blocks(model):
+        alive = _alive_hidden_channels(block, threshold)
+        if not alive.any():
+            alive[0] = True
+        index = torch.nonzero(alive).flatten()
+
+        expand, depthwise = block.conv[0], block.conv[1]
+        expand[0] = _slice_conv(expand[0], out_index=index)
+        expand[1] = _slice_batchnorm(expand[1], index)
+        depthwise[0] = _slice_conv(depthwise[0], out_index=index)
+        depthwise[1] = _slice_batchnorm(depthwise[1], index)
+        block.conv[2] = _slice_conv(block.conv[2], in_index=index)
+
+    return model
+
+def structured_flop_reduction(model, input_size=(1, 3, 32, 32), threshold=0):
+    '''
+    MACs of the dense model, MACs of the exported model and the relative reduction.
+    '''
+    dense_macs = count_macs(model, input_size)
+    exported_macs = count_macs(export_structured_mobilenet_v2(model, threshold), input_size)
+
+    return dense_macs, exported_macs, 1 - exported_macs / dense_macs
@@ -0,0 +1,287 @@
+import copy
+import math
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.nn.utils.prune as prune
+from torch.nn.parallel import DistributedDataParallel
+
+from pytorch_lightning.callbacks import Callback
+
+from checkpoint import untracked_values
+from Dropback_qe import Dropback
+
+
+# GradBucket changed between torch versions
+def _bucket_buffer(bucket):
+    if hasattr(bucket, "buffer"):
+        return bucket.buffer()
+    if hasattr(bucket, "get_tensor"):
+        return bucket.get_tensor()
+    return bucket.get_tensors()[0]
+
+def _bucket_index(bucket):
+    return bucket.index() if hasattr(bucket, "index") else bucket.get_index()
+
+def _bucket_params(bucket):
+    if hasattr(bucket, "parameters"):
+        return bucket.parameters()
+    if hasattr(bucket, "get_model_params_for_bucket"):
+        return bucket.get_model_params_for_bucket()
+    raise RuntimeError("masked_allreduce_hook needs the parameters of a gradient bucket (torch >= 1.9)")
+
+def _hook_result(bucket, tensor):
+    # before torch 1.10 a hook returns a list of tensors
+    return tensor if hasattr(bucket, "buffer") else [tensor]
+
+def _allreduce_future(tensor, process_group):
+    work = dist.all_reduce(tensor, group=process_group, async_op=True)
+    try:
+        return work.get_future()
+    except RuntimeError:
+        # process groups without futures (older gloo)
+        work.wait()
+        future = torch.futures.Future()
+        future.set_result([tensor])
+        return future
+
+
+class MaskedAllreduceState:
+    '''
+    State of masked_allreduce_hook.
+
+    model: the module wrapped by DistributedDataParallel
+    optimizer: its Dropback optimizer. When None, the Dropback optimizer of the trainer
+        of a LightningModule is used if there is one, otherwise the masks of the pruning
+        reparametrization.
+    candidate_fraction: share of the untracked Dropback weights of a bucket whose
+        gradients are all-reduced as well, a window moving through the bucket every step,
+        so untracked weights can still enter the top-k.
+    error_feedback: gradients that are not communicated are added to the gradient of the
+        next step, so a candidate brings the gradient accumulated since it was last sent.
+
+    Only values are sent, every rank selects the same positions: the weights are the same
+    on every rank (DDP), so are the tracked sets, and the candidate window only depends on
+    the number of steps. bytes_sent and bytes_dense count the all-reduced bytes and the
+    bytes of a dense all-reduce.
+    '''
+
+    def __init__(self, model=None, optimizer=None, process_group=None, candidate_fraction=0.01, error_feedback=True):
+        self.model = model
+        self.optimizer = optimizer
+        self.process_group = process_group
+        self.candidate_fraction = candidate_fraction
+        self.error_feedback = error_feedback
+        self.residuals = {}
+        self.calls = {}
+        self.bytes_sent = 0
+        self.bytes_dense = 0
+        self._dropback_params = None
+
+    def _dropback(self):
+        optimizer = self.optimizer
+        if optimizer is None:
+            trainer = getattr(self.model, "trainer", None)
+            optimizers = getattr(trainer, "optimizers", None)
+            optimizer = optimizers[0] if optimizers else None
+        return optimizer if isinstance(optimizer, Dropback) else None
+
+    def mask(self, p):
+        '''Positions of p whose gradient is all-reduced, None for all of them.'''
+        optimizer = self._dropback()
+        if optimizer is not None:
+            if self._dropback_params is None:
+                self._dropback_params = {id(param): (group, init_p) for group in optimizer.param_groups
+                                         for param, init_p in zip(group['params'], group['init_params'])}
+            group, init_p = self._dropback_params.get(id(p), (None, None))
+            if group is None or group['dense'] or group['first_iter']:
+                # before the first step every weight still is at its initial value
+                return None
+            return p.detach() != untracked_values(group, init_p.to(p.device))
+
+        # the pruned parameter keeps its identity as <name>_orig, or stays <name> with the masks
+        # fused (PruneModel fused_masks), next to a <name>_mask buffer. The mask can change every epoch
+        for module in self.model.modules():
+            for name, param in module.named_parameters(recurse=False):
+                if param is not p:
+                    continue
+                mask_name = (name[:-len("_orig")] if name.endswith("_orig") else name) + "_mask"
+                if mask_name in module._buffers:
+                    return module._buffers[mask_name] != 0
+        return None
+
+    def communication_report(self):
+        return {"bytes_sent": self.bytes_sent, "bytes_dense": self.bytes_dense,
+                "fraction": self.bytes_sent / self.bytes_dense if self.bytes_dense else math.nan}
+
+
+def masked_allreduce_hook(state, bucket):
+    '''
+    DDP communication hook that all-reduces only the gradients of tracked Dropback weights
+    (plus a rotating window of candidates) or of unpruned weights, see MaskedAllreduceState.
+    The other gradients are zero after the hook. Register with
+    ddp_model.register_comm_hook(state, masked_allreduce_hook).
+    '''
+    process_group = state.process_group if state.process_group is not None else dist.group.WORLD
+    world_size = dist.get_world_size(process_group)
+    buffer = _bucket_buffer(bucket)
+    params = _bucket_params(bucket)
+    index = _bucket_index(bucket)
+    step = state.calls.get(index, 0)
+    state.calls[index] = step + 1
+    state.bytes_dense += buffer.numel() * buffer.element_size()
+
+    # init_params can be replaced between steps (load_state_dict, warm_start)
+    state._dropback_params = None
+    masks = [state.mask(p) for p in params]
+    if all(mask is None for mask in masks):
+        state.bytes_sent += buffer.numel() * buffer.element_size()
+        buffer.div_(world_size)
+        return _allreduce_future(buffer, process_group).then(lambda future: _hook_result(bucket, future.value()[0]))
+
+    selected = torch.cat([
+        torch.ones(p.numel(), dtype=torch.bool, device=buffer.device) if mask is None else mask.flatten()
+        for p, mask in zip(params, masks)
+    ])
+    dropback = state._dropback() is not None
+    if dropback and state.candidate_fraction:
+        window = max(1, int(state.candidate_fraction * buffer.numel()))
+        candidates = torch.arange(step * window, (step + 1) * window, device=buffer.device) % buffer.numel()
+        selected[candidates] = True
+    if dropback and state.error_feedback and index in state.residuals:
+        buffer.add_(state.residuals[index])
+
+    indices = selected.nonzero().flatten()
+    values = buffer[indices].div_(world_size)
+    if dropback and state.error_feedback:
+        residual = buffer.clone()
+        residual[indices] = 0
+        state.residuals[index] = residual
+    state.bytes_sent += values.numel() * values.element_size()
+
+    def decompress(future):
+        buffer.zero_()
+        buffer[indices] = future.value()[0]
+        return _hook_result(bucket, buffer)
+
+    return _allreduce_future(values, process_group).then(decompress)
+
+
+class GradientCompressionMonitor(Callback):
+    '''Logs comm/bytes_sent_fraction, the all-reduced bytes of the epoch relative to dense all-reduces.'''
+
+    def __init__(self, state):
+        super().__init__()
+        self.state = state
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self.state.bytes_sent = 0
+        self.state.bytes_dense = 0
+
+    def on_train_epoch_end(self, trainer, pl_module, *args):
+        if self.state.bytes_dense:
+            pl_module.log("comm/bytes_sent_fraction", self.state.communication_report()["fraction"])
+
+
+def _validate_worker(rank, world_size, port, pruned, error_feedback, num_steps, results):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(64, 256), nn.ReLU(), nn.Linear(256, 10))
+    if pruned:
+        for module in (model[0], model[2]):
+            prune.l1_unstructured(module, "weight", amount=0.9)
+    # gets the weights of model before every step and dense gradients
+    reference = copy.deepcopy(model)
+
+    ddp_model = DistributedDataParallel(model)
+    ddp_reference = DistributedDataParallel(reference)
+    if pruned:
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+    else:
+        optimizer = Dropback(model.parameters(), lr=0.1, momentum=0.9, track_size=2000)
+    state = MaskedAllreduceState(model, None if pruned else optimizer, error_feedback=error_feedback)
+    ddp_model.register_comm_hook(state, masked_allreduce_hook)
+
+    torch.manual_seed(1 + rank)
+    max_error = 0.
+    sent_total = 0.
+    dense_total = 0.
+    for _ in range(num_steps):
+        with torch.no_grad():
+            for p, q in zip(model.parameters(), reference.parameters()):
+                q.copy_(p)
+        masks = [state.mask(p) for p in model.parameters()]
+        x, y = torch.randn(32, 64), torch.randint(0, 10, (32,))
+        for module in (ddp_model, ddp_reference):
+            module.zero_grad()
+            F.cross_entropy(module(x), y).backward()
+        for p, q, mask in zip(model.parameters(), reference.parameters(), masks):
+            sent_total += p.grad.double().sum().item()
+            dense_total += q.grad.double().sum().item()
+            if error_feedback:
+                continue
+            # without error feedback the tracked (or unpruned) gradients are the dense averages
+            mask = torch.ones_like(p, dtype=torch.bool) if mask is None else mask
+            if mask.any():
+                max_error = max(max_error, (p.grad[mask] - q.grad[mask]).abs().max().item())
+        optimizer.step()
+
+    if error_feedback:
+        # with error feedback nothing is lost: what was sent plus what is still held back is the dense total
+        residual = torch.tensor([sum(r.double().sum().item() for r in state.residuals.values())], dtype=torch.float64)
+        dist.all_reduce(residual)
+        max_error = abs(sent_total + residual.item() / world_size - dense_total)
+
+    # the weights stay the same on every rank
+    checksum = torch.tensor([sum(p.double().sum().item() for p in model.parameters())], dtype=torch.float64)
+    gathered = [torch.zeros_like(checksum) for _ in range(world_size)]
+    dist.all_gather(gathered, checksum)
+    if rank == 0:
+        density = sum(int(mask.sum()) if mask is not None else p.numel() for p, mask in zip(model.parameters(), masks)) \
+            / sum(p.numel() for p in model.parameters())
+        results.put({
+            "max_gradient_error": max_error,
+            "same_weights": all(torch.equal(gathered[0], other) for other in gathered[1:]),
+            "density": density,
+            **state.communication_report(),
+        })
+    dist.destroy_process_group()
+
+def validate_masked_allreduce(world_size=2, num_steps=5):
+    '''
+    Train a small model with DDP on world_size cpu processes (gloo) with Dropback, with
+    Dropback and error feedback, and pruned. Checks that the ranks keep the same weights and
+    that the gradients of tracked (unpruned) weights are the ones of a dense all-reduce, or
+    with error feedback, that the sent and held back gradients add up to the dense ones.
+    '''
+    context = torch.multiprocessing.get_context("spawn")
+    ok = True
+    for name, pruned, error_feedback in (("dropback", False, False), ("dropback with error feedback", False, True),
+                                         ("pruned", True, False)):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        results = context.Queue()
+        processes = [context.Process(target=_validate_worker, args=(rank, world_size, port, pruned, error_feedback, num_steps, results))
+                     for rank in range(world_size)]
+        for process in processes:
+            process.start()
+        result = results.get()
+        for process in processes:
+            process.join()
+
+        passed = result["max_gradient_error"] < 1e-5 and result["same_weights"]
+        ok = ok and passed
+        print(f"{name:28s}: {'ok' if passed else 'FAILED'}, gradient error {result['max_gradient_error']:.2e}, "
+              f"density {result['density']:.3f}, bytes sent {result['fraction']:.3f} of dense")
+    return ok
+
+if __name__ == '__main__':
+    validate_masked_allreduce()
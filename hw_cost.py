@@ -0,0 +1,183 @@
+import sys
+
+import torch
+
+# Memory hierarchies: on-chip buffer size, off-chip bandwidth (bytes per second), energy per
+# byte moved off-chip and on-chip (pJ) and the size of a value and of an index
+MEMORY_HIERARCHIES = {
+    "edge_accelerator": {"on_chip_bytes": 2 * 2**20, "dram_bandwidth": 25.6e9, "dram_pj_per_byte": 20.,
+                         "sram_pj_per_byte": 1., "value_bytes": 4, "index_bytes": 4},
+    "edge_accelerator_fp16": {"on_chip_bytes": 2 * 2**20, "dram_bandwidth": 25.6e9, "dram_pj_per_byte": 20.,
+                              "sram_pj_per_byte": 1., "value_bytes": 2, "index_bytes": 4},
+    "gpu": {"on_chip_bytes": 40 * 2**20, "dram_bandwidth": 900e9, "dram_pj_per_byte": 7.,
+            "sram_pj_per_byte": 0.3, "value_bytes": 4, "index_bytes": 4},
+}
+
+# dense_sgd: plain SGD
+# dropback: Dropback as in Dropback_qe, dense weights and initial weights in memory
+# dropback_seed_init: initial weights regenerated on chip from the seed instead of read
+# dropback_sparse: only the tracked weights (values, indices) and their momentum are stored,
+#     untracked weights are regenerated, their score only needs the gradient
+VARIANTS = ("dense_sgd", "dropback", "dropback_seed_init", "dropback_sparse")
+
+
+def load_records(path):
+    '''
+    Mask schedule recorded by masks.MaskStability (mask_stability.pt): one record per recorded
+    step with the steps since the previous record and per layer the size, the number of
+    tracked weights and the weights that entered since the previous record.
+    '''
+    state = torch.load(path, map_location="cpu")
+    records = []
+    previous_step = 0
+    for step, tracked, entries in zip(state["step"].tolist(), state["layer_count"].tolist(), state["layer_entries"].tolist()):
+        records.append({"steps": max(1, step - previous_step), "numel": state["layer_numel"].tolist(),
+                        "tracked": tracked, "entries": entries})
+        previous_step = step
+    return records
+
+def synthetic_records(layer_numel, track_size, turnover=0.01, num_steps=1000):
+    '''One record of num_steps steps, track_size spread over the layers by size, turnover of the tracked set per step.'''
+    total = sum(layer_numel)
+    tracked = [round(track_size * numel / total) for numel in layer_numel]
+    return [{"steps": num_steps, "numel": list(layer_numel), "tracked": tracked,
+             "entries": [round(turnover * count * num_steps) for count in tracked]}]
+
+
+def layer_traffic(variant, numel, tracked, entries, hierarchy, momentum=True, ranking=True, spill_scores=True,
+                  include_forward=True):
+    '''
+    Bytes one step moves for one layer of numel weights, tracked of them tracked and entries
+    of them entering the set in this step: {"read", "write"} off-chip and "on_chip".
+    Gradients are read once by the optimizer. Scores are written off-chip and read back for
+    the selection unless the selection keeps them on chip (spill_scores=False), the mask is
+    one bit per weight and always goes off-chip.
+    '''
+    value, index = hierarchy["value_bytes"], hierarchy["index_bytes"]
+    m = 1 if momentum else 0
+    n, k, e = numel, tracked, entries
+    read = write = on_chip = 0
+
+    if variant in ("dense_sgd", "dropback", "dropback_seed_init"):
+        if include_forward:
+            read += 2 * n * value
+        # weights, gradients and momentum in, weights and momentum out
+        read += n * value * (2 + m)
+        write += n * value * (1 + m)
+        if variant != "dense_sgd" and ranking:
+            init_reads = 0 if variant == "dropback_seed_init" else 1
+            # scores from the weights and initial weights
+            read += n * value * (1 + init_reads)
+            if spill_scores:
+                write += n * value
+                read += n * value
+            else:
+                on_chip += 2 * n * value
+            write += n / 8
+            read += n / 8
+            # untracked weights back to their initial value, the mask is read again
+            read +=(n - k) * value * init_reads + n / 8
+            write += (n - k) * value
+
+    elif variant == "dropback_sparse":
+        if include_forward:
+            read += 2 * k * (value + index)
+        # gradients of all weights, tracked values with their indices and momentum
+        read += n * value + k * (value + index) + m * k * value
+        write += k * value * (1 + m)
+        if ranking:
+            # untracked scores are lr * |gradient| and tracked ones the updated values, both
+            # already on chip; entering weights are written with their index and new momentum
+            if spill_scores:
+                write += n * value
+                read += n * value
+            else:
+                on_chip += 2 * n * value
+            write += e * (value * (1 + m) + index)
+
+    else:
+        raise ValueError(f"Unknown variant {variant}, expected one of {VARIANTS}")
+
+    return {"read": read, "write": write, "on_chip": on_chip}
+
+def persistent_bytes(variant, numel, tracked, hierarchy, momentum=True):
+    '''Bytes the weights, initial weights and momentum of a layer take between steps.'''
+    value, index = hierarchy["value_bytes"], hierarchy["index_bytes"]
+    m = 1 if momentum else 0
+    if variant == "dense_sgd" or variant == "dropback_seed_init":
+        return numel * value * (1 + m)
+    if variant == "dropback":
+        return numel * value * (2 + m)
+    return tracked * (value * (1 + m) + index)
+
+def simulate(records, hierarchy, variants=VARIANTS, momentum=True, selection="topk", rank_every=1, include_forward=True):
+    '''
+    Replay a mask schedule (load_records, synthetic_records) and return per variant the mean
+    per step of the off-chip reads and writes, the on-chip traffic, a lower bound of the step
+    time from the off-chip bandwidth, the energy of the traffic, the on-chip buffer the
+    selection needs and the persistent memory.
+
+    selection: "topk" keeps a heap of the track_size best scores, which avoids writing the
+    scores off-chip only when it fits on chip; "qe" (quantile estimation) compares every
+    score with a running threshold and never stores them. The entries of a record are spread
+    evenly over its steps, so churn that cancels out between two records is not counted.
+    '''
+    value, index = hierarchy["value_bytes"], hierarchy["index_bytes"]
+    results = {}
+    for variant in variants:
+        total = {"read": 0., "write": 0., "on_chip": 0.}
+        steps = 0
+        buffer_required = 0
+        persistent = 0
+        for record in records:
+            track_size = sum(record["tracked"])
+            heap_bytes = track_size * (value + index) if selection == "topk" else 0
+            spill_scores = heap_bytes > hierarchy["on_chip_bytes"]
+            buffer_required = max(buffer_required, heap_bytes if variant != "dense_sgd" else 0)
+            persistent = max(persistent, sum(persistent_bytes(variant, n, k, hierarchy, momentum)
+                                             for n, k in zip(record["numel"], record["tracked"])))
+            for ranking, num_steps in ((True, record["steps"] / rank_every), (False, record["steps"] * (1 - 1 / rank_every))):
+                if num_steps == 0:
+                    continue
+                for n, k, e in zip(record["numel"], record["tracked"], record["entries"]):
+                    traffic = layer_traffic(variant, n, k, e * rank_every / record["steps"] if ranking else 0, hierarchy,
+                                            momentum, ranking, spill_scores, include_forward)
+                    for key, value_bytes in traffic.items():
+                        total[key] += value_bytes * num_steps
+            steps += record["steps"]
+
+        per_step = {key: value_bytes / steps for key, value_bytes in total.items()}
+        off_chip = per_step["read"] + per_step["write"]
+        results[variant] = {
+            "off_chip_read": per_step["read"],
+            "off_chip_write": per_step["write"],
+            "on_chip": per_step["on_chip"],
+            "time_lower_bound": off_chip / hierarchy["dram_bandwidth"],
+            "energy": (off_chip * hierarchy["dram_pj_per_byte"] + per_step["on_chip"] * hierarchy["sram_pj_per_byte"]) * 1e-12,
+            "buffer_required": buffer_required,
+            "persistent": persistent,
+        }
+    return results
+
+def report(records, hierarchies=MEMORY_HIERARCHIES, **kwargs):
+    for name, hierarchy in hierarchies.items():
+        print(f"{name} ({hierarchy['on_chip_bytes'] / 2**20:.0f} MiB on chip, {hierarchy['dram_bandwidth'] / 1e9:.0f} GB/s)")
+        for variant, result in simulate(records, hierarchy, **kwargs).items():
+            print(f"  {variant:18s}: {result['off_chip_read'] / 2**20:7.2f} MiB read, {result['off_chip_write'] / 2**20:7.2f} MiB written, "
+                  f">= {result['time_lower_bound'] * 1e3:6.3f} ms, {result['energy'] * 1e3:7.3f} mJ per step, "
+                  f"buffer {result['buffer_required'] / 2**20:5.2f} MiB, stored {result['persistent'] / 2**20:6.2f} MiB")
+
+
+def main():
+    if len(sys.argv) > 1:
+        records = load_records(sys.argv[1])
+    else:
+        # MobileNetV2 on 10 classes with the track_size of the experiments
+        import torchvision
+        model = torchvision.models.mobilenet_v2(num_classes=10)
+        records = synthetic_records([p.numel() for p in model.parameters()], track_size=111835)
+    report(records)
+    report(records, selection="qe")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+import math
+import os
+
+import torch
+
+from pytorch_lightning.callbacks import Callback
+
+from checkpoint import untracked_values, _param_names
+from utils import pack_mask, unpack_mask
+
+
+def popcount(bits):
+    '''Number of set bits of a uint8 tensor, counted per byte with shifts and masks.'''
+    bits = bits - ((bits >> 1) & 0x55)
+    bits = (bits & 0x33) + ((bits >> 2) & 0x33)
+    bits = (bits + (bits >> 4)) & 0x0F
+    return int(bits.sum(dtype=torch.int64))
+
+
+class PackedMask:
+    '''
+    Bool mask stored with 8 entries per byte, in the layout of utils.pack_mask (the one of
+    sparse checkpoints, so their masks can be wrapped as they are). The set operations work
+    on the packed bytes and count() is a popcount, nothing is unpacked.
+    '''
+
+    def __init__(self, bits, shape):
+        self.bits = bits
+        self.shape = torch.Size(shape)
+
+    @classmethod
+    def from_bool(cls, mask):
+        return cls(pack_mask(mask), mask.shape)
+
+    def to_bool(self):
+        return unpack_mask(self.bits, self.shape)
+
+    def to(self, device):
+        return PackedMask(self.bits.to(device), self.shape)
+
+    def numel(self):
+        return self.shape.numel()
+
+    @property
+    def nbytes(self):
+        return self.bits.numel()
+
+    def count(self):
+        return popcount(self.bits)
+
+    def _check(self, other):
+        if self.shape != other.shape:
+            raise ValueError(f"Masks of different shapes {tuple(self.shape)} and {tuple(other.shape)}")
+
+    def __and__(self, other):
+        self._check(other)
+        return PackedMask(self.bits & other.bits, self.shape)
+
+    def __or__(self, other):
+        self._check(other)
+        return PackedMask(self.bits | other.bits, self.shape)
+
+    def __xor__(self, other):
+        self._check(other)
+        return PackedMask(self.bits ^ other.bits, self.shape)
+
+    def __invert__(self):
+        bits = ~self.bits
+        padding = (-self.numel()) % 8
+        if padding:
+            # the padding bits at the end stay zero, so count() only counts entries
+            bits[-1] &= (0xFF << padding) & 0xFF
+        return PackedMask(bits, self.shape)
+
+    def difference(self, other):
+        '''self & ~other'''
+        self._check(other)
+        return PackedMask(self.bits & ~other.bits, self.shape)
+
+
+def dropback_masks(model, optimizer):
+    '''
+    {parameter name: PackedMask} of the weights Dropback tracks, the ones that differ from
+    their untracked value (as in checkpoint.dropback_state_dict). Packed on the device of the
+    weights, only the packed masks are moved to the cpu.
+    '''
+    masks = {}
+    for group, names in zip(optimizer.param_groups, _param_names(model, optimizer)):
+        if group.get('dense', False):
+            continue
+        for p, init_p, name in zip(group['params'], group['init_params'], names):
+            if not p.requires_grad:
+                continue
+            mask = p.detach() != untracked_values(group, init_p.to(p.device))
+            masks[name] = PackedMask.from_bool(mask).to("cpu")
+
+    return masks
+
+def pruning_masks(model):
+    '''{parameter name: PackedMask} of the masks of the pruning reparametrization.'''
+    return {name[:-len("_mask")]: PackedMask.from_bool(buffer.bool()).to("cpu")
+            for name, buffer in model.named_buffers() if name.endswith("_mask")}
+
+
+class MaskStatistics:
+    '''
+    Streaming statistics of a sequence of masks given as {layer name: PackedMask}.
+    Every add() is compared with the previous masks:
+
+        count           size of the set
+        jaccard         |previous & current| / |previous | current|
+        entry_rate      share of the current set that was not in the previous one
+        exit_rate       share of the previous set that is not in the current one
+        layer_turnover  1 - jaccard of every layer
+        layer_entries   weights of every layer that entered the set (all of them at the first add)
+
+    One AND and three popcounts per layer, on the packed masks. With keep_history the masks
+    are kept (numel / 8 bytes each) so finalize() can compare every recorded set with the
+    last one. state_dict() is the compact time series, one row per recorded step.
+    '''
+
+    def __init__(self, keep_history=True):
+        self.keep_history = keep_history
+        self.names = None
+        self.steps = []
+        self.series = {"count": [], "jaccard": [], "entry_rate": [], "exit_rate": []}
+        self.layer_numel = None
+        self.layer_counts = []
+        self.layer_entries = []
+        self.layer_turnover = []
+        self.history = []
+        self.final_jaccard = []
+        self.layer_final_jaccard = []
+        self._previous = None
+        self._previous_counts = None
+
+    @staticmethod
+    def _ratio(numerator, denominator):
+        return numerator / denominator if denominator else math.nan
+
+    def add(self, step, masks):
+        '''Record the masks of a step and return the global statistics against the previous ones.'''
+        if self.names is None:
+            self.names = list(masks)
+            self.layer_numel = [masks[name].numel() for name in self.names]
+        counts = [masks[name].count() for name in self.names]
+        count = sum(counts)
+
+        if self._previous is None:
+            row = {"count": count, "jaccard": math.nan, "entry_rate": math.nan, "exit_rate": math.nan}
+            turnover = [math.nan] * len(self.names)
+            entries = counts
+        else:
+            intersections = [(masks[name] & self._previous[name]).count() for name in self.names]
+            intersection = sum(intersections)
+            previous_count = sum(self._previous_counts)
+            row = {
+                "count": count,
+                "jaccard": self._ratio(intersection, previous_count + count - intersection),
+                "entry_rate": self._ratio(count - intersection, count),
+                "exit_rate": self._ratio(previous_count - intersection, previous_count),
+            }
+            turnover = [1 - self._ratio(both, before + now - both) if before + now - both else 0.
+                        for both, before, now in zip(intersections, self._previous_counts, counts)]
+            entries = [now - both for both, now in zip(intersections, counts)]
+
+        self.steps.append(step)
+        for key, value in row.items():
+            self.series[key].append(value)
+        self.layer_counts.append(counts)
+        self.layer_entries.append(entries)
+        self.layer_turnover.append(turnover)
+        if self.keep_history:
+            self.history.append(masks)
+        self._previous = masks
+        self._previous_counts = counts
+
+        row["max_layer_turnover"] = max((value for value in turnover if not math.isnan(value)), default=math.nan)
+        return row
+
+    def finalize(self):
+        '''Jaccard overlap of every recorded set with the last one, globally and per layer.'''
+        if not self.history:
+            return
+        final = self.history[-1]
+        final_counts = self.layer_counts[-1]
+        self.final_jaccard = []
+        self.layer_final_jaccard = []
+        for masks, counts in zip(self.history, self.layer_counts):
+            intersections = [(masks[name] & final[name]).count() for name in self.names]
+            unions = [now + last - both for both, now, last in zip(intersections, counts, final_counts)]
+            self.final_jaccard.append(self._ratio(sum(intersections), sum(unions)))
+            self.layer_final_jaccard.append([self._ratio(both, union) if union else 1. for both, union in zip(intersections, unions)])
+
+    def state_dict(self):
+        state = {
+            "names": self.names,
+            "layer_numel": torch.tensor(self.layer_numel or [], dtype=torch.int64),
+            "step": torch.tensor(self.steps, dtype=torch.int64),
+            "layer_count": torch.tensor(self.layer_counts, dtype=torch.int64),
+            "layer_entries": torch.tensor(self.layer_entries, dtype=torch.int64),
+            "layer_turnover": torch.tensor(self.layer_turnover, dtype=torch.float32),
+        }
+        for key, values in self.series.items():
+            state[key] = torch.tensor(values, dtype=torch.int64 if key == "count" else torch.float32)
+        if self.final_jaccard:
+            state["final_jaccard"] = torch.tensor(self.final_jaccard, dtype=torch.float32)
+            state["layer_final_jaccard"] = torch.tensor(self.layer_final_jaccard, dtype=torch.float32)
+        return state
+
+    def save(self, path):
+        torch.save(self.state_dict(), path)
+
+
+class MaskStability(Callback):
+    '''
+    Records the tracked set of Dropback, or the masks of the pruning reparametrization,
+    every every_n_steps training steps with MaskStatistics. For Dropback only steps that
+    ranked count (see Dropback rank_every), in between every weight moves.
+
+    mask/count, mask/jaccard, mask/entry_rate, mask/exit_rate and mask/max_layer_turnover
+    go to the logger. When training ends the time series and the overlap of every recorded
+    set with the final one are written to <log_dir>/mask_stability.pt.
+    '''
+
+    def __init__(self, every_n_steps=100, keep_history=True, file_name="mask_stability.pt"):
+        super().__init__()
+        self.every_n_steps = every_n_steps
+        self.file_name = file_name
+        self.statistics = MaskStatistics(keep_history=keep_history)
+        self._batches = 0
+
+    def _masks(self, trainer, pl_module):
+        optimizer = trainer.optimizers[0]
+        if 'init_params' not in optimizer.param_groups[0]:
+            return pruning_masks(pl_module)
+        group = next((group for group in optimizer.param_groups if not group.get('dense', False)), None)
+        if group is None or (group.get('step_count', 1) - 1) % group.get('rank_every', 1) != 0:
+            return {}
+        return dropback_masks(pl_module, optimizer)
+
+    def on_train_batch_end(self, trainer, pl_module, *args):
+        self._batches += 1
+        if self._batches % self.every_n_steps != 0:
+            return
+        masks = self._masks(trainer, pl_module)
+        if not masks:
+            return
+
+        row = self.statistics.add(trainer.global_step, masks)
+        if trainer.logger is not None:
+            metrics = {f"mask/{key}": value for key, value in row.items() if not math.isnan(value)}
+            trainer.logger.log_metrics(metrics, step=trainer.global_step)
+
+    def on_train_end(self, trainer, pl_module):
+        if not self.statistics.steps:
+            return
+        self.statistics.finalize()
+        log_dir = trainer.log_dir or trainer.default_root_dir
+        self.statistics.save(os.path.join(log_dir, self.file_name))
@@ -1,3 +1,7 @@
+import copy
+import functools
+from typing import Sequence
+
 import torch
 import torch.optim as optim
 import torch.optim.lr_scheduler as lr_scheduler
@@ -7,17 +11,23 @@ import torch.nn.utils.prune as prune
 import torchvision.models as models
 
 import pytorch_lightning as pl
-from pytorch_lightning.utilities import rank_zero_info
+from pytorch_lightning.utilities import rank_zero_info, rank_zero_warn
 
 import torchmetrics
 
-from utils import measure_global_sparsity, measure_module_sparsity
+from utils import measure_global_sparsity, measure_module_sparsity, fold_batchnorm
 
 # from Dropback import Dropback
 from Dropback_qe import Dropback
+from Dropback_structured import StructuredDropback
+from export import mobilenet_v2_channel_groups, export_structured_mobilenet_v2, structured_flop_reduction
 
 collecting_histogram = False
 
+def _masked_grad(module, name, grad):
+    # The mask is looked up on every call since pruning rounds replace the buffer
+    return grad * module._buffers[name + "_mask"]
+
 class ExperimentModel(pl.LightningModule):
 
     def __init__(
@@ -30,7 +40,14 @@ class ExperimentModel(pl.LightningModule):
                 "weight_decay": 4e-5,
         },
         pre_trained: bool = False,
+        fast_path: bool = False,
+        compile_model: bool = False,
     ):
+        '''
+        fast_path: keep the model and its inputs in channels_last memory format and run
+            validation/test on a copy with BatchNorm folded into the convolutions
+        compile_model: wrap the training forward (and thereby backward) with torch.compile
+        '''
         super(ExperimentModel, self).__init__()
 
         self.lr = config["lr"]
@@ -55,6 +72,18 @@ class ExperimentModel(pl.LightningModule):
         else:
             self.model = models.__dict__[self.arch](pretrained=self.pre_trained, num_classes=self.num_classes)
 
+        self.fast_path = fast_path
+        self.compile_model = compile_model
+        if self.compile_model and not hasattr(torch, "compile"):
+            rank_zero_warn("torch.compile is not available in this version of PyTorch, running eagerly.")
+            self.compile_model = False
+
+        if self.fast_path:
+            self.model = self.model.to(memory_format=torch.channels_last)
+
+        # Not registered as submodules so that state_dict and parameters() are unchanged
+        self._fast_path_cache = {}
+
         self.train_accuracy_top1 = torchmetrics.Accuracy(top_k=1)
         self.train_accuracy_top5 = torchmetrics.Accuracy(top_k=5)
         self.val_accuracy_top1 = torchmetrics.Accuracy(top_k=1)
@@ -63,7 +92,49 @@ class ExperimentModel(pl.LightningModule):
         self.save_hyperparameters()
 
     def forward(self, x):
+        if self.fast_path:
+            x = x.contiguous(memory_format=torch.channels_last)
+            if not self.training and "folded_model" in self._fast_path_cache:
+                return self._fast_path_cache["folded_model"](x)
+
+        if self.compile_model and self.training:
+            return self._compiled_model()(x)
+
         return self.model(x)
+
+    def _compiled_model(self):
+        '''
+        torch.compile shares the parameters of self.model, so the in-place updates of
+        Dropback are seen by the compiled graph. Pruning adds or replaces parameters
+        and forward pre-hooks, in which case the model is compiled again.
+        '''
+        signature = tuple(name for name, _ in self.model.named_parameters())
+        if self._fast_path_cache.get("compiled_signature") != signature:
+            self._fast_path_cache["compiled_model"] = torch.compile(self.model)
+            self._fast_path_cache["compiled_signature"] = signature
+
+        return self._fast_path_cache["compiled_model"]
+
+    def _build_folded_model(self):
+        # Weights change every training step, so the folded copy only lives for one evaluation epoch
+        if self.fast_path:
+            folded_model = fold_batchnorm(copy.deepcopy(self.model).eval())
+            self._fast_path_cache["folded_model"] = folded_model.to(memory_format=torch.channels_last)
+
+    def _drop_folded_model(self):
+        self._fast_path_cache.pop("folded_model", None)
+
+    def on_validation_epoch_start(self):
+        self._build_folded_model()
+
+    def on_validation_epoch_end(self):
+        self._drop_folded_model()
+
+    def on_test_epoch_start(self):
+        self._build_folded_model()
+
+    def on_test_epoch_end(self):
+        self._drop_folded_model()
     
     def configure_optimizers(self):
         optimizer = optim.SGD(self.parameters(), lr=self.lr, momentum=self.momentum, weight_decay=self.weight_decay)
@@ -160,8 +231,24 @@ class DBModel(ExperimentModel):
             "sf": False,
         },
         pre_trained: bool = False,
+        fast_path: bool = False,
+        compile_model: bool = False,
+        source_checkpoint: str = None,
+        source_momentum: bool = False,
+        freeze: Sequence[str] = (),
+        dense: Sequence[str] = (),
     ):
-        super().__init__(arch=arch, num_classes=num_classes, config=config, pre_trained=pre_trained)
+        '''
+        source_checkpoint: Lightning or sparse checkpoint of a Dropback run to continue from
+            (transfer learning). Its weights, initial weights, tracked weights and decay state
+            are taken over, the classifier is kept freshly initialized if num_classes differs.
+        source_momentum: also take over the momentum of the source run
+        freeze: names (prefixes, e.g. "model.features.0") of parameters that are not trained
+        dense: names (prefixes) of parameters trained without Dropback, all of their weights
+            are kept and they do not count towards track_size
+        '''
+        super().__init__(arch=arch, num_classes=num_classes, config=config, pre_trained=pre_trained,
+                         fast_path=fast_path, compile_model=compile_model)
 
         self.track_size = config["track_size"]
         self.init_decay = config["init_decay"]
@@ -169,6 +256,71 @@ class DBModel(ExperimentModel):
         self.q_init = config['q_init']
         self.q_step = config['q_step']
         self.sf = config['sf']
+        # optional, bytes Dropback may use, see Dropback memory_budget
+        self.memory_budget = config.get("memory_budget")
+        # optional, measure the peak allocation of every step, see Dropback measure_memory
+        self.measure_memory = config.get("measure_memory", False)
+        # optional, optimizer steps between two rankings, see Dropback rank_every
+        self.rank_every = config.get("rank_every", 1)
+        # optional, directory of the memory-mapped initial weights, see Dropback init_offload_dir
+        self.init_offload_dir = config.get("init_offload_dir")
+        # optional, elements per chunk of the top-k selection, see Dropback selection_chunk_size
+        self.selection_chunk_size = config.get("selection_chunk_size")
+        # optional, smaller nested track sizes validated from the same run, see multi_sparsity.py
+        self.track_sizes = config.get("track_sizes")
+
+        self.freeze = tuple(freeze)
+        self.dense = tuple(dense)
+        for name, p in self.named_parameters():
+            if name.startswith(self.freeze):
+                p.requires_grad_(False)
+
+        self._source_state = None
+        if source_checkpoint:
+            self._load_source(source_checkpoint, source_momentum)
+
+    def _load_source(self, source_checkpoint, source_momentum):
+        # imported here since checkpoint.py imports this module
+        from checkpoint import load_source_state
+
+        self._source_state = load_source_state(source_checkpoint, self, with_momentum=source_momentum)
+        with torch.no_grad():
+            for name, p in self.named_parameters():
+                if name in self._source_state["weights"]:
+                    p.copy_(self._source_state["weights"][name])
+            for name, buffer in self.named_buffers():
+                source_buffer = self._source_state["buffers"].get(name)
+                if source_buffer is not None and source_buffer.shape == buffer.shape:
+                    buffer.copy_(source_buffer)
+        rank_zero_info(f"Source checkpoint {source_checkpoint} loaded.")
+
+    def _param_groups(self):
+        if not self.dense:
+            return [{"params": list(self.parameters())}], [[name for name, _ in self.named_parameters()]]
+
+        groups = [{"params": []}, {"params": [], "dense": True}]
+        names = [[], []]
+        for name, p in self.named_parameters():
+            index = int(name.startswith(self.dense))
+            groups[index]["params"].append(p)
+            names[index].append(name)
+        non_empty = [i for i, group in enumerate(groups) if group["params"]]
+        return [groups[i] for i in non_empty], [names[i] for i in non_empty]
+
+    def memory_report(self):
+        '''Memory used by the optimizer by category, see Dropback.memory_report. None before training.'''
+        if self.trainer is None or not self.trainer.optimizers:
+            return None
+        optimizer = self.trainer.optimizers[0]
+        if not hasattr(optimizer, "memory_report"):
+            return None
+        return optimizer.memory_report()
+
+    def _warm_start(self, optimizer, names):
+        state = self._source_state
+        init_params = [[state["init_params"].get(name) for name in group_names] for group_names in names]
+        momentum_buffers = [[state["momentum"].get(name) for name in group_names] for group_names in names]
+        optimizer.warm_start(init_params, momentum_buffers, **state["group_state"])
 
     def configure_optimizers(self):
         # optimizer = Dropback(
@@ -180,8 +332,9 @@ class DBModel(ExperimentModel):
         #     init_decay = self.init_decay
         # )
 
+        param_groups, names = self._param_groups()
         optimizer = Dropback(
-            self.parameters(), 
+            param_groups, 
             lr=self.lr, 
             momentum=self.momentum, 
             weight_decay=self.weight_decay, 
@@ -191,7 +344,15 @@ class DBModel(ExperimentModel):
             q_init=self.q_init, 
             q_step=self.q_step, 
             sf=self.sf, 
+            memory_budget=self.memory_budget,
+            measure_memory=self.measure_memory,
+            rank_every=self.rank_every,
+            init_offload_dir=self.init_offload_dir,
+            selection_chunk_size=self.selection_chunk_size,
+            track_sizes=self.track_sizes,
         )
+        if self._source_state is not None:
+            self._warm_start(optimizer, names)
         
         use_ReduceLROnPlateau = False
         if use_ReduceLROnPlateau:
@@ -212,6 +373,15 @@ class DBModel(ExperimentModel):
         self.log("num_elements", num_elements)
         self.log("sparsity", sparsity)
 
+        memory = self.memory_report()
+        if memory is not None:
+            for category, num_bytes in memory["persistent"].items():
+                self.log("memory/" + category, float(num_bytes))
+            for category, num_bytes in memory["transient"].items():
+                self.log("memory/step_" + category, float(num_bytes))
+            for name, num_bytes in memory["measured"].items():
+                self.log("memory/" + name, float(num_bytes))
+
         if collecting_histogram:
             for name, module in self.named_modules():
                 if hasattr(module, 'weight'):
@@ -222,6 +392,72 @@ class DBModel(ExperimentModel):
                 module_num_zeros, module_num_elements, _ = measure_module_sparsity(module, threshold=zero_threshold, weight=True, bias=True, use_mask=False)
                 self.log("remaining_params/" + name, module_num_elements - module_num_zeros)
 
+class SDBModel(DBModel):
+    '''
+    Dropback with whole channels (or blocks) as tracked units, see StructuredDropback.
+    For MobileNetV2 the hidden channels of the inverted residual blocks are tracked as one
+    unit each, so the model can be exported physically smaller.
+    '''
+
+    def __init__(
+        self,
+        arch: str = "mobilenet_v2", 
+        num_classes: int = 10, 
+        config = {
+            "lr": 0.1,
+            "momentum": 0.9,
+            "weight_decay": 4e-5,
+            "track_size": 111835,
+            "init_decay": 0.99,
+            "q": None,
+            "q_init": 1e-2,
+            "q_step": 1e-6,
+            "sf": False,
+            "granularity": "channel",
+            "block_size": 16,
+        },
+        pre_trained: bool = False,
+        fast_path: bool = False,
+        compile_model: bool = False,
+    ):
+        super().__init__(arch=arch, num_classes=num_classes, config=config, pre_trained=pre_trained,
+                         fast_path=fast_path, compile_model=compile_model)
+
+        self.granularity = config["granularity"]
+        self.block_size = config["block_size"]
+
+    def configure_optimizers(self):
+        channel_groups = None
+        if self.arch == "mobilenet_v2" and self.granularity == "channel":
+            channel_groups = mobilenet_v2_channel_groups(self.model)
+
+        optimizer = StructuredDropback(
+            self.parameters(), 
+            lr=self.lr, 
+            momentum=self.momentum, 
+            weight_decay=self.weight_decay, 
+            track_size=self.track_size, 
+            init_decay=self.init_decay,
+            granularity=self.granularity,
+            block_size=self.block_size,
+            channel_groups=channel_groups,
+        )
+
+        scheduler = lr_scheduler.MultiStepLR(optimizer, milestones=[150, 250, 350], gamma=0.1)
+        return [optimizer], [scheduler]
+
+    def training_epoch_end(self, outputs):
+        super().training_epoch_end(outputs)
+
+        self.log("tracked_fraction", self.trainer.optimizers[0].param_groups[0]["tracked_fraction"])
+        if self.arch == "mobilenet_v2":
+            _, _, flop_reduction = structured_flop_reduction(self.model)
+            self.log("flop_reduction", flop_reduction)
+
+    def export(self, threshold=0):
+        '''Physically smaller MobileNetV2 without the dead hidden channels.'''
+        return export_structured_mobilenet_v2(self.model, threshold)
+
 class PruneModel(ExperimentModel):
     def __init__(
         self,
@@ -234,9 +470,64 @@ class PruneModel(ExperimentModel):
         },
         pruning: bool = False,
         pre_trained: bool = False,
+        fast_path: bool = False,
+        compile_model: bool = False,
+        fused_masks: bool = False,
     ):
-        super().__init__(arch=arch, num_classes=num_classes, config=config, pre_trained=pre_trained)
+        '''
+        fused_masks: keep pruned weights masked in place instead of recomputing
+            weight_orig * weight_mask in a forward pre-hook every step, see fuse_pruning_masks
+        '''
+        super().__init__(arch=arch, num_classes=num_classes, config=config, pre_trained=pre_trained,
+                         fast_path=fast_path, compile_model=compile_model)
         self.pruning = pruning
+        self.fused_masks = fused_masks
+        self._mask_grad_hooks = {}
+
+    def fuse_pruning_masks(self):
+        '''
+        Replace the pruning reparametrization (weight_orig, weight_mask and a forward pre-hook)
+        by the masked weight itself. The mask stays as the weight_mask buffer, so
+        measure_global_sparsity(use_mask=True) and the next global pruning round of
+        ModelPruning still see it. It is enforced on the gradient by a hook and on the
+        weight after every optimizer step by apply_pruning_masks.
+        The parameter object is kept, so the optimizer state stays valid.
+        '''
+        for module in self.model.modules():
+            for key, hook in list(module._forward_pre_hooks.items()):
+                if not isinstance(hook, prune.BasePruningMethod):
+                    continue
+                name = hook._tensor_name
+                del module._forward_pre_hooks[key]
+                delattr(module, name)
+                param = module._parameters.pop(name + "_orig")
+                mask = module._buffers[name + "_mask"].bool()
+                module._buffers[name + "_mask"] = mask
+                with torch.no_grad():
+                    param.mul_(mask)
+                module.register_parameter(name, param)
+
+                handle = self._mask_grad_hooks.pop(id(param), None)
+                if handle is not None:
+                    handle.remove()
+                self._mask_grad_hooks[id(param)] = param.register_hook(functools.partial(_masked_grad, module, name))
+
+    def apply_pruning_masks(self):
+        '''Zero the pruned weights again after momentum and weight decay moved them.'''
+        with torch.no_grad():
+            for module in self.model.modules():
+                for name in ("weight", "bias"):
+                    if name in module._parameters and name + "_mask" in module._buffers:
+                        module._parameters[name].mul_(module._buffers[name + "_mask"])
+
+    def on_train_epoch_start(self):
+        # ModelPruning prunes at the end of an epoch
+        if self.fused_masks:
+            self.fuse_pruning_masks()
+
+    def on_train_batch_end(self, outputs, batch, batch_idx, dataloader_idx=0):
+        if self.fused_masks:
+            self.apply_pruning_masks()
 
     def configure_optimizers(self):
         parameters = list(self.parameters())
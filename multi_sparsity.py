@@ -0,0 +1,95 @@
+import time
+
+import torch
+import torch.nn.functional as F
+
+from pytorch_lightning.callbacks import Callback
+
+from utils import is_sanity_checking, measure_global_sparsity
+
+
+def multi_sparsity_tune_metrics(track_sizes):
+    '''Entries for the metrics of TuneReportCallback, the validation accuracy of every level and the compute saved.'''
+    metrics = {f"accuracy_{k}": f"level_{k}/val_accuracy_top1" for k in track_sizes}
+    metrics["compute_saved"] = "multi_sparsity/compute_saved"
+    return metrics
+
+
+class MultiSparsityValidation(Callback):
+    '''
+    Validate the nested track_sizes levels of a Dropback run (see Dropback track_sizes and
+    shadow_weights) after every validation of the full model, so one run gives the curves
+    of several sparsity levels instead of one Ray Tune sweep per track_size.
+
+    Logged per level: level_<k>/val_loss, level_<k>/val_accuracy_top1 and
+    level_<k>/sparsity. multi_sparsity/compute_saved is the share of the training and
+    validation time of independent runs (one per level plus the full one, each as long as
+    this run without the level validations) that the shared run saves so far.
+
+    Approximation relative to independent runs: a level is the top k of the scores of the
+    shared trajectory, whose tracked weights follow the gradients of the largest track_size.
+    A run at track_size k would compute its gradients, and so its scores, with only k weights
+    tracked, and its BatchNorm statistics would be its own instead of the shared ones. The
+    level curves rank sparsity levels and show where accuracy breaks down; the final numbers
+    of a chosen level should be confirmed with a run of its own.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self._epoch_start = None
+        self._validation_start = None
+        self._train_time = 0.
+        self._validation_time = 0.
+        self._level_time = 0.
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._epoch_start = time.perf_counter()
+
+    def on_validation_start(self, trainer, pl_module):
+        self._validation_start = time.perf_counter()
+        if self._epoch_start is not None and not is_sanity_checking(trainer):
+            # validation runs at the end of the training epoch
+            self._train_time += self._validation_start - self._epoch_start
+            self._epoch_start = None
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        if is_sanity_checking(trainer):
+            return
+        self._validation_time += time.perf_counter() - self._validation_start
+
+        optimizer = trainer.optimizers[0]
+        track_sizes = sorted(set(k for group in optimizer.param_groups for k in group.get('track_sizes', ())), reverse=True)
+        if not track_sizes or not optimizer.levels:
+            return
+
+        start = time.perf_counter()
+        for k in track_sizes:
+            with optimizer.shadow_weights(k):
+                loss, accuracy, sparsity = self._validate(trainer, pl_module)
+            pl_module.log(f"level_{k}/val_loss", loss)
+            pl_module.log(f"level_{k}/val_accuracy_top1", accuracy)
+            pl_module.log(f"level_{k}/sparsity", sparsity)
+        self._level_time += time.perf_counter() - start
+
+        shared = self._train_time + self._validation_time + self._level_time
+        independent = (len(track_sizes) + 1) * (self._train_time + self._validation_time)
+        pl_module.log("multi_sparsity/compute_saved", 1 - shared / independent)
+
+    @torch.no_grad()
+    def _validate(self, trainer, pl_module):
+        was_training = pl_module.training
+        pl_module.eval()
+        total_loss = 0.
+        correct = 0
+        num_samples = 0
+        for x, y in trainer.datamodule.val_dataloader():
+            x, y = x.to(pl_module.device), y.to(pl_module.device)
+            logits = pl_module(x)
+            total_loss += F.cross_entropy(logits, y, reduction="sum").item()
+            correct += (logits.argmax(1) == y).sum().item()
+            num_samples += len(y)
+        pl_module.train(was_training)
+
+        # as the sparsity logged by DBModel
+        _, _, sparsity = measure_global_sparsity(pl_module.model, threshold=0, weight=True, bias=True, use_mask=False)
+        return total_loss / num_samples, correct / num_samples, sparsity
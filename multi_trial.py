@@ -0,0 +1,239 @@
+import bisect
+import copy
+import os
+import random
+from pathlib import Path
+
+import torch
+import torch.nn.functional as F
+from torch.func import functional_call, stack_module_state, vmap
+from torch.utils.tensorboard import SummaryWriter
+
+from pytorch_lightning.utilities import rank_zero_info
+
+from models import ExperimentModel
+from datamodules import cifar100_datamodule
+from Dropback_qe import qe
+
+
+class VectorizedTrials:
+    '''
+    Train several configs of the same architecture in one process on the same batches.
+    The N models are stacked with torch.func.stack_module_state and run with vmap over
+    functional_call, so one forward/backward covers all of them. Every model has its own
+    lr, momentum and weight_decay and, with dropback=True, its own Dropback state
+    (track_size, init_decay, q, q_init, q_step, sf), following Dropback_qe step by step.
+    BatchNorm running statistics are stacked as well, so they are tracked per model.
+    '''
+
+    def __init__(self, configs, arch="mobilenet_v2", num_classes=10, dropback=False, milestones=(150, 250, 350),
+                 device="cpu"):
+        self.configs = configs
+        self.num_trials = len(configs)
+        self.dropback = dropback
+        self.milestones = list(milestones)
+        self.device = device
+
+        models = [ExperimentModel(arch=arch, num_classes=num_classes, config=config).model.to(device) for config in configs]
+        self.params, self.buffers = stack_module_state(models)
+        self.params = {name: param.detach().requires_grad_() for name, param in self.params.items()}
+        # Stateless copy of the architecture that functional_call runs with the stacked tensors
+        self.base_model = copy.deepcopy(models[0]).to("meta")
+
+        self.base_lr = self._hyperparameter("lr")
+        self.lr = self.base_lr.clone()
+        self.momentum = self._hyperparameter("momentum")
+        self.weight_decay = self._hyperparameter("weight_decay")
+        self.momentum_buffers = None
+
+        if self.dropback:
+            self.init_params = {name: param.detach().clone() for name, param in self.params.items()}
+            self.init_decay = self._hyperparameter("init_decay")
+            self.decay_rate = torch.ones(self.num_trials, device=device)
+            self.first_iter = True
+            self.track_size = [config["track_size"] for config in configs]
+            self.q = [config.get("q") for config in configs]
+            self.q_init = [config.get("q_init") for config in configs]
+            self.q_step = [config.get("q_step") for config in configs]
+            self.sf = [config.get("sf", False) for config in configs]
+
+    def _hyperparameter(self, key):
+        return torch.tensor([float(config[key]) for config in self.configs], device=self.device)
+
+    def _per_trial(self, values, tensor):
+        # view a [N] vector so it broadcasts against a stacked [N, ...] tensor
+        return values.view(-1, *([1] * (tensor.dim() - 1)))
+
+    def _forward(self, params, buffers, x):
+        return functional_call(self.base_model, (params, buffers), (x,))
+
+    def forward(self, x):
+        '''Logits of every model, shape [N, batch, num_classes].'''
+        return vmap(self._forward, in_dims=(0, 0, None))(self.params, self.buffers, x)
+
+    def set_epoch(self, epoch):
+        '''MultiStepLR with gamma 0.1, as in the Lightning models.'''
+        self.lr = self.base_lr * 0.1 ** bisect.bisect_right(self.milestones, epoch)
+
+    def training_step(self, x, y):
+        self.base_model.train()
+        logits = self.forward(x)
+        losses = torch.stack([F.cross_entropy(trial_logits, y) for trial_logits in logits])
+        # the models are independent, so the gradient of the sum is the gradient of every model
+        grads = torch.autograd.grad(losses.sum(), list(self.params.values()))
+
+        with torch.no_grad():
+            if self.dropback:
+                self._decay_init_params()
+            self._sgd_step(grads)
+            if self.dropback:
+                self._dropback_reset()
+
+        accuracy = (logits.argmax(2) == y).float().mean(1)
+        return losses.detach(), accuracy
+
+    def _sgd_step(self, grads):
+        '''torch.optim.SGD without dampening and nesterov, vectorized over the models.'''
+        first_step = self.momentum_buffers is None
+        if first_step:
+            self.momentum_buffers = {}
+
+        for (name, param), grad in zip(self.params.items(), grads):
+            d_p = grad + self._per_trial(self.weight_decay, param) * param
+            if first_step:
+                self.momentum_buffers[name] = d_p.clone()
+            else:
+                self.momentum_buffers[name].mul_(self._per_trial(self.momentum, param)).add_(d_p)
+            param.sub_(self._per_trial(self.lr, param) * self.momentum_buffers[name])
+
+    def _decay_init_params(self):
+        if not self.first_iter:
+            decay = (self.decay_rate != 0) & (self.init_decay < 1)
+            self.decay_rate = torch.where(decay, self.decay_rate * self.init_decay, self.decay_rate)
+            self.decay_rate[self.decay_rate < 1e-10] = 0
+        self.first_iter = False
+
+    def _dropback_reset(self):
+        scores = torch.cat([
+            torch.abs(param - self._per_trial(self.decay_rate, param) * self.init_params[name]).flatten(1)
+            for name, param in self.params.items()
+        ], dim=1)
+
+        if all(q is None for q in self.q) and len(set(self.track_size)) == 1:
+            _, ind = torch.topk(scores, self.track_size[0], dim=1)
+            flattened_mask = torch.zeros_like(scores, dtype=torch.bool)
+            flattened_mask.scatter_(1, ind, True)
+        else:
+            flattened_mask = torch.stack([self._trial_mask(i, trial_scores) for i, trial_scores in enumerate(scores)])
+
+        start = 0
+        for name, param in self.params.items():
+            end = start + param[0].numel()
+            mask = flattened_mask[:, start:end].reshape(param.shape)
+            param.copy_(torch.where(mask, param, self._per_trial(self.decay_rate, param) * self.init_params[name]))
+            start = end
+
+    def _trial_mask(self, i, trial_scores):
+        '''Mask of a single model, with quantile estimation as in Dropback_qe.'''
+        if self.q[i] is None:
+            _, ind = torch.topk(trial_scores, self.track_size[i])
+            mask = torch.zeros_like(trial_scores, dtype=torch.bool)
+            mask.scatter_(0, ind, True)
+            return mask
+
+        mask, est = qe(trial_scores.cpu(), self.q_init[i], self.q_step[i], self.q[i])
+        if self.sf[i]:
+            self.q_init[i] = 0.1 * self.q_init[i] + 0.9 * torch.mean(est)
+        return mask.to(trial_scores.device).bool()
+
+    def validation_step(self, x, y):
+        self.base_model.eval()
+        with torch.no_grad():
+            logits = self.forward(x)
+        losses = torch.stack([F.cross_entropy(trial_logits, y, reduction="sum") for trial_logits in logits])
+        correct = (logits.argmax(2) == y).sum(1)
+        return losses, correct
+
+    def sparsity(self):
+        '''Fraction of exactly zero weights of every model.'''
+        num_zeros = sum((param == 0).flatten(1).sum(1) for param in self.params.values())
+        num_elements = sum(param[0].numel() for param in self.params.values())
+        return num_zeros.float() / num_elements
+
+
+def train_vectorized(configs, num_epochs=10, dropback=False, labels=range(100), log_dir=None, device="cpu",
+                     on_metrics=None):
+    '''
+    Train all configs at once. Metrics of every config are written to their own TensorBoard
+    directory (log_dir/trial_<i>) and passed to on_metrics(trial_index, epoch, metrics).
+    '''
+    dm = cifar100_datamodule(labels=labels, already_prepared=True, data_dir=str(Path.home())+"/data")
+    trials = VectorizedTrials(configs, num_classes=dm.num_classes, dropback=dropback, device=device)
+    log_dir = log_dir or str(Path.home()) + "/ray_results/vectorized"
+    writers = [SummaryWriter(os.path.join(log_dir, f"trial_{i}")) for i in range(len(configs))]
+    for writer, config in zip(writers, configs):
+        writer.add_text("config", str(config))
+
+    for epoch in range(num_epochs):
+        trials.set_epoch(epoch)
+
+        train_loss = torch.zeros(len(configs), device=device)
+        train_accuracy = torch.zeros(len(configs), device=device)
+        num_batches = 0
+        for x, y in dm.train_dataloader():
+            loss, accuracy = trials.training_step(x.to(device), y.to(device))
+            train_loss += loss
+            train_accuracy += accuracy
+            num_batches += 1
+
+        val_loss = torch.zeros(len(configs), device=device)
+        val_correct = torch.zeros(len(configs), device=device)
+        num_samples = 0
+        for x, y in dm.val_dataloader():
+            loss, correct = trials.validation_step(x.to(device), y.to(device))
+            val_loss += loss
+            val_correct += correct
+            num_samples += len(y)
+
+        sparsity = trials.sparsity()
+        for i, writer in enumerate(writers):
+            metrics = {
+                "ptl/train_loss": (train_loss[i] / num_batches).item(),
+                "ptl/train_accuracy_top1": (train_accuracy[i] / num_batches).item(),
+                "ptl/val_loss": (val_loss[i] / num_samples).item(),
+                "ptl/val_accuracy_top1": (val_correct[i] / num_samples).item(),
+                "current_lr": trials.lr[i].item(),
+                "sparsity": sparsity[i].item(),
+            }
+            for name, value in metrics.items():
+                writer.add_scalar(name, value, epoch)
+            if on_metrics is not None:
+                on_metrics(i, epoch, metrics)
+
+    for writer in writers:
+        writer.close()
+
+    return trials
+
+def main():
+    rank_zero_info(f"Experiment name is: vectorized dropback")
+
+    # Same search space as dropback_experiment.py, sampled up front
+    configs = [{
+        "lr": random.uniform(0.05, 0.3),
+        "momentum": random.uniform(0.8, 0.99),
+        "weight_decay": 10 ** random.uniform(-6, -3),
+        "track_size": 111835,
+        "init_decay": 0.995,
+        "q": 0.95,
+        "q_init": 10 ** random.uniform(-4, -2),
+        "q_step": 10 ** random.uniform(-6, -4),
+        "sf": False
+    } for _ in range(4)]
+
+    training_labels_2 = (55, 91, 54, 28, 57, 86, 94, 18, 88, 17)
+    train_vectorized(configs, num_epochs=450, dropback=True, labels=training_labels_2,
+                     on_metrics=lambda i, epoch, metrics: print(i, epoch, metrics))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import bisect
+import io
+import os
+import time
+
+import torch
+
+from pytorch_lightning.callbacks import Callback
+from pytorch_lightning.utilities import rank_zero_info
+
+from ray import tune
+from ray.tune.schedulers import PopulationBasedTraining
+
+from checkpoint import dropback_state_dict, load_dropback_state_dict
+from utils import is_sanity_checking
+
+TRIAL_STATE_FILE_NAME = "trial_state.pt"
+
+# Config keys that are written into the optimizer param groups when a trial is cloned
+PERTURBED_KEYS = ("lr", "momentum", "weight_decay", "init_decay")
+
+
+def trial_state_dict(trainer, pl_module):
+    '''
+    Everything a trial needs to continue from another trial's state, without the Lightning
+    checkpoint overhead. Dropback trials of a population are built from the same init_seed,
+    so only the tracked weights, their mask and their momentum are stored (dropback_state_dict
+    with sparse_momentum). Other models store their weights and optimizer state.
+    '''
+    optimizer = trainer.optimizers[0]
+    if 'init_params' in optimizer.param_groups[0]:
+        state = {"dropback": dropback_state_dict(pl_module, optimizer, sparse_momentum=True)}
+    else:
+        state = {"state_dict": pl_module.state_dict(), "optimizer": optimizer.state_dict()}
+
+    state["lr_schedulers"] = [config["scheduler"].state_dict() for config in trainer.lr_schedulers]
+    state["epoch"] = trainer.current_epoch
+    state["global_step"] = trainer.global_step
+    return state
+
+def _scheduled_lr(scheduler, base_lr):
+    # MultiStepLR keeps its milestones as a Counter
+    milestones = sorted(scheduler.milestones.elements())
+    return base_lr * scheduler.gamma ** bisect.bisect_right(milestones, scheduler.last_epoch)
+
+def load_trial_state(trainer, pl_module, state, config=None):
+    '''
+    Restore a trial_state_dict into a running trainer, then apply the (perturbed)
+    hyperparameters of config to the optimizer and lr scheduler.
+    '''
+    optimizer = trainer.optimizers[0]
+    if "dropback" in state:
+        load_dropback_state_dict(pl_module, optimizer, state["dropback"])
+    else:
+        pl_module.load_state_dict(state["state_dict"])
+        optimizer.load_state_dict(state["optimizer"])
+
+    for scheduler_config, scheduler_state in zip(trainer.lr_schedulers, state["lr_schedulers"]):
+        scheduler_config["scheduler"].load_state_dict(scheduler_state)
+
+    # continue after the epoch the state was saved at
+    trainer.current_epoch = state["epoch"] + 1
+    trainer.global_step = state["global_step"]
+
+    if config is None:
+        return
+    for group in optimizer.param_groups:
+        for key in PERTURBED_KEYS:
+            if key in config and key in group:
+                group[key] = config[key]
+    if "lr" in config:
+        scheduler = trainer.lr_schedulers[0]["scheduler"]
+        scheduler.base_lrs = [config["lr"] for _ in optimizer.param_groups]
+        for group in optimizer.param_groups:
+            group["lr"] = _scheduled_lr(scheduler, config["lr"])
+
+
+class TrialStateCheckpoint(Callback):
+    '''
+    Report to Ray Tune with a trial_state_dict checkpoint, for PopulationBasedTraining.
+    Use it instead of TuneReportCallback and pass the checkpoint_dir of the trial function,
+    the state in it is restored when training starts.
+
+    The time to write and to restore the state (pbt/clone_save_time, pbt/clone_load_time)
+    and its size are logged and reported next to the epoch time.
+    '''
+
+    def __init__(self, metrics, checkpoint_dir=None, config=None, every_n_epochs=1):
+        super().__init__()
+        self.metrics = metrics
+        self.checkpoint_dir = checkpoint_dir
+        self.config = config
+        self.every_n_epochs = every_n_epochs
+        self._timings = {}
+        self._epoch_start = None
+
+    def on_train_start(self, trainer, pl_module):
+        if not self.checkpoint_dir:
+            return
+        start = time.time()
+        state = torch.load(os.path.join(self.checkpoint_dir, TRIAL_STATE_FILE_NAME), map_location="cpu")
+        load_trial_state(trainer, pl_module, state, self.config)
+        self._timings["pbt/clone_load_time"] = time.time() - start
+        rank_zero_info(f"Trial state of epoch {state['epoch']} restored in {self._timings['pbt/clone_load_time']:.3f}s.")
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._epoch_start = time.time()
+
+    def on_train_epoch_end(self, trainer, pl_module, *args):
+        if self._epoch_start is not None:
+            self._timings["epoch_time"] = time.time() - self._epoch_start
+
+    def on_validation_end(self, trainer, pl_module):
+        if is_sanity_checking(trainer):
+            return
+        if (trainer.current_epoch + 1) % self.every_n_epochs != 0:
+            return
+
+        start = time.time()
+        buffer = io.BytesIO()
+        torch.save(trial_state_dict(trainer, pl_module), buffer)
+        with tune.checkpoint_dir(step=trainer.current_epoch) as checkpoint_dir:
+            with open(os.path.join(checkpoint_dir, TRIAL_STATE_FILE_NAME), "wb") as f:
+                f.write(buffer.getbuffer())
+        self._timings["pbt/clone_save_time"] = time.time() - start
+        self._timings["pbt/checkpoint_bytes"] = buffer.getbuffer().nbytes
+
+        if trainer.logger is not None:
+            trainer.logger.log_metrics(self._timings, step=trainer.global_step)
+
+        report_dict = {key: trainer.callback_metrics[metric].item() for key, metric in self.metrics.items() if metric in trainer.callback_metrics}
+        report_dict.update(self._timings)
+        tune.report(**report_dict)
+
+
+def pbt_scheduler(hyperparam_mutations, perturbation_interval=20):
+    '''PopulationBasedTraining on the metric and mode passed to tune.run.'''
+    return PopulationBasedTraining(
+        time_attr="training_iteration",
+        perturbation_interval=perturbation_interval,
+        hyperparam_mutations=hyperparam_mutations)
@@ -2,11 +2,10 @@ from pathlib import Path
 
 import math
 
-import torch
-
 import pytorch_lightning as pl
 from pytorch_lightning import seed_everything
 from pytorch_lightning.loggers import TensorBoardLogger
+from pytorch_lightning.plugins import DDPSpawnPlugin
 from pytorch_lightning.callbacks import ModelCheckpoint
 from pytorch_lightning.callbacks import ModelPruning
 from pytorch_lightning.utilities.cloud_io import load as pl_load
@@ -19,6 +18,15 @@ from ray.tune.integration.pytorch_lightning import TuneReportCallback
 
 from models import PruneModel
 from datamodules import cifar100_datamodule
+from checkpoint import load_pruned_checkpoint
+from curve_scheduler import LearningCurveScheduler
+from telemetry import StepTimeline, timeline_tune_metrics
+from results_store import ResultsStore
+from core_pinning import pin_trial
+from compute_cost import ComputeCost, cost_tune_metrics
+from trial_cache import TrialCache, TrialMemo, trial_identity
+from masks import MaskStability
+from grad_compression import MaskedAllreduceState, GradientCompressionMonitor, masked_allreduce_hook
 
 def main():
     rank_zero_info(f"Experiment name is: prune")
@@ -26,6 +34,13 @@ def main():
     tune_asha(num_samples=6, num_epochs=600, gpus_per_trial=1)
 
 def training(config, num_epochs=10, num_gpus=0):
+    # CPU-only sweeps: run every trial on its own cores (intra-op threads, dataloader workers and
+    # NUMA-local memory) instead of all trials sharing all cores, see core_pinning.py.
+    # cores_per_trial is the "cpu" of resources_per_trial.
+    pin_cores = False
+    pinned = pin_trial(cores_per_trial=4) if pin_cores else None
+    loader_kwargs = {"num_workers": pinned.num_workers, "worker_init_fn": pinned.worker_init_fn} if pinned else {}
+
     deterministic = False
     if deterministic:
         seed_everything(42, workers=True)
@@ -34,25 +49,61 @@ def training(config, num_epochs=10, num_gpus=0):
     training_labels_2 = (55, 91, 54, 28, 57, 86, 94, 18, 88, 17)
     target_list = (33, 19, 63, 79, 46, 93, 50, 52, 8, 85)
     target_list_2 = (49, 15, 66, 99, 98, 29, 74, 47, 58, 89)
-    cifar100_dm = cifar100_datamodule(labels=training_labels_2, already_prepared=True, data_dir=str(Path.home())+"/data")
+    cifar100_dm = cifar100_datamodule(labels=training_labels_2, already_prepared=True, data_dir=str(Path.home())+"/data", **loader_kwargs)
     num_classes = cifar100_dm.num_classes
     
+    # Per step time breakdown (data wait, forward, backward, optimizer, ...), see telemetry.py
+    step_timeline = False
+    # Jaccard overlap and turnover of the tracked (or unpruned) weights over training, see masks.py
+    mask_stability = False
+    # Effective MACs (dense, unstructured, channel-structured) and measured cpu latency, see compute_cost.py
+    compute_cost = False
+    # Every config and metric also goes to results.sqlite in the experiment directory, see results_store.py.
+    # SQLite's WAL needs a local filesystem for the experiment directory
+    results_store = False
+
+    # With several GPUs per trial (DDP), only all-reduce the gradients of unpruned weights, see grad_compression.py
+    compress_gradients = False
+    compression_state = MaskedAllreduceState() if compress_gradients else None
+
+    tune_metrics = {
+        "loss": "ptl/val_loss",
+        "mean_accuracy": "ptl/val_accuracy_top1",
+        "current_lr": "current_lr",
+        "sparsity": "sparsity",
+        **(timeline_tune_metrics() if step_timeline else {}),
+        **(cost_tune_metrics() if compute_cost else {}),
+    }
+
+    # checkpoint_path = None
+    checkpoint_path = str(Path.home()) + "/" + "dropback_experiments/checkpoints/prune_2-val_accuracy0.88-val_loss0.49_sparsity0.94.ckpt"
+
+    # Reuse the results and checkpoints of an earlier trial with the same identity, or resume from
+    # the longest cached prefix of it, see trial_cache.py
+    memoize = False
+    trial_cache = None
+    resume_checkpoint = None
+    if memoize:
+        trial_cache = TrialCache(trial_identity(
+            config, training_labels_2, "mobilenet_v2", "prune", num_epochs, seed=42 if deterministic else None,
+            extra={"checkpoint": checkpoint_path}, script=__file__))
+        completed, resume_checkpoint = trial_cache.restore(tune.report, tune.get_trial_dir())
+        if completed:
+            return
+
     trainer = pl.Trainer(
         max_epochs=num_epochs,
+        resume_from_checkpoint=resume_checkpoint,
+        # ddp would launch the script again in every child process (the whole sweep), spawn only runs the trial
+        accelerator="ddp_spawn" if compress_gradients else None,
+        plugins=[DDPSpawnPlugin(ddp_comm_state=compression_state, ddp_comm_hook=masked_allreduce_hook)] if compress_gradients else None,
         gpus=math.ceil(num_gpus),           # If fractional GPUs passed in, convert to int.
         logger=TensorBoardLogger(
             save_dir=tune.get_trial_dir(), name="", version="."),
         progress_bar_refresh_rate=0,
         deterministic=deterministic,
         callbacks = [
-            TuneReportCallback(
-                metrics = {
-                    "loss": "ptl/val_loss",
-                    "mean_accuracy": "ptl/val_accuracy_top1",
-                    "current_lr": "current_lr",
-                    "sparsity": "sparsity"
-                },
-                on="validation_end"),
+            TuneReportCallback(metrics=tune_metrics, on="validation_end"),
             ModelCheckpoint(
                 filename='epoch{epoch:02d}-val_accuracy{ptl/val_accuracy_top1:.2f}-val_loss{ptl/val_loss:.2f}_sparsity{sparsity:.2f}',
                 auto_insert_metric_name=False,
@@ -70,25 +121,26 @@ def training(config, num_epochs=10, num_gpus=0):
                 verbose=1,
                 use_lottery_ticket_hypothesis=False
                 )
-        ]
+        ] + ([StepTimeline()] if step_timeline else []) + ([MaskStability()] if mask_stability else [])
+          + ([GradientCompressionMonitor(compression_state)] if compress_gradients else [])
+          + ([ComputeCost()] if compute_cost else [])
+          + ([ResultsStore(config)] if results_store else [])
+          + ([TrialMemo(trial_cache, tune_metrics)] if trial_cache else [])
     )
 
-    # checkpoint_path = None
-    checkpoint_path = str(Path.home()) + "/" + "dropback_experiments/checkpoints/prune_2-val_accuracy0.88-val_loss0.49_sparsity0.94.ckpt"
+    # Keep the pruned weights masked in place instead of using forward pre-hooks
+    fused_masks = False
+
     if checkpoint_path:
-        model = PruneModel(config=config, num_classes=num_classes, pruning=True)
-        for name, module in model.named_modules():
-            if hasattr(module, "weight") and module.weight is not None: 
-                torch.nn.utils.prune.identity(module, "weight")
-            if hasattr(module, "bias") and module.bias is not None: 
-                torch.nn.utils.prune.identity(module, "bias")
-
-        checkpoint = torch.load(checkpoint_path)
-        model.load_state_dict(checkpoint['state_dict'])  
+        model = PruneModel(config=config, num_classes=num_classes, pruning=True, fused_masks=fused_masks)
+        # Only creates the pruning reparametrization where the checkpoint has masks
+        load_pruned_checkpoint(model, checkpoint_path)
         rank_zero_info(f"Checkpoint {checkpoint_path} loaded.")
     else:
-        model = PruneModel(config=config, num_classes=num_classes, pruning=True)
+        model = PruneModel(config=config, num_classes=num_classes, pruning=True, fused_masks=fused_masks)
 
+    if compress_gradients:
+        compression_state.model = model
     trainer.fit(model, datamodule=cifar100_dm) 
     
 def tune_asha(num_samples=10, num_epochs=10, gpus_per_trial=0):
@@ -98,10 +150,19 @@ def tune_asha(num_samples=10, num_epochs=10, gpus_per_trial=0):
         "weight_decay": tune.loguniform(1e-6, 1e-3),
     }
 
-    scheduler = ASHAScheduler(
-        max_t=num_epochs,
-        grace_period=60,
-        reduction_factor=2)
+    # Stop trials whose extrapolated accuracy curve is confidently below the best trial, see curve_scheduler.py
+    use_curve_scheduler = False
+    if use_curve_scheduler:
+        scheduler = LearningCurveScheduler(
+            max_t=num_epochs,
+            metric="mean_accuracy", sparsity_attr="sparsity",
+            min_t=20,
+            eval_every=10)
+    else:
+        scheduler = ASHAScheduler(
+            max_t=num_epochs,
+            grace_period=60,
+            reduction_factor=2)
 
     in_jupyter_notebook = False
     if in_jupyter_notebook:
@@ -0,0 +1,319 @@
+import copy
+import inspect
+import io
+import os
+import sys
+import warnings
+from pathlib import Path
+
+import torch
+from torch.utils.data import DataLoader
+
+from models import ExperimentModel, DBModel, SDBModel
+from checkpoint import SPARSE_CHECKPOINT_FORMAT, load_sparse_checkpoint, load_pruned_checkpoint
+from masks import dropback_masks
+from utils import cpu_latency, fold_batchnorm, pack_mask, unpack_mask
+
+QUANTIZED_FORMAT = "sparse-int8-v1"
+
+
+def drop_untracked(model, optimizer):
+    '''
+    Set the weights Dropback does not track to zero, so the sparsity pattern of the exported
+    model is the tracked set (masks.dropback_masks). Untracked weights sit at
+    decay_rate * initial weight, they are only zero already once decay_rate reached 0; before
+    that zeroing them changes the network, which is warned about. Returns the number of
+    tracked weights.
+    '''
+    masks = dropback_masks(model, optimizer)
+    parameters = dict(model.named_parameters())
+    num_tracked = 0
+    changed = False
+    with torch.no_grad():
+        for name, mask in masks.items():
+            p = parameters[name]
+            tracked = mask.to_bool()
+            changed = changed or bool((p[~tracked] != 0).any())
+            p[~tracked] = 0
+            num_tracked += int(tracked.sum())
+    if changed:
+        decay_rates = sorted(set(group['decay_rate'] for group in optimizer.param_groups if not group.get('dense', False)))
+        warnings.warn(f"decay_rate {decay_rates} is not 0, the untracked weights (decay_rate * initial weight) were not "
+                      f"zero and are set to zero for the sparse export, the exported network differs from the trained one.")
+    return num_tracked
+
+def _load_dropback_lightning(checkpoint):
+    # Dropback keeps the initial weights and decay_rate in its param groups, they decide the tracked set
+    hyper_parameters = {key: value for key, value in checkpoint["hyper_parameters"].items() if key != "source_checkpoint"}
+    model_cls = SDBModel if "granularity" in hyper_parameters.get("config", {}) else DBModel
+    pl_module = model_cls(**hyper_parameters)
+    pl_module.load_state_dict(checkpoint["state_dict"])
+    optimizers, _ = pl_module.configure_optimizers()
+    optimizers[0].load_state_dict(checkpoint["optimizer_states"][0])
+    return pl_module, optimizers[0]
+
+def load_for_export(checkpoint_path):
+    '''
+    The network (pl_module.model, in eval mode) of a DBModel/PruneModel/ExperimentModel
+    Lightning checkpoint or of a sparse Dropback checkpoint. Pruning masks are applied to
+    the weights, and of Dropback checkpoints only the tracked weights are kept
+    (drop_untracked), so the zeros of the exported network are its sparsity pattern.
+    '''
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    if checkpoint.get("format") == SPARSE_CHECKPOINT_FORMAT:
+        pl_module, optimizer, _, _ = load_sparse_checkpoint(checkpoint_path)
+        drop_untracked(pl_module, optimizer)
+        return pl_module.model.eval()
+
+    optimizer_states = checkpoint.get("optimizer_states") or [{}]
+    if any("init_params" in group for group in optimizer_states[0].get("param_groups", ())):
+        pl_module, optimizer = _load_dropback_lightning(checkpoint)
+        drop_untracked(pl_module, optimizer)
+        return pl_module.model.eval()
+
+    hyper_parameters = checkpoint["hyper_parameters"]
+    model = ExperimentModel(arch=hyper_parameters.get("arch", "mobilenet_v2"),
+                            num_classes=hyper_parameters.get("num_classes", 10),
+                            config=hyper_parameters["config"]).model
+    state_dict = {key[len("model."):]: value for key, value in checkpoint["state_dict"].items() if key.startswith("model.")}
+    if any(key.endswith("_mask") for key in state_dict):
+        load_pruned_checkpoint(model, {"state_dict": state_dict}, make_permanent=True)
+    else:
+        model.load_state_dict(state_dict)
+    return model.eval()
+
+
+def _fx_quantization():
+    try:
+        from torch.ao.quantization import get_default_qconfig
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    except ImportError:
+        from torch.quantization import get_default_qconfig
+        from torch.quantization.quantize_fx import prepare_fx, convert_fx
+    return get_default_qconfig, prepare_fx, convert_fx
+
+def _prepare(model, backend, example_input):
+    get_default_qconfig, prepare_fx, _ = _fx_quantization()
+    qconfig_dict = {"": get_default_qconfig(backend)}
+    # example_inputs is required from torch 1.13 on
+    if "example_inputs" in inspect.signature(prepare_fx).parameters:
+        return prepare_fx(model, qconfig_dict, example_inputs=(example_input,))
+    return prepare_fx(model, qconfig_dict)
+
+def quantize(model, calibration_data, backend="fbgemm", num_batches=8):
+    '''
+    Post training static int8 quantization (FX graph mode, so the torchvision model needs no
+    quant stubs) of a copy of model, calibrated on num_batches (x, y) batches. BatchNorm is
+    folded into the convolutions first. The default qconfig quantizes weights per output
+    channel and symmetrically, a zero weight stays exactly zero and the sparsity pattern is
+    the one of the fp32 model. backend: fbgemm (x86) or qnnpack (ARM).
+    '''
+    _, _, convert_fx = _fx_quantization()
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+
+    prepared = None
+    with torch.no_grad():
+        for i, (x, _) in enumerate(calibration_data):
+            if i == num_batches:
+                break
+            if prepared is None:
+                prepared = _prepare(model, backend, x)
+            prepared(x)
+    if prepared is None:
+        raise ValueError("No calibration data.")
+
+    return convert_fx(prepared)
+
+
+def _quantized_modules(model):
+    # quantized Conv2d/ConvReLU2d/Linear keep their weight packed and expose it as weight()
+    return {name: module for name, module in model.named_modules()
+            if hasattr(module, "set_weight_bias") and callable(getattr(module, "weight", None))}
+
+def _zero_points(weight):
+    if weight.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric):
+        shape = [1] * weight.dim()
+        shape[weight.q_per_channel_axis()] = -1
+        return weight.q_per_channel_zero_points().view(shape).expand(weight.shape)
+    return torch.full(weight.shape, weight.q_zero_point(), dtype=torch.int64)
+
+def _pack_quantized(weight):
+    ints = weight.int_repr()
+    mask = ints.long() != _zero_points(weight)
+    packed = {"shape": tuple(weight.shape), "dtype": weight.dtype, "mask": pack_mask(mask), "values": ints[mask]}
+    if weight.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric):
+        packed.update(scales=weight.q_per_channel_scales().float(), zero_points=weight.q_per_channel_zero_points(),
+                      axis=weight.q_per_channel_axis())
+    else:
+        packed.update(scale=weight.q_scale(), zero_point=weight.q_zero_point())
+    return packed
+
+def _unpack_quantized(packed):
+    if "scales" in packed:
+        zero_points = packed["zero_points"].view([-1 if i == packed["axis"] else 1 for i in range(len(packed["shape"]))])
+        ints = zero_points.expand(packed["shape"]).clone()
+    else:
+        ints = torch.full(packed["shape"], packed["zero_point"], dtype=torch.int64)
+    ints = ints.to(packed["values"].dtype)
+    ints[unpack_mask(packed["mask"], packed["shape"])] = packed["values"]
+    if "scales" in packed:
+        return torch._make_per_channel_quantized_tensor(ints, packed["scales"].double(), packed["zero_points"], packed["axis"])
+    return torch._make_per_tensor_quantized_tensor(ints, packed["scale"], packed["zero_point"])
+
+def quantized_state_dict(quantized_model, backend="fbgemm"):
+    '''
+    Compact form of a quantized model: the int8 weights of every quantized layer as a packed
+    bitset of the nonzero weights and their int8 values (as dropback_state_dict does for
+    fp32 weights), with their scales and zero points. Everything else (biases, activation
+    scales) is stored as it is.
+    '''
+    modules = _quantized_modules(quantized_model)
+    layers = {name: {"weight": _pack_quantized(module.weight()), "bias": module.bias()} for name, module in modules.items()}
+    state_dict = {}
+    for key, value in quantized_model.state_dict().items():
+        module_name = key.split("._packed_params")[0] if "._packed_params" in key else key.rsplit(".", 1)[0]
+        if module_name in layers and (isinstance(value, tuple) or (torch.is_tensor(value) and (value.is_quantized or key.endswith(".bias")))):
+            continue
+        state_dict[key] = value
+    return {"format": QUANTIZED_FORMAT, "backend": backend, "layers": layers, "state_dict": state_dict}
+
+def load_quantized_state_dict(model, state, example_input=None):
+    '''
+    Rebuild the quantized model from the fp32 network it was made from (weights do not
+    matter, e.g. a freshly created one) and a quantized_state_dict.
+    '''
+    if state.get("format") != QUANTIZED_FORMAT:
+        raise ValueError("Not a quantized sparse state dict.")
+    _, _, convert_fx = _fx_quantization()
+    torch.backends.quantized.engine = state["backend"]
+    example_input = torch.zeros(1, 3, 32, 32) if example_input is None else example_input
+
+    # the structure of the quantized model, its observers only need to have seen something
+    prepared = _prepare(copy.deepcopy(model).cpu().eval(), state["backend"], example_input)
+    with torch.no_grad():
+        prepared(example_input)
+    quantized_model = convert_fx(prepared)
+
+    state_dict = quantized_model.state_dict()
+    state_dict.update(state["state_dict"])
+    quantized_model.load_state_dict(state_dict)
+    modules = _quantized_modules(quantized_model)
+    for name, layer in state["layers"].items():
+        modules[name].set_weight_bias(_unpack_quantized(layer["weight"]), layer["bias"])
+    return quantized_model
+
+def save_quantized(quantized_model, path, backend="fbgemm"):
+    torch.save(quantized_state_dict(quantized_model, backend), path)
+
+
+def sparse_fp32_state_dict(model):
+    '''fp32 weights stored as in sparse checkpoints, a packed bitset of the nonzero weights and their values.'''
+    state = {}
+    for name, tensor in model.state_dict().items():
+        if tensor.is_floating_point() and tensor.dim() > 1:
+            mask = tensor != 0
+            state[name] = {"shape": tuple(tensor.shape), "mask": pack_mask(mask), "values": tensor[mask]}
+        else:
+            state[name] = tensor
+    return state
+
+def serialized_bytes(state):
+    buffer = io.BytesIO()
+    torch.save(state, buffer)
+    return buffer.getbuffer().nbytes
+
+def weight_sparsity(model):
+    '''Share of zero weights of the conv and linear layers, for float and quantized models.'''
+    zeros = total = 0
+    quantized = _quantized_modules(model)
+    for name, module in model.named_modules():
+        if name in quantized:
+            weight = module.weight()
+            zeros += int((weight.int_repr().long() == _zero_points(weight)).sum())
+            total += weight.numel()
+        elif isinstance(module, (torch.nn.Conv2d, torch.nn.Linear)):
+            zeros += int((module.weight == 0).sum())
+            total += module.weight.numel()
+    return zeros / total
+
+@torch.no_grad()
+def accuracy(model, data, num_batches=None):
+    correct = num_samples = 0
+    for i, (x, y) in enumerate(data):
+        if i == num_batches:
+            break
+        correct += (model(x).argmax(1) == y).sum().item()
+        num_samples += len(y)
+    return correct / num_samples
+
+def compare_exports(model, calibration_data, val_data, backend="fbgemm", num_calibration_batches=8, num_val_batches=None,
+                    batch_sizes=(1, 64), num_threads=1):
+    '''
+    Accuracy, artifact size, weight sparsity and cpu latency of:
+
+        fp32 dense   the network as trained, dense state_dict
+        fp32 sparse  BatchNorm folded, stored as bitset and values; runs dense kernels,
+                     PyTorch has no sparse convolutions on the cpu
+        int8 sparse  quantize() on top of the sparsity pattern, quantized_state_dict
+
+    Returns the rows and the quantized model.
+    '''
+    model = copy.deepcopy(model).cpu().eval()
+    folded = fold_batchnorm(copy.deepcopy(model))
+    quantized_model = quantize(model, calibration_data, backend, num_calibration_batches)
+
+    variants = (
+        ("fp32 dense", model, model.state_dict()),
+        ("fp32 sparse", folded, sparse_fp32_state_dict(folded)),
+        ("int8 sparse", quantized_model, quantized_state_dict(quantized_model, backend)),
+    )
+    rows = []
+    for name, variant, state in variants:
+        rows.append({
+            "name": name,
+            "accuracy": accuracy(variant, val_data, num_val_batches),
+            "bytes": serialized_bytes(state),
+            "sparsity": weight_sparsity(variant),
+            **{f"latency_{batch_size}": cpu_latency(variant, (batch_size, 3, 32, 32), num_threads=num_threads) for batch_size in batch_sizes},
+        })
+    return rows, quantized_model
+
+def print_comparison(rows):
+    for row in rows:
+        latencies = ", ".join(f"batch {key[len('latency_'):]} {value * 1e3:7.2f} ms" for key, value in row.items() if key.startswith("latency_"))
+        print(f"{row['name']:12s}: accuracy {row['accuracy']:.4f}, {row['bytes'] / 2**20:6.2f} MiB, "
+              f"sparsity {row['sparsity']:.3f}, {latencies}")
+
+
+def cifar100_export_data(datamodule, batch_size=64):
+    '''
+    Calibration batches from the training images with the validation transforms (shuffled,
+    so a few batches cover the classes) and the validation loader.
+    '''
+    from datasets import TrialCifar100
+
+    _, val_transforms = datamodule.default_transforms()
+    calibration_set = TrialCifar100(datamodule.data_dir, train=True, download=False, transform=val_transforms,
+                                    labels=datamodule.lables, relabel=True, already_prepared=datamodule.already_prepared)
+    calibration_data = DataLoader(calibration_set, batch_size=batch_size, shuffle=True)
+    return calibration_data, datamodule.val_dataloader()
+
+def main():
+    from datamodules import cifar100_datamodule
+
+    checkpoint_path = sys.argv[1]
+    # label set the checkpoint was trained on, training_labels_2 of the experiment scripts by default
+    labels = tuple(int(label) for label in sys.argv[2].split(",")) if len(sys.argv) > 2 else (55, 91, 54, 28, 57, 86, 94, 18, 88, 17)
+    datamodule = cifar100_datamodule(labels=labels, already_prepared=True, data_dir=str(Path.home())+"/data", num_workers=0)
+
+    model = load_for_export(checkpoint_path)
+    rows, quantized_model = compare_exports(model, *cifar100_export_data(datamodule))
+    print_comparison(rows)
+
+    path = os.path.splitext(checkpoint_path)[0] + ".int8.pt"
+    save_quantized(quantized_model, path)
+    print(f"Quantized model written to {path}.")
+
+if __name__ == '__main__':
+    main()
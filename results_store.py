@@ -0,0 +1,276 @@
+import glob
+import json
+import numbers
+import os
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+from pytorch_lightning.callbacks import Callback
+
+from utils import is_sanity_checking
+
+RESULTS_FILE_NAME = "results.sqlite"
+
+# One row per trial, epoch and metric. The primary key starts with the metric name and the
+# table has no rowid, so the rows of a metric are stored together and a slice over a whole
+# sweep is one range scan of the table.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS trials (
+    trial_id TEXT PRIMARY KEY,
+    experiment TEXT,
+    trial_dir TEXT,
+    config TEXT,
+    started REAL
+);
+CREATE TABLE IF NOT EXISTS params (
+    trial_id TEXT,
+    key TEXT,
+    value REAL,
+    text TEXT,
+    PRIMARY KEY (key, trial_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS metrics (
+    name TEXT,
+    trial_id TEXT,
+    epoch INTEGER,
+    step INTEGER,
+    value REAL,
+    wall_time REAL,
+    PRIMARY KEY (name, trial_id, epoch)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS trials_experiment ON trials (experiment);
+'''
+
+
+def connect(path):
+    '''
+    Open (and create) a results store. Trials of a sweep write to the same file from
+    several processes, WAL lets them append while analysis queries read.
+    '''
+    connection = sqlite3.connect(path, timeout=60)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+def _scalar(value):
+    if hasattr(value, "item"):
+        if getattr(value, "numel", lambda: 1)() != 1:
+            return None
+        value = value.item()
+    return float(value) if isinstance(value, numbers.Number) else None
+
+def add_trial(connection, trial_id, config, experiment=None, trial_dir=None):
+    '''Record a trial and its config, numeric config values also go to params to filter on.'''
+    config = config or {}
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?)",
+                           (trial_id, experiment, trial_dir, json.dumps(config, default=str), time.time()))
+        connection.executemany("INSERT OR REPLACE INTO params VALUES (?, ?, ?, ?)", [
+            (trial_id, key, _scalar(value), None if _scalar(value) is not None else json.dumps(value, default=str))
+            for key, value in config.items()])
+
+def add_metrics(connection, trial_id, epoch, metrics, step=None, wall_time=None):
+    '''Record {name: value} of an epoch, in one transaction. Non scalar values are skipped.'''
+    wall_time = time.time() if wall_time is None else wall_time
+    rows = [(name, trial_id, epoch, step, _scalar(value), wall_time)
+            for name, value in metrics.items() if _scalar(value) is not None]
+    with connection:
+        connection.executemany("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+
+class ResultsStore(Callback):
+    '''
+    Appends the config of the trial and, after every validation, every metric in
+    trainer.callback_metrics to a SQLite results store, one transaction per epoch. Without
+    validation (limit_val_batches=0) the metrics are written at the end of the training
+    epoch instead. Query the store with best_of, learning_curves and trial_configs.
+
+    path defaults to results.sqlite in the directory of the Ray Tune experiment (the parent
+    of the trial directory), so all trials of a sweep share one file. Only the global zero
+    process writes.
+    '''
+
+    def __init__(self, config=None, path=None, experiment=None, trial_id=None):
+        super().__init__()
+        self.config = config
+        self.path = path
+        self.experiment = experiment
+        self.trial_id = trial_id
+        self._connection = None
+        self._trial_dir = None
+
+    def on_train_start(self, trainer, pl_module):
+        if not trainer.is_global_zero:
+            return
+        from ray import tune
+
+        self._trial_dir = tune.get_trial_dir()
+        experiment_dir = os.path.dirname(os.path.normpath(self._trial_dir)) if self._trial_dir else os.getcwd()
+        self.path = self.path or os.path.join(experiment_dir, RESULTS_FILE_NAME)
+        self.experiment = self.experiment or os.path.basename(experiment_dir)
+        self.trial_id = self.trial_id or tune.get_trial_id() or os.path.basename(os.path.normpath(self._trial_dir or "trial"))
+        self._connection = connect(self.path)
+        add_trial(self._connection, self.trial_id, self.config, self.experiment, self._trial_dir)
+
+    def _write(self, trainer):
+        if self._connection is None:
+            return
+        add_metrics(self._connection, self.trial_id, trainer.current_epoch, trainer.callback_metrics, step=trainer.global_step)
+
+    def on_validation_end(self, trainer, pl_module):
+        if is_sanity_checking(trainer):
+            return
+        self._write(trainer)
+
+    def on_train_epoch_end(self, trainer, pl_module, *args):
+        if not trainer.num_val_batches or not sum(trainer.num_val_batches):
+            self._write(trainer)
+
+    def on_train_end(self, trainer, pl_module):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def _trial_filter(experiment=None, where=None):
+    '''
+    SQL condition on m.trial_id and its arguments. where: {config key: value or (low, high)},
+    numeric config values only.
+    '''
+    conditions = []
+    args = []
+    if experiment is not None:
+        conditions.append("m.trial_id IN (SELECT trial_id FROM trials WHERE experiment = ?)")
+        args.append(experiment)
+    for key, value in (where or {}).items():
+        if isinstance(value, (tuple, list)):
+            conditions.append("m.trial_id IN (SELECT trial_id FROM params WHERE key = ? AND value BETWEEN ? AND ?)")
+            args += [key, value[0], value[1]]
+        else:
+            conditions.append("m.trial_id IN (SELECT trial_id FROM params WHERE key = ? AND value = ?)")
+            args += [key, value]
+    return "".join(f" AND {condition}" for condition in conditions), args
+
+def best_of(path_or_connection, metric, mode="max", top=10, experiment=None, max_epoch=None, where=None):
+    '''
+    The top trials by the best value of metric, up to max_epoch (inclusive) if given.
+    Returns [(trial_id, value, epoch, config)] ordered from the best.
+    '''
+    connection = connect(path_or_connection) if isinstance(path_or_connection, (str, Path)) else path_or_connection
+    if mode not in ("max", "min"):
+        raise ValueError(f"mode must be max or min, got {mode}")
+    condition, args = _trial_filter(experiment, where)
+    if max_epoch is not None:
+        condition += " AND m.epoch <= ?"
+        args.append(max_epoch)
+    # SQLite takes the other columns of a MAX/MIN aggregate from the row of the extreme
+    rows = connection.execute(
+        f"SELECT m.trial_id, {mode.upper()}(m.value), m.epoch, t.config FROM metrics m JOIN trials t USING (trial_id) "
+        f"WHERE m.name = ?{condition} GROUP BY m.trial_id ORDER BY 2 {'DESC' if mode == 'max' else 'ASC'} LIMIT ?",
+        [metric] + args + [top]).fetchall()
+    return [(trial_id, value, epoch, json.loads(config) if config else {}) for trial_id, value, epoch, config in rows]
+
+def learning_curves(path_or_connection, metric, trial_ids=None, experiment=None, where=None, epochs=None):
+    '''
+    {trial_id: (epochs, values)} of metric, optionally only for trial_ids and the epochs in
+    the range epochs=(first, last).
+    '''
+    connection = connect(path_or_connection) if isinstance(path_or_connection, (str, Path)) else path_or_connection
+    condition, args = _trial_filter(experiment, where)
+    if trial_ids is not None:
+        trial_ids = list(trial_ids)
+        condition += f" AND m.trial_id IN ({', '.join('?' * len(trial_ids))})"
+        args += trial_ids
+    if epochs is not None:
+        condition += " AND m.epoch BETWEEN ? AND ?"
+        args += list(epochs)
+
+    curves = {}
+    for trial_id, epoch, value in connection.execute(
+            f"SELECT m.trial_id, m.epoch, m.value FROM metrics m WHERE m.name = ?{condition} ORDER BY m.trial_id, m.epoch",
+            [metric] + args):
+        trial_epochs, values = curves.setdefault(trial_id, ([], []))
+        trial_epochs.append(epoch)
+        values.append(value)
+    return curves
+
+def trial_configs(path_or_connection, experiment=None):
+    '''{trial_id: config} of the trials of a store, or of one experiment.'''
+    connection = connect(path_or_connection) if isinstance(path_or_connection, (str, Path)) else path_or_connection
+    if experiment is None:
+        rows = connection.execute("SELECT trial_id, config FROM trials")
+    else:
+        rows = connection.execute("SELECT trial_id, config FROM trials WHERE experiment = ?", (experiment,))
+    return {trial_id: json.loads(config) if config else {} for trial_id, config in rows}
+
+
+def _trial_id(trial_dir):
+    '''Ray Tune trial id of a trial directory (as ResultsStore records it), from its result.json.'''
+    result_file = os.path.join(trial_dir, "result.json")
+    if os.path.exists(result_file):
+        with open(result_file) as f:
+            for line in f:
+                if line.strip():
+                    trial_id = json.loads(line).get("trial_id")
+                    if trial_id:
+                        return trial_id
+    return os.path.basename(trial_dir)
+
+def import_tensorboard(experiment_dir, path=None):
+    '''
+    Fill a results store from the TensorBoard logs and params.json of the trials of an
+    earlier Ray Tune experiment, so sweeps from before the store can be queried the same way.
+    Scalars logged per step get the index of the event as epoch, as in load_trial_curves.
+    Trials are keyed by their Ray Tune trial id like ResultsStore does, so importing a sweep
+    that was also recorded live does not duplicate its trials.
+    '''
+    from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
+
+    path = path or os.path.join(experiment_dir, RESULTS_FILE_NAME)
+    connection = connect(path)
+    experiment = os.path.basename(os.path.normpath(experiment_dir))
+    num_trials = 0
+    for event_file in sorted(glob.glob(os.path.join(experiment_dir, "*", "events.out.tfevents.*"))):
+        trial_dir = os.path.dirname(event_file)
+        trial_id = _trial_id(trial_dir)
+        config = {}
+        params_file = os.path.join(trial_dir, "params.json")
+        if os.path.exists(params_file):
+            with open(params_file) as f:
+                config = json.load(f)
+        add_trial(connection, trial_id, config, experiment, trial_dir)
+
+        accumulator = EventAccumulator(event_file, size_guidance={"scalars": 0})
+        accumulator.Reload()
+        rows = []
+        for tag in accumulator.Tags()["scalars"]:
+            rows += [(tag, trial_id, epoch, event.step, event.value, event.wall_time)
+                     for epoch, event in enumerate(accumulator.Scalars(tag))]
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?)", rows)
+        num_trials += 1
+
+    connection.close()
+    return num_trials
+
+
+def main():
+    experiment_dir = sys.argv[1] if len(sys.argv) > 1 else str(Path.home()) + "/ray_results/source_2_dropback"
+    path = os.path.join(experiment_dir, RESULTS_FILE_NAME)
+    if not os.path.exists(path):
+        print(f"Imported {import_tensorboard(experiment_dir, path)} trials from the TensorBoard logs.")
+
+    connection = connect(path)
+    start = time.perf_counter()
+    best = best_of(connection, "ptl/val_accuracy_top1", mode="max", top=5)
+    curves = learning_curves(connection, "ptl/val_accuracy_top1", trial_ids=[trial_id for trial_id, *_ in best])
+    elapsed = time.perf_counter() - start
+    for trial_id, value, epoch, config in best:
+        print(f"{trial_id}: {value:.4f} at epoch {epoch}, {len(curves[trial_id][0])} epochs, {config}")
+    print(f"Queries took {elapsed * 1e3:.1f} ms.")
+
+if __name__ == '__main__':
+    main()
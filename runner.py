@@ -0,0 +1,351 @@
+import math
+import os
+import sys
+import time
+from pathlib import Path
+
+import yaml
+
+import torch
+
+import pytorch_lightning as pl
+from pytorch_lightning import seed_everything
+from pytorch_lightning.loggers import TensorBoardLogger
+from pytorch_lightning.callbacks import Callback, ModelCheckpoint, ModelPruning
+from pytorch_lightning.utilities import rank_zero_info
+
+from ray import tune
+from ray.tune import CLIReporter, JupyterNotebookReporter
+from ray.tune.schedulers import ASHAScheduler
+from ray.tune.integration.pytorch_lightning import TuneReportCallback
+
+from models import ExperimentModel, DBModel, SDBModel, PruneModel
+from datamodules import cifar100_datamodule
+from checkpoint import SparseCheckpoint, load_pruned_checkpoint
+from async_validation import AsyncValidation
+from curve_scheduler import LearningCurveScheduler
+from pbt import TrialStateCheckpoint, pbt_scheduler
+from telemetry import StepTimeline, timeline_tune_metrics
+from masks import MaskStability
+from results_store import ResultsStore
+from core_pinning import pin_trial
+from compute_cost import ComputeCost, cost_tune_metrics
+from trial_cache import TrialCache, TrialMemo, trial_identity
+from multi_sparsity import MultiSparsityValidation, multi_sparsity_tune_metrics
+
+LABEL_SETS = {
+    "training_labels": (30, 67, 62, 10, 51, 22, 20, 24, 97, 76),
+    "training_labels_2": (55, 91, 54, 28, 57, 86, 94, 18, 88, 17),
+    "target_list": (33, 19, 63, 79, 46, 93, 50, 52, 8, 85),
+    "target_list_2": (49, 15, 66, 99, 98, 29, 74, 47, 58, 89),
+}
+
+MODELS = {
+    "baseline": ExperimentModel,
+    "dropback": DBModel,
+    "structured_dropback": SDBModel,
+    "prune": PruneModel,
+}
+
+SEARCH_SPACE = {
+    "uniform": tune.uniform,
+    "loguniform": tune.loguniform,
+    "choice": tune.choice,
+    "randint": tune.randint,
+}
+
+DEFAULT_EXPERIMENT = {
+    "labels": "training_labels_2",
+    "num_samples": 10,
+    "num_epochs": 450,
+    "gpus_per_trial": 1,
+    "cpus_per_trial": 4,
+    "deterministic": False,
+    "accumulate_grad_batches": 1,
+    "results_store": False,
+    "memoize": False,
+    "pin_cores": False,
+    "checkpoint": None,
+    "model": {},
+    "callbacks": {},
+    "scheduler": "asha",
+    "parameter_columns": [],
+}
+
+# Lives as long as the worker process. With reuse_actors, Ray Tune runs the following trials in
+# the same process, so the imports, datasets and loaded checkpoints are only paid for once.
+_warm = {"datamodules": {}, "checkpoints": {}, "trials": 0}
+
+
+def load_experiment(path):
+    '''Read an experiment file (see experiments/) and fill in the defaults.'''
+    with open(path) as f:
+        experiment = {**DEFAULT_EXPERIMENT, **yaml.safe_load(f)}
+    if experiment["model"].get("kind", "baseline") not in MODELS:
+        raise ValueError(f"Unknown model kind {experiment['model']['kind']}, expected one of {list(MODELS)}")
+    if experiment["checkpoint"] and MODELS[experiment["model"].get("kind", "baseline")] is SDBModel:
+        # StructuredDropback keeps its own tracked state, DBModel source_checkpoint only fills Dropback's
+        raise ValueError("A checkpoint to start from is not supported for structured_dropback models")
+    return experiment
+
+def search_space(space):
+    '''{"lr": {"uniform": [0.05, 0.3]}, "track_size": 111835} -> Ray Tune config'''
+    config = {}
+    for key, value in space.items():
+        if isinstance(value, dict):
+            (sampler, args), = value.items()
+            config[key] = SEARCH_SPACE[sampler](*args)
+        else:
+            config[key] = value
+    return config
+
+def get_datamodule(labels, **loader_kwargs):
+    labels = LABEL_SETS[labels] if isinstance(labels, str) else tuple(labels)
+    if labels not in _warm["datamodules"]:
+        _warm["datamodules"][labels] = cifar100_datamodule(
+            labels=labels, already_prepared=True, data_dir=str(Path.home())+"/data", cache_datasets=True, **loader_kwargs)
+    return _warm["datamodules"][labels]
+
+def get_checkpoint(path):
+    '''The loaded checkpoint is shared by the trials of the worker, copy it before handing tensors to a model.'''
+    if path not in _warm["checkpoints"]:
+        _warm["checkpoints"][path] = torch.load(path, map_location="cpu")
+    return _warm["checkpoints"][path]
+
+def _checkpoint_path(checkpoint):
+    path = checkpoint["path"]
+    return path if os.path.isabs(path) else str(Path.home()) + "/" + path
+
+
+class FirstStepTimer(Callback):
+    '''Logs the time from the start of the trial function to its first training step.'''
+
+    def __init__(self, start_time):
+        self.start_time = start_time
+        self._logged = False
+
+    def on_train_batch_start(self, trainer, pl_module, *args):
+        if self._logged:
+            return
+        self._logged = True
+        time_to_first_step = time.time() - self.start_time
+        rank_zero_info(f"Trial {_warm['trials']} of this worker reached its first training step after {time_to_first_step:.2f}s.")
+        if trainer.logger is not None:
+            trainer.logger.log_metrics({"time_to_first_step": time_to_first_step}, step=0)
+
+
+def build_callbacks(experiment, tune_metrics, config=None, checkpoint_dir=None):
+    callbacks = experiment["callbacks"]
+    if "timeline" in callbacks:
+        tune_metrics = {**tune_metrics, **timeline_tune_metrics()}
+    if "compute_cost" in callbacks:
+        tune_metrics = {**tune_metrics, **cost_tune_metrics()}
+    track_sizes = (config or {}).get("track_sizes")
+    if track_sizes:
+        tune_metrics = {**tune_metrics, **multi_sparsity_tune_metrics(track_sizes)}
+
+    async_validation = callbacks.get("async_validation")
+    if experiment["scheduler"] == "pbt":
+        report_callback = TrialStateCheckpoint(metrics=tune_metrics, checkpoint_dir=checkpoint_dir, config=config)
+    elif async_validation:
+        report_callback = AsyncValidation(metrics=tune_metrics, **async_validation)
+    else:
+        report_callback = TuneReportCallback(metrics=tune_metrics, on="validation_end")
+
+    if callbacks.get("sparse_checkpoint"):
+        checkpoint_callback = SparseCheckpoint(**callbacks["sparse_checkpoint"])
+    else:
+        checkpoint_callback = ModelCheckpoint(auto_insert_metric_name=False, **callbacks.get("checkpoint", {}))
+
+    result = [report_callback, checkpoint_callback]
+
+    pruning = callbacks.get("pruning")
+    if pruning:
+        amount = pruning["amount"]
+        every_n_epochs = pruning["every_n_epochs"]
+        result.append(ModelPruning(
+            pruning_fn='l1_unstructured',
+            parameter_names=["weight", "bias"],
+            make_pruning_permanent=False,
+            amount=lambda epoch: amount if epoch % every_n_epochs == 0 else 0,
+            use_global_unstructured=True,
+            verbose=1,
+            use_lottery_ticket_hypothesis=False
+        ))
+
+    if "timeline" in callbacks:
+        result.append(StepTimeline(**(callbacks["timeline"] or {})))
+
+    if "mask_stability" in callbacks:
+        result.append(MaskStability(**(callbacks["mask_stability"] or {})))
+
+    if "compute_cost" in callbacks:
+        result.append(ComputeCost(**(callbacks["compute_cost"] or {})))
+
+    if track_sizes:
+        result.append(MultiSparsityValidation())
+
+    if experiment["results_store"]:
+        result.append(ResultsStore(config))
+
+    return result
+
+def build_model(experiment, config, num_classes):
+    model_kwargs = dict(experiment["model"])
+    model_cls = MODELS[model_kwargs.pop("kind", "baseline")]
+    if experiment["scheduler"] == "pbt":
+        # Same initial weights in the whole population, so cloning a Dropback trial only copies the tracked weights
+        torch.manual_seed(0)
+
+    checkpoint = experiment["checkpoint"]
+    if checkpoint and model_cls is DBModel:
+        # Dropback continues from the source run, see DBModel source_checkpoint
+        return model_cls(config=config, num_classes=num_classes, source_checkpoint=_checkpoint_path(checkpoint),
+                         source_momentum=checkpoint.get("momentum", False), **model_kwargs)
+
+    model = model_cls(config=config, num_classes=num_classes, **model_kwargs)
+    if not checkpoint:
+        return model
+
+    path = _checkpoint_path(checkpoint)
+    loaded = get_checkpoint(path)
+    state_dict = {key: value.clone() for key, value in loaded["state_dict"].items()}
+
+    if model_cls is PruneModel:
+        # Only creates the pruning reparametrization where the checkpoint has masks
+        load_pruned_checkpoint(model, {"state_dict": state_dict})
+    else:
+        model.on_load_checkpoint({"state_dict": state_dict})
+        model.load_state_dict(state_dict)
+
+    rank_zero_info(f"Checkpoint {path} loaded.")
+    return model
+
+def get_trial_cache(experiment, config, num_epochs):
+    '''TrialCache of a trial of the experiment, see trial_cache.py.'''
+    model_kwargs = dict(experiment["model"])
+    labels = experiment["labels"]
+    identity = trial_identity(
+        config,
+        LABEL_SETS[labels] if isinstance(labels, str) else labels,
+        model_kwargs.pop("arch", "mobilenet_v2"),
+        model_kwargs.pop("kind", "baseline"),
+        num_epochs,
+        seed=42 if experiment["deterministic"] else None,
+        extra={
+            "model": model_kwargs,
+            "checkpoint": experiment["checkpoint"],
+            "accumulate_grad_batches": experiment["accumulate_grad_batches"],
+            "pruning": experiment["callbacks"].get("pruning"),
+        },
+        script=__file__)
+    return TrialCache(identity)
+
+def training(config, checkpoint_dir=None, experiment=None, num_epochs=10, num_gpus=0):
+    start_time = time.time()
+    _warm["trials"] += 1
+
+    # Every trial on its own cpus_per_trial cores, see core_pinning.py. The slot is kept by the
+    # worker process, so its cached datamodule keeps the right workers.
+    pinned = pin_trial(experiment["cpus_per_trial"]) if experiment["pin_cores"] else None
+    loader_kwargs = {"num_workers": pinned.num_workers, "worker_init_fn": pinned.worker_init_fn} if pinned else {}
+
+    deterministic = experiment["deterministic"]
+    if deterministic:
+        seed_everything(42, workers=True)
+
+    # Cached results are replayed, a cached prefix is resumed from, PBT clones and asynchronous
+    # validation report outside of the cached epochs
+    trial_cache = None
+    resume_checkpoint = None
+    if experiment["memoize"] and experiment["scheduler"] != "pbt" and not experiment["callbacks"].get("async_validation"):
+        trial_cache = get_trial_cache(experiment, config, num_epochs)
+        completed, resume_checkpoint = trial_cache.restore(tune.report, tune.get_trial_dir())
+        if completed:
+            return
+
+    datamodule = get_datamodule(experiment["labels"], **loader_kwargs)
+    num_classes = datamodule.num_classes
+
+    trainer = pl.Trainer(
+        max_epochs=num_epochs,
+        resume_from_checkpoint=resume_checkpoint,
+        gpus=math.ceil(num_gpus),           # If fractional GPUs passed in, convert to int.
+        logger=TensorBoardLogger(
+            save_dir=tune.get_trial_dir(), name="", version="."),
+        progress_bar_refresh_rate=0,
+        deterministic=deterministic,
+        accumulate_grad_batches=experiment["accumulate_grad_batches"],
+        checkpoint_callback=not experiment["callbacks"].get("sparse_checkpoint"),
+        limit_val_batches=0 if experiment["callbacks"].get("async_validation") else 1.0,
+        callbacks=build_callbacks(experiment, experiment["tune_metrics"], config, checkpoint_dir) + [FirstStepTimer(start_time)]
+                  + ([TrialMemo(trial_cache, experiment["tune_metrics"])] if trial_cache else [])
+    )
+
+    model = build_model(experiment, config, num_classes)
+    trainer.fit(model, datamodule=datamodule)
+
+def run_experiment(experiment):
+    rank_zero_info(f"Experiment name is: {experiment['name']}")
+
+    num_epochs = experiment["num_epochs"]
+    gpus_per_trial = experiment["gpus_per_trial"]
+    metric_columns = list(experiment["tune_metrics"]) + ["training_iteration"]
+
+    if experiment["scheduler"] == "pbt":
+        scheduler = pbt_scheduler(
+            hyperparam_mutations=search_space(experiment["hyperparam_mutations"]),
+            perturbation_interval=experiment.get("perturbation_interval", 20))
+    elif experiment["scheduler"] == "curve":
+        scheduler = LearningCurveScheduler(
+            max_t=num_epochs,
+            metric="mean_accuracy",
+            sparsity_attr="sparsity" if "sparsity" in experiment["tune_metrics"] else None,
+            min_t=20,
+            eval_every=10)
+    else:
+        scheduler = ASHAScheduler(
+            max_t=num_epochs,
+            grace_period=60,
+            reduction_factor=2)
+
+    in_jupyter_notebook = False
+    if in_jupyter_notebook:
+        reporter = JupyterNotebookReporter(
+            overwrite=False,
+            parameter_columns=experiment["parameter_columns"],
+            metric_columns=metric_columns
+        )
+    else:
+        reporter = CLIReporter(
+            parameter_columns=experiment["parameter_columns"],
+            metric_columns=metric_columns)
+
+    analysis = tune.run(
+        tune.with_parameters(
+            training,
+            experiment=experiment,
+            num_epochs=num_epochs,
+            num_gpus=gpus_per_trial,
+        ),
+        resources_per_trial={
+            "cpu": experiment["cpus_per_trial"],
+            "gpu": gpus_per_trial
+        },
+        metric="loss",
+        mode="min",
+        config=search_space(experiment["search_space"]),
+        num_samples=experiment["num_samples"],
+        scheduler=scheduler,
+        progress_reporter=reporter,
+        reuse_actors=True,
+        name=experiment["name"])
+
+    print("Best hyperparameters found were: ", analysis.best_config)
+
+def main():
+    experiment_path = sys.argv[1] if len(sys.argv) > 1 else "experiments/dropback.yaml"
+    run_experiment(load_experiment(experiment_path))
+
+if __name__ == '__main__':
+    main()
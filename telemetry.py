@@ -0,0 +1,173 @@
+import functools
+import math
+import time
+
+import torch
+
+from pytorch_lightning.callbacks import Callback
+
+# Phases of a training step in the order they end, see StepTimeline
+PHASES = ("data_wait", "transfer", "forward", "backward", "optimizer",
+          "dropback/decay", "dropback/select", "dropback/reset", "other", "logging")
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(sorted_values, q):
+    '''Nearest rank percentile of an already sorted list.'''
+    return sorted_values[max(0, math.ceil(q / 100 * len(sorted_values)) - 1)]
+
+def timeline_tune_metrics(phases=("data_wait", "forward", "backward", "optimizer")):
+    '''Entries for the metrics of TuneReportCallback, the p50 of the given phases and the time fractions.'''
+    metrics = {"data_wait_fraction": "timeline/data_wait_fraction", "step_time_p50_ms": "timeline/step_p50_ms"}
+    for phase in phases:
+        metrics[f"{phase}_p50_ms"] = f"timeline/{phase}_p50_ms"
+    return metrics
+
+
+class StepTimeline(Callback):
+    '''
+    Where the wall clock of a training step goes. Every step is split into phases by marks
+    set from the Lightning hooks, forward hooks on pl_module.model and, for Dropback, from
+    the optimizer itself:
+
+        data_wait        end of the previous step to on_train_batch_start (dataloader)
+        transfer         to the start of the model forward (batch to device, training_step)
+        forward          model forward
+        backward         loss, zero_grad and backward, up to on_after_backward
+        optimizer        optimizer step (for Dropback only the SGD part)
+        dropback/*       init weight decay, scoring and top-k/qe selection, reset
+        other            until on_train_batch_end
+        logging          self.log and logger calls, taken out of the phase they happen in
+
+    The timers are time.perf_counter. Without cuda_sync, CUDA kernels are only accounted
+    where the cpu waits for them; cuda_sync=True synchronizes at every mark, which is exact
+    but slows training down.
+
+    Per epoch the p50/p90/p99 of every phase (timeline/<phase>_p<q>_ms), the share of every
+    phase in the epoch time (timeline/<phase>_fraction) and the step time percentiles are
+    logged with pl_module.log, so they go to TensorBoard and, with timeline_tune_metrics, to
+    Ray Tune. Since validation runs before on_train_epoch_end, Ray Tune gets them with the
+    validation of the next epoch.
+    '''
+
+    def __init__(self, cuda_sync=False):
+        super().__init__()
+        self.cuda_sync = cuda_sync
+        self._durations = {phase: [] for phase in PHASES}
+        self._step_times = []
+        self._handles = []
+        self._last = None
+        self._step_start = None
+        self._step = {}
+        self._nested = 0.
+        self._patched = []
+        self._validation_start = None
+
+    def mark(self, phase):
+        '''End the current phase, its time is added to phase.'''
+        if self._last is None:
+            return
+        if self.cuda_sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self._step[phase] = self._step.get(phase, 0.) + now - self._last - self._nested
+        self._last = now
+        self._nested = 0.
+
+    def _timed(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                if self._last is not None:
+                    self._step["logging"] = self._step.get("logging", 0.) + elapsed
+                    self._nested += elapsed
+        return wrapper
+
+    def _patch(self, obj, name):
+        original = getattr(obj, name)
+        setattr(obj, name, self._timed(original))
+        self._patched.append((obj, name))
+
+    def on_train_start(self, trainer, pl_module):
+        model = getattr(pl_module, "model", pl_module)
+        # validation runs inside the training epoch, its forward passes are not marked
+        self._handles = [
+            model.register_forward_pre_hook(lambda module, *args: self.mark("transfer") if module.training else None),
+            model.register_forward_hook(lambda module, *args: self.mark("forward") if module.training else None),
+        ]
+        for optimizer in trainer.optimizers:
+            if hasattr(optimizer, "timeline"):
+                optimizer.timeline = self.mark
+        self._patch(pl_module, "log")
+        if trainer.logger is not None:
+            self._patch(trainer.logger, "log_metrics")
+
+    def on_train_end(self, trainer, pl_module):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        for optimizer in trainer.optimizers:
+            if hasattr(optimizer, "timeline"):
+                optimizer.timeline = None
+        for obj, name in self._patched:
+            # the patched attribute shadows the method of the class
+            delattr(obj, name)
+        self._patched = []
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._durations = {phase: [] for phase in PHASES}
+        self._step_times = []
+        self._last = time.perf_counter()
+        self._step_start = self._last
+        self._step = {}
+        self._nested = 0.
+
+    def on_train_batch_start(self, trainer, pl_module, *args):
+        self.mark("data_wait")
+
+    def on_validation_start(self, trainer, pl_module):
+        self._validation_start = time.perf_counter()
+
+    def on_validation_end(self, trainer, pl_module):
+        # a validation in the middle of an epoch is not counted as data_wait of the next step
+        if self._last is not None:
+            self._last += time.perf_counter() - self._validation_start
+            self._step_start += time.perf_counter() - self._validation_start
+
+    def on_after_backward(self, trainer, pl_module):
+        self.mark("backward")
+
+    def on_train_batch_end(self, trainer, pl_module, *args):
+        self.mark("other" if "dropback/reset" in self._step else "optimizer")
+        for phase in PHASES:
+            self._durations[phase].append(self._step.get(phase, 0.))
+        self._step_times.append(self._last - self._step_start)
+        self._step_start = self._last
+        self._step = {}
+
+    def on_train_epoch_end(self, trainer, pl_module, *args):
+        if not self._step_times:
+            return
+        self._last = None
+        epoch_time = sum(self._step_times)
+
+        metrics = {}
+        for phase, durations in self._durations.items():
+            if not any(durations):
+                continue
+            durations = sorted(durations)
+            for q in PERCENTILES:
+                metrics[f"timeline/{phase.replace('/', '_')}_p{q}_ms"] = percentile(durations, q) * 1000
+            metrics[f"timeline/{phase.replace('/', '_')}_fraction"] = sum(durations) / epoch_time
+
+        step_times = sorted(self._step_times)
+        for q in PERCENTILES:
+            metrics[f"timeline/step_p{q}_ms"] = percentile(step_times, q) * 1000
+        metrics.setdefault("timeline/data_wait_fraction", 0.)
+
+        for name, value in metrics.items():
+            pl_module.log(name, value)
@@ -2,8 +2,6 @@ from pathlib import Path
 
 import math
 
-import torch
-
 import pytorch_lightning as pl
 from pytorch_lightning import seed_everything
 from pytorch_lightning.loggers import TensorBoardLogger
@@ -19,6 +17,10 @@ from ray.tune.integration.pytorch_lightning import TuneReportCallback
 
 from models import DBModel
 from datamodules import cifar100_datamodule
+from curve_scheduler import LearningCurveScheduler
+from telemetry import StepTimeline, timeline_tune_metrics
+from results_store import ResultsStore
+from masks import MaskStability
 
 def main():
     rank_zero_info(f"Experiment name is: tl_dropback")
@@ -37,6 +39,14 @@ def training(config, num_epochs=10, num_gpus=0):
     cifar100_dm = cifar100_datamodule(labels=target_list_2, already_prepared=True, data_dir=str(Path.home())+"/data")
     num_classes = cifar100_dm.num_classes
     
+    # Per step time breakdown (data wait, forward, backward, optimizer, ...), see telemetry.py
+    step_timeline = False
+    # Jaccard overlap and turnover of the tracked (or unpruned) weights over training, see masks.py
+    mask_stability = False
+    # Every config and metric also goes to results.sqlite in the experiment directory, see results_store.py.
+    # SQLite's WAL needs a local filesystem for the experiment directory
+    results_store = False
+
     trainer = pl.Trainer(
         max_epochs=num_epochs,
         gpus=math.ceil(num_gpus),           # If fractional GPUs passed in, convert to int.
@@ -50,7 +60,8 @@ def training(config, num_epochs=10, num_gpus=0):
                     "loss": "ptl/val_loss",
                     "mean_accuracy": "ptl/val_accuracy_top1",
                     "current_lr": "current_lr",
-                    "sparsity" : "sparsity"
+                    "sparsity" : "sparsity",
+                    **(timeline_tune_metrics() if step_timeline else {}),
                 },
                 on="validation_end"),
             ModelCheckpoint(
@@ -60,25 +71,16 @@ def training(config, num_epochs=10, num_gpus=0):
                 mode='max',
                 auto_insert_metric_name=False
             )
-        ]
+        ] + ([StepTimeline()] if step_timeline else []) + ([MaskStability()] if mask_stability else [])
+          + ([ResultsStore(config)] if results_store else [])
     )
 
     # checkpoint_path = None
     checkpoint_path = str(Path.home()) + "/" + "dropback_experiments/checkpoints/Source_1/dropback-val_accuracy0.87-val_loss0.64.ckpt"
     if checkpoint_path:
-        checkpoint = torch.load(checkpoint_path)
-        model = DBModel(config=config, num_classes=num_classes)
-        model.load_state_dict(checkpoint['state_dict'])  
-        
-        # Clear the momentum related states
-        checkpoint['optimizer_states'][0]['state'] = {}
-        # Initialize the trainer
-        trainer.max_epochs = 0
-        trainer.fit(model, datamodule=cifar100_dm)
-        trainer.max_epochs = num_epochs
-        trainer.optimizers[0].load_state_dict(checkpoint['optimizer_states'][0])
-
-        rank_zero_info(f"Checkpoint {checkpoint_path} loaded.")
+        # Takes over the weights, initial weights and decay state of the source run, without its momentum.
+        # Parameters can be frozen or trained densely by name prefix, e.g. dense=["model.classifier"]
+        model = DBModel(config=config, num_classes=num_classes, source_checkpoint=checkpoint_path, source_momentum=False)
     else:
         model = DBModel(config=config, num_classes=num_classes)
 
@@ -97,10 +99,19 @@ def tune_asha(num_samples=10, num_epochs=10, gpus_per_trial=0):
         "sf": False
     }
 
-    scheduler = ASHAScheduler(
-        max_t=num_epochs,
-        grace_period=60,
-        reduction_factor=2)
+    # Stop trials whose extrapolated accuracy curve is confidently below the best trial, see curve_scheduler.py
+    use_curve_scheduler = False
+    if use_curve_scheduler:
+        scheduler = LearningCurveScheduler(
+            max_t=num_epochs,
+            metric="mean_accuracy", sparsity_attr="sparsity",
+            min_t=20,
+            eval_every=10)
+    else:
+        scheduler = ASHAScheduler(
+            max_t=num_epochs,
+            grace_period=60,
+            reduction_factor=2)
 
     in_jupyter_notebook = False
     if in_jupyter_notebook:
@@ -0,0 +1,226 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+from pathlib import Path
+
+from pytorch_lightning.callbacks import Callback
+from pytorch_lightning.utilities import rank_zero_info
+
+from utils import is_sanity_checking
+
+DEFAULT_CACHE_DIR = str(Path.home()) + "/ray_results/trial_cache"
+
+# Sources that decide what a trial computes, their content is part of the trial identity
+CODE_FILES = ("models.py", "Dropback_qe.py", "Dropback.py", "Dropback_structured.py", "datamodules.py",
+              "datasets.py", "utils.py", "checkpoint.py")
+
+IDENTITY_FILE_NAME = "identity.json"
+RESULTS_FILE_NAME = "results.jsonl"
+COMPLETED_FILE_NAME = "completed.json"
+
+
+def code_version(files=CODE_FILES, scripts=()):
+    '''
+    Hash of the content of the training code, so edits (committed or not) change the identity.
+    scripts: paths of further sources, e.g. the experiment script defining the trial.
+    '''
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    paths = [(name, os.path.join(directory, name)) for name in files]
+    paths += [(os.path.basename(path), path) for path in scripts]
+    for name, path in paths:
+        if os.path.exists(path):
+            digest.update(name.encode())
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+def trial_identity(config, labels, arch, optimizer, num_epochs, seed=None, extra=None, script=None):
+    '''
+    Everything that decides the results of a trial. extra takes what a script sets outside
+    of the config (source checkpoint, accumulate_grad_batches, ...). script is the source
+    file of the trial function (its __file__), it holds the pruning schedule, the trainer
+    options and the flags of the script and is hashed with the training code. Without a
+    seed (deterministic=False) trials with the same identity are taken as interchangeable runs.
+    '''
+    return {
+        "config": config,
+        "labels": list(labels),
+        "arch": arch,
+        "optimizer": optimizer,
+        "num_epochs": num_epochs,
+        "seed": seed,
+        "extra": extra or {},
+        "code": code_version(scripts=(script,) if script else ()),
+    }
+
+def _digest(identity):
+    return hashlib.sha256(json.dumps(identity, sort_keys=True, default=str).encode()).hexdigest()[:24]
+
+def _read_results(run_dir):
+    results = {}
+    path = os.path.join(run_dir, RESULTS_FILE_NAME)
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    results[entry["epoch"]] = entry["report"]
+    return results
+
+def _checkpoint_path(run_dir, epoch):
+    return os.path.join(run_dir, f"epoch{epoch:03d}.ckpt")
+
+def _checkpoint_epochs(run_dir):
+    return sorted(int(os.path.basename(path)[len("epoch"):-len(".ckpt")]) for path in glob.glob(os.path.join(run_dir, "epoch*.ckpt")))
+
+
+class TrialCache:
+    '''
+    Content addressed store of the results and checkpoints of trials.
+
+    The entry of a trial is a directory named after the hash of its identity without the
+    epoch budget: the lr schedules only depend on the epoch, so a trial with a larger budget
+    runs through the same epochs first and the checkpoints of a shorter (or stopped) trial
+    are a prefix of it. Every run of an identity has its own run directory with the reported
+    results of every epoch (results.jsonl) and a checkpoint every few epochs.
+
+    lookup() finds the longest cached prefix of a trial: the latest checkpoint at or before
+    its last epoch whose run has the results of all epochs up to it. When that is the last
+    epoch the trial is complete and restore() only replays the results, otherwise training
+    resumes from the checkpoint.
+    '''
+
+    def __init__(self, identity, cache_dir=DEFAULT_CACHE_DIR):
+        self.identity = identity
+        self.num_epochs = identity["num_epochs"]
+        self.key = _digest({key: value for key, value in identity.items() if key != "num_epochs"})
+        self.directory = os.path.join(cache_dir, self.key)
+        self.run_dir = None
+        self.resume_epoch = None
+        self._resumed_results = []
+
+    def runs(self):
+        return sorted(glob.glob(os.path.join(self.directory, "run-*")))
+
+    def lookup(self):
+        '''(run_dir, epoch) of the longest cached prefix of the trial, (None, None) without one.'''
+        best = (None, None)
+        for run_dir in self.runs():
+            results = _read_results(run_dir)
+            for epoch in reversed(_checkpoint_epochs(run_dir)):
+                if epoch < self.num_epochs and all(e in results for e in range(epoch + 1)):
+                    if best[1] is None or epoch > best[1]:
+                        best = (run_dir, epoch)
+                    break
+        return best
+
+    def restore(self, report, trial_dir=None):
+        '''
+        Replay the cached results of the longest prefix with report (tune.report).
+        Returns (completed, checkpoint path to resume from). A complete trial also gets its
+        last checkpoint linked into <trial_dir>/checkpoints.
+        '''
+        run_dir, epoch = self.lookup()
+        if run_dir is None:
+            return False, None
+
+        start = time.time()
+        results = _read_results(run_dir)
+        for e in range(epoch + 1):
+            report(**results[e])
+        checkpoint = _checkpoint_path(run_dir, epoch)
+        completed = epoch == self.num_epochs - 1
+        if completed and trial_dir:
+            os.makedirs(os.path.join(trial_dir, "checkpoints"), exist_ok=True)
+            target = os.path.join(trial_dir, "checkpoints", os.path.basename(checkpoint))
+            try:
+                os.link(checkpoint, target)
+            except OSError:
+                shutil.copyfile(checkpoint, target)
+
+        self.resume_epoch = epoch
+        self._resumed_results = [(e, results[e]) for e in range(epoch + 1)]
+        rank_zero_info(f"Trial cache {self.key}: {'complete' if completed else 'resuming after'} epoch {epoch} "
+                       f"of {os.path.basename(run_dir)}, {epoch + 1} results replayed in {time.time() - start:.2f}s.")
+        return completed, None if completed else checkpoint
+
+    def new_run(self):
+        '''Directory of a new run of the trial, starting with the results it resumes from.'''
+        self.run_dir = os.path.join(self.directory, f"run-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}")
+        os.makedirs(self.run_dir)
+        with open(os.path.join(self.run_dir, IDENTITY_FILE_NAME), "w") as f:
+            json.dump(self.identity, f, indent=2, default=str)
+        for epoch, report in self._resumed_results:
+            self.add_result(epoch, report)
+        return self.run_dir
+
+    def add_result(self, epoch, report):
+        with open(os.path.join(self.run_dir, RESULTS_FILE_NAME), "a") as f:
+            f.write(json.dumps({"epoch": epoch, "report": report}) + "\n")
+
+    def complete(self, epoch):
+        with open(os.path.join(self.run_dir, COMPLETED_FILE_NAME), "w") as f:
+            json.dump({"num_epochs": epoch + 1, "checkpoint": _checkpoint_path(self.run_dir, epoch)}, f)
+
+
+class TrialMemo(Callback):
+    '''
+    Writes a run of a trial to a TrialCache: the metrics reported to Ray Tune (the same
+    {report key: logged metric} as TuneReportCallback) after every validation, and a
+    Lightning checkpoint every every_n_epochs epochs and at the last one. Checkpoints are
+    written to a temporary file first, so a trial stopped by the scheduler never leaves a
+    partial one. Only the global zero process writes.
+    '''
+
+    def __init__(self, cache, metrics, every_n_epochs=50):
+        super().__init__()
+        self.cache = cache
+        self.metrics = metrics
+        self.every_n_epochs = every_n_epochs
+        self._last_epoch = None
+
+    def on_train_start(self, trainer, pl_module):
+        if trainer.is_global_zero:
+            self.cache.new_run()
+
+    def on_validation_end(self, trainer, pl_module):
+        if is_sanity_checking(trainer):
+            return
+        if not trainer.is_global_zero or self.cache.run_dir is None:
+            return
+        epoch = trainer.current_epoch
+        report = {key: trainer.callback_metrics[metric].item() for key, metric in self.metrics.items() if metric in trainer.callback_metrics}
+        self.cache.add_result(epoch, report)
+        self._last_epoch = epoch
+
+        if (epoch + 1) % self.every_n_epochs == 0 or epoch + 1 == trainer.max_epochs:
+            path = _checkpoint_path(self.cache.run_dir, epoch)
+            trainer.save_checkpoint(path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+    def on_train_end(self, trainer, pl_module):
+        if self.cache.run_dir is not None and self._last_epoch is not None and self._last_epoch + 1 == trainer.max_epochs:
+            self.cache.complete(self._last_epoch)
+
+
+def main():
+    '''List the entries of a trial cache.'''
+    cache_dir = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CACHE_DIR
+    for directory in sorted(glob.glob(os.path.join(cache_dir, "*"))):
+        for run_dir in sorted(glob.glob(os.path.join(directory, "run-*"))):
+            with open(os.path.join(run_dir, IDENTITY_FILE_NAME)) as f:
+                identity = json.load(f)
+            results = _read_results(run_dir)
+            completed = os.path.exists(os.path.join(run_dir, COMPLETED_FILE_NAME))
+            print(f"{os.path.basename(directory)}/{os.path.basename(run_dir)}: {identity['optimizer']} {identity['arch']}, "
+                  f"{len(results)}/{identity['num_epochs']} epochs, checkpoints {_checkpoint_epochs(run_dir)}"
+                  f"{', completed' if completed else ''}, config {identity['config']}")
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,10 @@
 import math
+import statistics
+import time
 import torch
+import torch.nn as nn
+import torch.nn.utils.prune as prune
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 def measure_module_sparsity(module, threshold=0, weight=True, bias=False, use_mask=False):
 
@@ -103,3 +108,162 @@ def compute_num_param_to_keep(model, target_prune_rate):
     num_param_to_prune = math.ceil(num_parameters * target_prune_rate)
     
     return num_parameters, num_param_to_prune
+
+def remove_pruning_reparametrization(model):
+    '''
+    Make every pruning reparametrization in the model permanent, i.e. replace
+    weight_orig * weight_mask by a plain parameter and drop the forward pre-hooks.
+    '''
+    for module in model.modules():
+        for hook in list(module._forward_pre_hooks.values()):
+            if isinstance(hook, prune.BasePruningMethod):
+                prune.remove(module, hook._tensor_name)
+
+    return model
+
+def fold_batchnorm(model):
+    '''
+    Fold every BatchNorm2d that directly follows a Conv2d inside an nn.Sequential
+    (ConvBNReLU blocks and the projection of InvertedResidual in MobileNetV2) into
+    the convolution. The model is modified in place and has to be in eval mode.
+    Pruning reparametrizations are made permanent first.
+    '''
+    remove_pruning_reparametrization(model)
+
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        children = list(module.named_children())
+        for (conv_name, conv), (bn_name, bn) in zip(children[:-1], children[1:]):
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                module._modules[conv_name] = fuse_conv_bn_eval(conv, bn)
+                module._modules[bn_name] = nn.Identity()
+
+    return model
+
+def count_macs(model, input_size=(1, 3, 32, 32)):
+    '''
+    Multiply-accumulates per sample of the Conv2d and Linear layers, computed from the
+    layer shapes seen during a forward pass with a dummy input.
+    '''
+    macs = []
+
+    def conv_hook(module, inputs, output):
+        kernel_macs = (module.in_channels // module.groups) * module.kernel_size[0] * module.kernel_size[1]
+        macs.append(output[0].numel() * kernel_macs)
+
+    def linear_hook(module, inputs, output):
+        macs.append(output[0].numel() * module.in_features)
+
+    handles = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            handles.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            handles.append(module.register_forward_hook(linear_hook))
+
+    was_training = model.training
+    model.eval()
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        model(torch.zeros(input_size, device=device))
+    model.train(was_training)
+
+    for handle in handles:
+        handle.remove()
+
+    return sum(macs)
+
+def effective_macs(model, input_size=(1, 3, 32, 32)):
+    '''
+    Multiply-accumulates per sample of the Conv2d and Linear layers under three execution models:
+
+        dense         every weight is used
+        unstructured  only the nonzero weights are used (an ideal sparse kernel)
+        channel       output channels with only zero weights are removed and, unless the
+                      convolution is grouped, input channels with only zero weights, the rest runs dense
+
+    The channel count is per layer, an input channel only disappears in practice when the
+    layer before does not produce it. Layer shapes are taken from a forward pass with a dummy
+    input as in count_macs, the weights are the current ones (with pruning masks applied).
+    '''
+    macs = {"dense": 0, "unstructured": 0, "channel": 0}
+
+    def hook(module, inputs, output):
+        weight = module.weight.detach()
+        positions = output[0][0].numel() if isinstance(module, nn.Conv2d) else 1
+        nonzero = weight != 0
+        alive_out = int(nonzero.flatten(1).any(1).sum())
+        if isinstance(module, nn.Conv2d) and module.groups > 1:
+            alive_in = weight.size(1)
+        else:
+            alive_in = int(nonzero.transpose(0, 1).flatten(1).any(1).sum())
+        macs["dense"] += positions * weight.numel()
+        macs["unstructured"] += positions * int(nonzero.sum())
+        macs["channel"] += positions * alive_out * alive_in * weight[0, 0].numel()
+
+    handles = [module.register_forward_hook(hook) for module in model.modules() if isinstance(module, (nn.Conv2d, nn.Linear))]
+
+    was_training = model.training
+    model.eval()
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        model(torch.zeros(input_size, device=device))
+    model.train(was_training)
+
+    for handle in handles:
+        handle.remove()
+
+    return macs
+
+@torch.no_grad()
+def cpu_latency(model, input_size=(1, 3, 32, 32), num_steps=50, warmup=10, num_threads=None):
+    '''
+    Median wall clock in seconds of a forward pass of model (in its current mode) on a random
+    input_size batch, with num_threads intra-op threads (None keeps the current setting).
+    '''
+    threads = torch.get_num_threads()
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    x = torch.randn(input_size)
+    times = []
+    try:
+        for i in range(warmup + num_steps):
+            start = time.perf_counter()
+            model(x)
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+    finally:
+        torch.set_num_threads(threads)
+    return statistics.median(times)
+
+def pack_mask(mask):
+    '''
+    Pack a bool tensor into a flat uint8 tensor, 8 entries per byte (most significant bit first).
+    '''
+    flattened = mask.flatten().to(torch.uint8)
+    padding = (-flattened.numel()) % 8
+    if padding:
+        flattened = torch.cat([flattened, flattened.new_zeros(padding)])
+    bit_values = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=mask.device)
+
+    return (flattened.view(-1, 8) * bit_values).sum(1).to(torch.uint8)
+
+def unpack_mask(packed, shape):
+    '''
+    Inverse of pack_mask, returns a bool tensor of the given shape.
+    '''
+    numel = 1
+    for size in shape:
+        numel *= size
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=packed.device)
+    bits = (packed.unsqueeze(1) >> shifts) & 1
+
+    return bits.flatten()[:numel].view(shape).bool()
+
+def is_sanity_checking(trainer):
+    '''
+    Whether the trainer runs the validation sanity check before training, under the
+    attribute names of the installed Lightning version.
+    '''
+    return getattr(trainer, "sanity_checking", getattr(trainer, "running_sanity_check", False))